@@ -1,23 +1,51 @@
+from __future__ import print_function
+import binascii
+import bisect
 import datetime
+import hashlib
+import io
+import json
 import mmap
+import os
+import struct
+import time
+import zipfile
 
-# shorthand parsing methods. They take a sequence of characters (bytes) as input.
+import numpy as np
+
+try:
+    BadZipFile = zipfile.BadZipFile
+except AttributeError:
+    BadZipFile = zipfile.BadZipfile     # Python 2
+
+# shorthand parsing methods. They take a sequence of bytes (str, bytes or memoryview) as input.
 def number(seq):
-    out = 0
-    for c in seq:
-        out = 256*out + ord(c)
-    return out
+    "Big-endian unsigned number"
+    return int(binascii.hexlify(bytearray(seq)) or b'0', 16)
 
-def rawstring(seq, encoding='ascii'):
-    return ''.join(seq)
+if str is bytes:
+    # Python 2: keep strings as byte strings
+    def rawstring(seq, encoding='ascii'):
+        return str(bytearray(seq))
+else:
+    def rawstring(seq, encoding='ascii'):
+        return bytes(seq).decode(encoding, 'replace')
 
 def string(seq, encoding='ascii'):
     return rawstring(seq, encoding).rstrip()
 
+def byte_array(data):
+    "View bytes-like data (a string, mmap, memoryview or array) as a uint8 array, without copying"
+    if isinstance(data, (np.ndarray, memoryview)):
+        return np.asarray(data, dtype=np.uint8)
+    else:
+        return np.frombuffer(data, dtype=np.uint8)
+
 # the disc label datetime format
 def dl_datetime(seq):
     assert len(seq) == 16
 
+    seq = rawstring(seq)
     if seq == '0'*16:
         return None
     else:
@@ -30,25 +58,234 @@ def dl_datetime(seq):
 def dir_datetime(seq):
     assert len(seq) == 6
 
-    year, month,  day    = 1900+number(seq[0:1]), number(seq[1:2]), number(seq[2:3])
-    hour, minute, second = number(seq[3:4]), number(seq[4:5]), number(seq[5:6])
+    year, month,  day, hour, minute, second = bytearray(seq)
+    year += 1900
 
     return datetime.datetime(year, month, day, hour, minute, second)
 
+# the range list format of the command line tools
+def range_mask(spec, count):
+    """Parse a comma-separated list of ranges like '16-32,100,200-' into a boolean mask of length count.
+
+    'a-b' stands for a up to but not including b, like a slice; 'a' for just
+    a, 'a-' for a to the end and '-b' for the start up to b. Raises
+    ValueError for a malformed list."""
+    mask = np.zeros(count, dtype=bool)
+    for part in spec.split(','):
+        bounds = part.strip().split('-')
+        if len(bounds) == 1 and bounds[0]:
+            start = int(bounds[0])
+            stop  = start+1
+        elif len(bounds) == 2 and (bounds[0] or bounds[1]):
+            start = int(bounds[0]) if bounds[0] else 0
+            stop  = int(bounds[1]) if bounds[1] else count
+        else:
+            raise ValueError("Invalid range '%s'" % part)
+        mask[max(0, start):max(0, stop)] = True
+    return mask
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+class _Stage(object):
+    "Context manager adding the time spent in it to a stage of a Stats object"
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name  = name
+
+    def __enter__(self):
+        self.start = _clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stats.add_time(self.name, _clock() - self.start)
+
+class _NullStage(object):
+    "Context manager that does nothing, handed out while statistics are off"
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+_NULL_STAGE = _NullStage()
+
+class Stats(object):
+    """Stage timers and counters, to find out where a run spends its time.
+
+    Code wraps its stages in 'with stats.stage(name):' and counts work with
+    stats.count(name, n). Both are no-ops until enable() is called, and hot
+    code checks stats.enabled before counting, so turned off they cost next
+    to nothing. Stage times include the time of stages nested in them."""
+
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        self.times    = {}
+        self.calls    = {}
+        self.counters = {}
+        self.started  = _clock()
+
+    def enable(self):
+        self.enabled = True
+        self.reset()
+
+    def stage(self, name):
+        "Context manager timing a stage"
+        return _Stage(self, name) if self.enabled else _NULL_STAGE
+
+    def add_time(self, name, seconds, calls=1):
+        self.times[name] = self.times.get(name, 0.) + seconds
+        self.calls[name] = self.calls.get(name, 0) + calls
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def as_dict(self):
+        "The statistics as a dictionary that can be stored as JSON"
+        return {'wall_time': _clock() - self.started,
+                'stages':    dict((name, {'seconds': self.times[name], 'calls': self.calls[name]}) for name in self.times),
+                'counters':  dict(self.counters)}
+
+    def take(self):
+        "Returns the statistics as a dictionary and starts over, for passing on results from worker processes"
+        result = self.as_dict()
+        self.reset()
+        return result
+
+    def merge(self, other):
+        "Add the stage times and counters of a dictionary from as_dict or take"
+        for name, stage in other['stages'].items():
+            self.add_time(name, stage['seconds'], stage['calls'])
+        for name, n in other['counters'].items():
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self, out):
+        "Print a breakdown of the statistics"
+        wall = self.as_dict()['wall_time']
+        print("%-20s %10s %8s %10s" % ('stage', 'seconds', '%', 'calls'), file=out)
+        for name in sorted(self.times, key=lambda name: -self.times[name]):
+            print("%-20s %10.4f %7.1f%% %10d" % (name, self.times[name], 100.*self.times[name]/wall if wall > 0 else 0., self.calls[name]), file=out)
+        print("%-20s %10.4f" % ('total', wall), file=out)
+
+        if self.counters:
+            print(file=out)
+            print("%-20s %19s" % ('counter', 'count'), file=out)
+            for name in sorted(self.counters):
+                print("%-20s %19d" % (name, self.counters[name]), file=out)
+
+    def write_json(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2, sort_keys=True)
+
+# the statistics of this process, off unless a tool is run with --stats
+stats = Stats()
+
+# error detection and correction codes of Mode 2 sectors. These work on blocks
+# of many sectors at once: 2-D uint8 arrays of full sectors, one per row.
+# Offsets are within the full sector, which starts at the subheader.
+EDC_FORM1_SIZE   = 2056     # subheader and data covered by the EDC
+EDC_FORM2_SIZE   = 2332
+ECC_P_OFFSET     = 2060
+ECC_Q_OFFSET     = 2232
+ECC_SIZE         = 276      # P and Q parity, at the end of a Form 1 sector
+
+def _edc_tables():
+    "Tables for computing the EDC, a reflected CRC-32 with polynomial 0xD8018001, four bytes at a time"
+    table = np.arange(256, dtype=np.uint32)
+    for _ in range(8):
+        table = (table >> 1) ^ np.where(table & 1, np.uint32(0xD8018001), np.uint32(0))
+    tables = [table]
+    for _ in range(3):
+        prev = tables[-1]
+        tables.append((prev >> 8) ^ table[prev & 0xff])
+    return tables
+
+def _ecc_tables():
+    "Multiplication by 2 in GF(2^8), and the inverse of x -> x ^ 2x, as used for the ECC"
+    f_lut = np.zeros(256, dtype=np.uint8)
+    b_lut = np.zeros(256, dtype=np.uint8)
+    for i in range(256):
+        j = ((i << 1) ^ (0x11d if i & 0x80 else 0)) & 0xff
+        f_lut[i] = j
+        b_lut[i ^ j] = i
+    return f_lut, b_lut
+
+def _ecc_indices(major_count, minor_count, major_mult, minor_inc):
+    "For every P or Q vector, the positions in the covered bytes that it runs through, as a (minor_count, major_count) array"
+    size = major_count*minor_count
+    indices = np.zeros((minor_count, major_count), dtype=np.intp)
+    for major in range(major_count):
+        index = (major >> 1)*major_mult + (major & 1)
+        for minor in range(minor_count):
+            indices[minor, major] = index
+            index = (index + minor_inc) % size
+    return indices
+
+_EDC_TABLES = _edc_tables()
+_ECC_F, _ECC_B = _ecc_tables()
+_ECC_P = _ecc_indices(86, 24, 2, 86)
+_ECC_Q = _ecc_indices(52, 43, 86, 88)
+
+def sector_edc(block, form2):
+    """Compute the EDC of every sector in block, over 2056 bytes for Form 1 and 2332 bytes for Form 2 sectors.
+
+    form2 is a boolean array saying which rows are Form 2 sectors. Returns a
+    uint32 array, to compare with the EDC stored little-endian after the data."""
+    words = np.ascontiguousarray(block[:, :EDC_FORM2_SIZE]).view('<u4').astype(np.uint32).T.copy()
+    t0, t1, t2, t3 = _EDC_TABLES
+    edc = np.zeros(len(block), dtype=np.uint32)
+    result = np.zeros(len(block), dtype=np.uint32)
+    form2 = np.asarray(form2, dtype=bool)
+    for i in range(EDC_FORM2_SIZE // 4):
+        if i == EDC_FORM1_SIZE // 4:
+            result[~form2] = edc[~form2]
+        edc ^= words[i]
+        edc = t3[edc & 0xff] ^ t2[(edc >> 8) & 0xff] ^ t1[(edc >> 16) & 0xff] ^ t0[edc >> 24]
+    result[form2] = edc[form2]
+    return result
+
+def stored_edc(block, form2):
+    "The EDC stored in every sector in block, as a uint32 array"
+    form2 = np.asarray(form2, dtype=bool)
+    at = lambda offset: np.ascontiguousarray(block[:, offset:offset+4]).view('<u4')[:, 0].astype(np.uint32)
+    return np.where(form2, at(EDC_FORM2_SIZE), at(EDC_FORM1_SIZE))
+
+def _ecc_parity(src, indices):
+    "P or Q parity of every column of src, which has the covered bytes of one sector per column, with the vectors running through indices"
+    a = np.zeros((indices.shape[1], src.shape[1]), dtype=np.uint8)
+    b = np.zeros_like(a)
+    for row in indices:
+        byte = src[row]
+        a ^= byte
+        b ^= byte
+        a = _ECC_F[a]
+    a = _ECC_B[_ECC_F[a] ^ b]
+    return np.concatenate((a, a ^ b))
+
+def sector_ecc(block):
+    """Compute the P and Q parity of every sector in block as Form 1 sectors. Returns a (len(block), 276) uint8 array.
+
+    As in all Mode 2 sectors, the CD header counts as zero, so the ECC does
+    not depend on whether the image has headers. Q covers the P parity, and
+    is computed over the computed P."""
+    src = np.zeros((4 + ECC_Q_OFFSET, len(block)), dtype=np.uint8)
+    src[4:4+ECC_P_OFFSET] = block[:, :ECC_P_OFFSET].T
+    p = _ecc_parity(src, _ECC_P)
+    src[4+ECC_P_OFFSET:] = p
+    q = _ecc_parity(src, _ECC_Q)
+    return np.concatenate((p, q)).T
+
 class Subheader(object):
     "A sector sub-header"
     SIZE = 8
+    LAYOUT = struct.Struct('>BBBB')
 
     def __init__(self, data):
-        # check redundancy
-        # for i in range(4):
-        #     assert data[i] == data[4+i], "Redundant subheader data does not match"
-
-        # fill in fields
-        self.file_number    = number(data[0:1])
-        self.channel_number = number(data[1:2])
-        self.submode_raw    = number(data[2:3])
-        self.coding_raw     = number(data[3:4])
+        # fill in fields; the redundant copy is checked by cdi_verify.py, not here
+        self.file_number, self.channel_number, self.submode_raw, self.coding_raw = Subheader.LAYOUT.unpack_from(data)
 
     def _submode_flag(bit, doc):
         "helper for bit flag boilerplate"
@@ -72,51 +309,137 @@ class Sector(object):
         self.disc = disc
         self.offset = offset
         self.subheader = Subheader(self[0:Subheader.SIZE])
+        if stats.enabled:
+            stats.count('sector objects')
 
     data_size   = property(lambda self: 2048 if self.subheader.form1 else 2324, doc="The number of data bytes in the sector")
     FULL_SIZE = 2336
 
     def __getitem__(self, key):
-        return self.disc.image_file[self.offset:self.offset+self.FULL_SIZE][key]
+        # only copy the requested bytes out of the image
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.FULL_SIZE)
+            if step == 1:
+                result = self.disc.image_file[self.offset+start:self.offset+max(start, stop)]
+            else:
+                result = self.disc.image_file[self.offset:self.offset+self.FULL_SIZE][key]
+            if stats.enabled:
+                stats.count('bytes copied', len(result))
+            return result
+
+        if key < 0:
+            key += self.FULL_SIZE
+        if not 0 <= key < self.FULL_SIZE:
+            raise IndexError("sector index out of range")
+        if stats.enabled:
+            stats.count('bytes copied')
+        return self.disc.image_file[self.offset+key]
 
-    def __iter__(self, key):
+    def __iter__(self):
         return iter(self.data)
 
-    data = property(lambda self: self[Subheader.SIZE:Subheader.SIZE+self.data_size], doc="Returns the data part of the sector")
+    data = property(lambda self: self[Subheader.SIZE:Subheader.SIZE+self.data_size], doc="Returns a copy of the data part of the sector")
+
+    view = property(lambda self: memoryview(self.disc.buffer[self.offset:self.offset+self.FULL_SIZE]),
+                    doc="Returns a read-only memoryview of the full sector, without copying")
+
+    data_view = property(lambda self: self.view[Subheader.SIZE:Subheader.SIZE+self.data_size],
+                         doc="Returns a read-only memoryview of the data part of the sector, without copying")
+
+class SectorTable(object):
+    """Columnar table of all sectors in a disc image.
+
+    Holds one array per field (sector offset and the four subheader fields),
+    all filled in a single strided pass over the image. Sector objects are
+    only created on demand by Disc.__getitem__."""
+
+    COLUMNS = ('offset', 'file_number', 'channel_number', 'submode_raw', 'coding_raw')
+
+    def __init__(self, image_file, headers=False):
+        start  = Disc.HEADER_LEN if headers else 0
+        stride = (Sector.FULL_SIZE+Disc.HEADER_LEN) if headers else Sector.FULL_SIZE
+        size   = len(image_file)
+        count  = max(0, (size - start + stride - 1) // stride)
+
+        buf = np.frombuffer(image_file, dtype=np.uint8)
+
+        with stats.stage('scan'):
+            self.offset         = start + stride*np.arange(count, dtype=np.int64)
+            self.file_number    = self._column(buf, start+0, stride, count)
+            self.channel_number = self._column(buf, start+1, stride, count)
+            self.submode_raw    = self._column(buf, start+2, stride, count)
+            self.coding_raw     = self._column(buf, start+3, stride, count)
+        stats.count('sectors scanned', count)
+
+    @classmethod
+    def from_columns(cls, columns):
+        "Create a sector table from columns built before, as loaded by DiscIndex"
+        table = cls.__new__(cls)
+        for name in cls.COLUMNS:
+            setattr(table, name, columns[name])
+        return table
+
+    @staticmethod
+    def _column(buf, start, stride, count):
+        "Copies one byte out of every sector. A truncated last sector reads as zero, like number('') does."
+        col = np.zeros(count, dtype=np.uint8)
+        values = buf[start::stride]
+        col[:len(values)] = values
+        return col
+
+    def _submode_flag(bit, doc):
+        "helper for bit flag boilerplate"
+        def getter(self):
+            return (self.submode_raw & (1<<bit)) != 0
+        return property(getter, doc=doc)
+
+    eor      = _submode_flag(0, "Mask of sectors that are last in record")
+    video    = _submode_flag(1, "Mask of sectors that contain video")
+    audio    = _submode_flag(2, "Mask of sectors that contain audio")
+    data     = _submode_flag(3, "Mask of sectors that contain data")
+    empty    = property(lambda self: (self.submode_raw & 0b00001110) == 0, doc="Mask of sectors that have no type")
+    trigger  = _submode_flag(4, "Mask of sectors that cause an interrupt when read")
+    form2    = _submode_flag(5, "Mask of Form 2 sectors")
+    form1    = property(lambda self: ~self.form2, doc="Mask of Form 1 sectors")
+    realtime = _submode_flag(6, "Mask of sectors that are for real-time reading")
+    eof      = _submode_flag(7, "Mask of sectors that are last in file")
+
+    def __len__(self):
+        return len(self.offset)
 
 class DiscLabel(object):
     STANDARD   = 1
     CODED      = 2
     TERMINATOR = 255
 
+    # layout of a standard disc label, starting at the type byte
+    LAYOUT = struct.Struct('>B5sBB32s32s12xI32s2xH2xH2xH4xI8xI38x128s128s128s128s32s5x32s5x32s5x16sx16sx16sx16sxB')
+
     def __init__(self, sector):
         self.sector = sector
-        self.type = number(sector.data[0:1])
+        data = sector.data_view
+        self.type = number(data[0:1])
         if self.type == DiscLabel.STANDARD:
-            self.standard_id    = rawstring(sector.data[  1:  6])
-            self.version        = number(sector.data[  6:  7])
-            self.volume_flags   = number(sector.data[  7:  8])
-            self.system_id      = string(sector.data[  8: 40])
-            self.volume_id      = string(sector.data[ 40: 72])
-            self.volume_size    = number(sector.data[ 84: 88])
-            self.charset        = string(sector.data[ 88:120])
-            self.album_size     = number(sector.data[122:124])
-            self.album_idx      = number(sector.data[126:128])
-            self.block_size     = number(sector.data[130:132])
-            self.path_tbl_size  = number(sector.data[136:140])
-            self.path_tbl_addr  = number(sector.data[148:152])
-            self.album_id       = string(sector.data[190:318])
-            self.publisher_id   = string(sector.data[318:446])
-            self.data_preparer  = string(sector.data[446:574])
-            self.app_id         = string(sector.data[574:702])
-            self.copyright_file = string(sector.data[702:734])
-            self.abstract_file  = string(sector.data[739:771])
-            self.biblio_file    = string(sector.data[776:808])
-            self.creation_date  = dl_datetime(sector.data[813:829])
-            self.mod_date       = dl_datetime(sector.data[830:846])
-            self.exp_date       = dl_datetime(sector.data[847:863])
-            self.effective_date = dl_datetime(sector.data[864:880])
-            self.fs_version     = number(sector.data[881:882])
+            (_, standard_id, self.version, self.volume_flags, system_id, volume_id, self.volume_size,
+             charset, self.album_size, self.album_idx, self.block_size, self.path_tbl_size, self.path_tbl_addr,
+             album_id, publisher_id, data_preparer, app_id, copyright_file, abstract_file, biblio_file,
+             creation_date, mod_date, exp_date, effective_date, self.fs_version) = DiscLabel.LAYOUT.unpack_from(data)
+
+            self.standard_id    = rawstring(standard_id)
+            self.system_id      = string(system_id)
+            self.volume_id      = string(volume_id)
+            self.charset        = string(charset)
+            self.album_id       = string(album_id)
+            self.publisher_id   = string(publisher_id)
+            self.data_preparer  = string(data_preparer)
+            self.app_id         = string(app_id)
+            self.copyright_file = string(copyright_file)
+            self.abstract_file  = string(abstract_file)
+            self.biblio_file    = string(biblio_file)
+            self.creation_date  = dl_datetime(creation_date)
+            self.mod_date       = dl_datetime(mod_date)
+            self.exp_date       = dl_datetime(exp_date)
+            self.effective_date = dl_datetime(effective_date)
 
 class FileAttr(object):
     def __init__(self, flags):
@@ -138,7 +461,7 @@ class FileAttr(object):
     directory  = _flag(15, "File is directory")
 
 class File(object):
-    def __init__(self, name, attr_size, first_lbn, size, creation_date, flags, interleave_a, interleave_b, album_idx, owner, attributes, number):
+    def __init__(self, name, attr_size, first_lbn, size, creation_date, flags, interleave_a, interleave_b, album_idx, owner, attributes, number, disc=None):
         self.name          = name
         self.attr_size     = attr_size
         self.first_lbn     = first_lbn
@@ -151,44 +474,121 @@ class File(object):
         self.owner         = owner
         self.attributes    = attributes
         self.number        = number
+        self.disc          = disc
+
+    def interleaved_sectors(self, disc=None):
+        """Sorted array of the indices of the sectors the file occupies according to its directory record, without reading them.
+
+        interleave_a is the number of blocks in each unit of the file and
+        interleave_b the number of blocks of other files between units, like
+        the file unit size and interleave gap size of ISO 9660. A file with
+        either of them zero takes up successive blocks. The size gives the
+        number of blocks. Sectors past the end of the image are left out."""
+        disc = disc or self.disc
+        start = disc.lbn2sector(self.first_lbn)
+        blocks = np.arange(max(1, (self.size + 2047) // 2048), dtype=np.int64)
+        if self.interleave_a and self.interleave_b:
+            unit, gap = self.interleave_a, self.interleave_b
+            blocks = (blocks // unit)*(unit + gap) + blocks % unit
+
+        indices = start + blocks
+        return indices[(indices >= 0) & (indices < len(disc.sectors))]
+
+    def __getstate__(self):
+        # the disc holds an mmap, which cannot be sent to worker processes; they have a disc of their own
+        state = dict(self.__dict__)
+        state['disc'] = None
+        return state
+
+    def open(self, record=None, channel=None, buffering=io.DEFAULT_BUFFER_SIZE, disc=None):
+        """Open the data of the file for reading, as a seekable binary file object.
+
+        With record and/or channel, only the sectors of that record and channel
+        are read. Returns an io.BufferedReader over a FileReader, or the
+        FileReader itself if buffering is 0. disc is the disc the file is on,
+        by default the one it was read from."""
+        reader = FileReader(disc or self.disc, self, record, channel)
+        return io.BufferedReader(reader, buffering) if buffering else reader
 
 class Directory(object):
-    def __init__(self, name, attr_size, sector, parent):
+    # layouts of a file record: the fixed part before the file name, and the part after it
+    RECORD_HEAD = struct.Struct('>BB4xI4xI6sxBBB2xHB')
+    RECORD_TAIL = struct.Struct('>IH2xB')
+
+    # names of the records for the directory itself and its parent
+    SELF_NAMES = ('\x00', '\x01')
+
+    def __init__(self, name, attr_size, disc, lbn, parent, number):
         self.name       = name
         self.attr_size  = attr_size
-        self.sector     = sector
-        self.parent     = parent
+        self.disc       = disc
+        self.lbn        = lbn
+        self.parent     = parent    # path table number of the parent directory
+        self.number     = number    # path table number of this directory, the root is 1
 
-        # read actual sector
-        self.contents = []
-        offset = 0
-        while True:
-            file_record_length = number(sector.data[offset+ 0:offset+ 1])
-            if file_record_length == 0:
-                break
+        self._contents  = None
+        self._path      = None
+
+    sector = property(lambda self: self.disc.block(self.lbn), doc="The first block of the directory")
+
+    @property
+    def path(self):
+        "The full path of the directory, with a trailing slash"
+        if self._path is None:
+            if self.number == 1:
+                self._path = '/'
+            else:
+                self._path = self.disc.path_tbl[self.parent-1].path + self.name + '/'
+        return self._path
+
+    @property
+    def contents(self):
+        "The File records in the directory, read on first use"
+        if self._contents is None:
+            with stats.stage('directories'):
+                self._contents = self._read_contents()
+            stats.count('file objects', len(self._contents))
+        return self._contents
+
+    def _read_contents(self):
+        contents = []
+        nblocks = 1
+        block = 0
+        while block < nblocks:
+            # records do not cross block boundaries; a zero length byte ends the block
+            data = self.disc.block(self.lbn + block).data_view
+            offset = 0
+            while offset < len(data):
+                file_record_length = number(data[offset:offset+1])
+                if file_record_length == 0:
+                    break
+
+                f = self._read_record(data, offset)
+                if block == 0 and offset == 0:
+                    # the first record describes the directory itself, its size gives the extent
+                    nblocks = max(1, (f.size + 2047) // 2048)
 
-            file_attr_size     = number(sector.data[offset+ 1:offset+ 2])
-            file_first_lbn     = number(sector.data[offset+ 6:offset+10])
-            file_size          = number(sector.data[offset+14:offset+18])
-            file_creation_date = dir_datetime(sector.data[offset+18:offset+24])
-            file_flags         = number(sector.data[offset+25:offset+26])
-            file_interleave_a  = number(sector.data[offset+26:offset+27])
-            file_interleave_b  = number(sector.data[offset+27:offset+28])
-            file_album_idx     = number(sector.data[offset+30:offset+32])
-            file_name_size     = number(sector.data[offset+32:offset+33])
+                contents.append(f)
+                offset += file_record_length
 
-            file_name          = string(sector.data[offset+33:offset+33+file_name_size])
+            block += 1
 
-            file_owner         = number(sector.data[offset+33+file_name_size:offset+37+file_name_size])
-            file_attributes    = number(sector.data[offset+37+file_name_size:offset+39+file_name_size])
-            file_number        = number(sector.data[offset+41+file_name_size:offset+42+file_name_size])
+        return contents
 
-            f = File(file_name, file_attr_size, file_first_lbn, file_size, file_creation_date, file_flags, file_interleave_a,
-                     file_interleave_b, file_album_idx, file_owner, FileAttr(file_attributes), file_number)
+    def _read_record(self, data, offset):
+        (_, file_attr_size, file_first_lbn, file_size, file_creation_date, file_flags, file_interleave_a,
+         file_interleave_b, file_album_idx, file_name_size) = Directory.RECORD_HEAD.unpack_from(data, offset)
 
-            self.contents.append(f)
+        name_offset        = offset+Directory.RECORD_HEAD.size
+        file_name          = string(data[name_offset:name_offset+file_name_size])
 
-            offset += file_record_length 
+        file_owner, file_attributes, file_number = Directory.RECORD_TAIL.unpack_from(data, name_offset+file_name_size)
+
+        return File(file_name, file_attr_size, file_first_lbn, file_size, dir_datetime(file_creation_date), file_flags,
+                    file_interleave_a, file_interleave_b, file_album_idx, file_owner, FileAttr(file_attributes), file_number, self.disc)
+
+    def __len__(self):
+        return len(self.contents)
 
     def __getitem__(self, key):
         return self.contents[key]
@@ -197,55 +597,302 @@ class Directory(object):
         return iter(self.contents)
 
 class PathTable(object):
+    # layout of a path table record, before the directory name
+    RECORD_HEAD = struct.Struct('>BBIH')
+
     def __init__(self, sector, size):
         self.directories = []
         self.size = size
+        data = sector.data_view
         offset = 0
         while offset < self.size:
-            name_size  = number(sector.data[offset+0:offset+1])
-            attr_size  = number(sector.data[offset+1:offset+2])
-            dir_addr   = number(sector.data[offset+2:offset+6])
-            parent_dir = number(sector.data[offset+6:offset+8])
-            name       = string(sector.data[offset+8:offset+8+name_size])
+            name_size, attr_size, dir_addr, parent_dir = PathTable.RECORD_HEAD.unpack_from(data, offset)
+            name       = string(data[offset+8:offset+8+name_size])
 
-            self.directories.append(Directory(name, attr_size, sector.disc.block(dir_addr), parent_dir))
+            self.directories.append(Directory(name, attr_size, sector.disc, dir_addr, parent_dir, len(self.directories)+1))
             offset += 8+name_size + (name_size%2)   # last term is padding byte if name size is uneven
 
+        stats.count('directory objects', len(self.directories))
+
     def __getitem__(self, key):
         return self.directories[key]
 
     def __iter__(self):
         return iter(self.directories)
 
+class FileIndex(object):
+    """Index of the sectors that belong to each file on the disc.
+
+    Built once from the first_lbn and size of every File in the path table.
+    A file's sectors are those from its first block onwards that carry the
+    same subheader file number as its first block, up to its size in blocks
+    or the first end-of-file sector. Sectors of other files may be
+    interleaved in between. They are taken straight from the interleave
+    parameters of the file when the sector table bears them out, and found
+    by scanning the file numbers otherwise. Extents are kept sorted by first sector, so
+    finding the file that owns a sector takes a binary search."""
+
+    def __init__(self, disc, members=None):
+        "members optionally maps first_lbn to the sector indices of files already worked out, as loaded by DiscIndex"
+        self.disc = disc
+
+        files = {}
+        for directory in disc.path_tbl:
+            for f in directory:
+                if f.first_lbn not in files:
+                    files[f.first_lbn] = f
+
+        self.files   = [files[lbn] for lbn in sorted(files)]
+        if members is None:
+            members = {}
+        self.members = [members[f.first_lbn] if f.first_lbn in members else FileIndex.file_sectors(disc, f) for f in self.files]
+        self.positions = dict((f.first_lbn, i) for i, f in enumerate(self.files))
+        self.eors    = [m[disc.sectors.eor[m]] for m in self.members]
+
+        self.starts  = [disc.lbn2sector(f.first_lbn) for f in self.files]
+        ends         = [(m[-1]+1 if len(m) else start) for m, start in zip(self.members, self.starts)]
+
+        # running maximum of extent ends, to know when to stop looking back for overlapping extents
+        self.max_ends = np.maximum.accumulate(np.array(ends, dtype=np.int64)).tolist() if ends else []
+
+    @staticmethod
+    def file_sectors(disc, f):
+        "Sorted array of the indices of the sectors belonging to file f on disc, worked out from the sector table"
+        idx = FileIndex.interleaved_extent(disc, f)
+        if idx is not None:
+            return idx
+        if stats.enabled:
+            stats.count('extent scans')
+        return FileIndex.scanned_extent(disc, f)
+
+    @staticmethod
+    def interleaved_extent(disc, f):
+        """The sectors of file f as given by its interleave parameters, or None if the sector table does not bear them out.
+
+        They are only taken if they all carry the file number of the first,
+        number as many as the file's blocks or end with its end-of-file
+        sector, and no other sectors in between carry that number; the
+        result is then the same as that of scanned_extent."""
+        table = disc.sectors
+        start = disc.lbn2sector(f.first_lbn)
+        if not 0 <= start < len(table):
+            return np.zeros(0, dtype=np.int64)
+
+        number  = table.file_number[start]
+        nblocks = max(1, (f.size + 2047) // 2048)
+
+        idx = f.interleaved_sectors(disc)
+        eofs = np.flatnonzero(table.eof[idx])
+        if len(eofs) > 0:
+            idx = idx[:eofs[0]+1]
+        if len(idx) != nblocks and not (len(eofs) > 0 and len(idx) < nblocks):
+            return None
+        if not (table.file_number[idx] == number).all():
+            return None
+        if np.count_nonzero(table.file_number[start:idx[-1]+1] == number) != len(idx):
+            return None
+        return idx
+
+    @staticmethod
+    def scanned_extent(disc, f):
+        "The sectors of file f found by scanning the file numbers of the sector table from its first block"
+        table = disc.sectors
+        start = disc.lbn2sector(f.first_lbn)
+        if not 0 <= start < len(table):
+            return np.zeros(0, dtype=np.int64)
+
+        number  = table.file_number[start]
+        nblocks = max(1, (f.size + 2047) // 2048)
+
+        # look through ever larger windows until enough sectors are found
+        found  = []
+        count  = 0
+        pos    = start
+        window = nblocks
+        while pos < len(table) and count < nblocks:
+            end = min(len(table), pos+window)
+            idx = pos + np.flatnonzero(table.file_number[pos:end] == number)
+            idx = idx[:nblocks-count]
+
+            eofs = np.flatnonzero(table.eof[idx])
+            if len(eofs) > 0:
+                found.append(idx[:eofs[0]+1])
+                break
+
+            found.append(idx)
+            count  += len(idx)
+            pos     = end
+            window *= 2
+
+        return np.concatenate(found).astype(np.int64) if found else np.zeros(0, dtype=np.int64)
+
+    def members_of(self, f):
+        "Sorted array of the indices of the sectors belonging to file f"
+        return self.members[self.positions[f.first_lbn]]
+
+    def locate(self, sector):
+        """Find the file that owns the sector with the given index.
+
+        Returns a tuple (file, record, block) with the record number and the
+        index of the sector within the file, or None if no file owns it."""
+        i = bisect.bisect_right(self.starts, sector) - 1
+        while i >= 0 and self.max_ends[i] > sector:
+            members = self.members[i]
+            block = int(np.searchsorted(members, sector))
+            if block < len(members) and members[block] == sector:
+                record = int(np.searchsorted(self.eors[i], sector))
+                return self.files[i], record, block
+            i -= 1
+
+        return None
+
+class DiscIndex(object):
+    """Sidecar file that keeps the results of scanning a disc image.
+
+    Holds the sector table, the block offset, the positions of the disc
+    labels and the sectors of every file. It is keyed by the size, mtime and
+    fingerprint of the image, so an index for a changed image is detected
+    as stale and rebuilt. The file lives next to the image, or in cache_dir
+    under a name derived from the image's full path."""
+
+    VERSION = 3
+    SUFFIX  = '.cdi-index'
+
+    def __init__(self, image_filename, cache_dir=None):
+        if cache_dir is None:
+            self.filename = image_filename + DiscIndex.SUFFIX
+        else:
+            tag = hashlib.sha1(os.path.abspath(image_filename).encode('utf-8')).hexdigest()[:12]
+            self.filename = os.path.join(cache_dir, '%s-%s%s' % (os.path.basename(image_filename), tag, DiscIndex.SUFFIX))
+        self.image_filename = image_filename
+
+    def _key(self, disc):
+        "The properties of the image that the index is valid for"
+        st = os.stat(self.image_filename)
+        return {'version':     DiscIndex.VERSION,
+                'size':        st.st_size,
+                'mtime':       st.st_mtime,
+                'fingerprint': disc.fingerprint,
+                'headers':     bool(disc.headers)}
+
+    def load(self, disc):
+        "Fill in disc from the index. Returns False if there is no valid index for the image."
+        with stats.stage('index load'):
+            try:
+                with open(self.filename, 'rb') as f:
+                    arrays = np.load(f, allow_pickle=False)
+                    meta = json.loads(str(arrays['meta'][()]))
+                    key = self._key(disc)
+                    if any(meta.get(k) != v for k, v in key.items()):
+                        return False
+
+                    disc.sectors = SectorTable.from_columns(dict((name, arrays[name]) for name in SectorTable.COLUMNS))
+
+                    if meta['block_offset'] is not None:
+                        lengths = arrays['extent_lengths']
+                        members = np.split(arrays['extent_members'], np.cumsum(lengths)[:-1]) if len(lengths) else []
+                        disc._cached_extents = dict(zip(arrays['extent_lbns'].tolist(), members))
+
+            except (IOError, OSError, ValueError, KeyError, EOFError, BadZipFile):
+                return False    # no index, or a truncated or damaged one, which gets rebuilt
+
+            if meta['block_offset'] is not None:
+                disc.block_offset = meta['block_offset']
+                disc.disclabels = [DiscLabel(disc[idx]) for idx in meta['disclabels']]
+                disc._read_path_table()
+
+            return True
+
+    def save(self, disc):
+        "Write the index for disc, which must have its sector table and optionally disc labels read"
+        with stats.stage('index save'):
+            meta = self._key(disc)
+            meta['block_offset'] = disc.block_offset
+            arrays = dict((name, getattr(disc.sectors, name)) for name in SectorTable.COLUMNS)
+
+            if disc.block_offset is not None:
+                index = disc.file_index
+                meta['disclabels'] = [int(np.searchsorted(disc.sectors.offset, dl.sector.offset)) for dl in disc.disclabels]
+                arrays['extent_lbns']    = np.array([f.first_lbn for f in index.files], dtype=np.int64)
+                arrays['extent_lengths'] = np.array([len(m) for m in index.members], dtype=np.int64)
+                arrays['extent_members'] = np.concatenate(index.members) if index.members else np.zeros(0, dtype=np.int64)
+
+            directory = os.path.dirname(self.filename)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+
+            # write to a temporary file first, so a concurrent reader never sees half an index
+            tmp_filename = '%s.%d.tmp' % (self.filename, os.getpid())
+            with open(tmp_filename, 'wb') as f:
+                np.savez(f, meta=np.array(json.dumps(meta)), **arrays)
+            os.rename(tmp_filename, self.filename)
+
 class Disc(object):
     HEADER_LEN = 16
     FIRST_DISCLABEL_IDX = 16
 
+    # number and size of the chunks of the image that go into its fingerprint
+    FINGERPRINT_CHUNKS = 16
+    FINGERPRINT_CHUNK_SIZE = 4096
+
     def __init__(self, image_file, headers=False):
         "Create a disc image object from an image file. Does not immediately start processing it."
         self.image_file = mmap.mmap(image_file.fileno(), 0, access=mmap.ACCESS_READ)
-        self.sectors = []
+        self.buffer = np.frombuffer(self.image_file, dtype=np.uint8)   # read-only array over the whole image
+        self.sectors = None
         self.disclabels = []
         self.block_offset = None
         self.headers = headers
+        self._file_index = None
+        self._cached_extents = None
+        self._paths = None
+        self._fingerprint = None
+
+    def read(self, index=None):
+        """Read the basic info from the disc image.
+
+        If index is a DiscIndex, the results of an earlier run are loaded from
+        it when they are still valid for the image, and it is (re)written
+        otherwise."""
+        if index is not None and index.load(self) and self.block_offset is not None:
+            return
 
-    def read(self):
-        "Read the basic info from the disc image"
-        self.read_sectors()
+        if self.sectors is None:
+            self.read_sectors()
         self._find_disclabel()
 
-    def read_sectors(self):
-        offset = Disc.HEADER_LEN if self.headers else 0
-        while offset < self.image_file.size():
-            new_sector = Sector(self, offset)
-            offset += (Sector.FULL_SIZE+Disc.HEADER_LEN) if self.headers else Sector.FULL_SIZE
-            self.sectors.append(new_sector)
+        if index is not None:
+            index.save(self)
+
+    def read_sectors(self, index=None):
+        "Build the sector table for the whole image, or load it from a DiscIndex"
+        if index is not None and index.load(self):
+            return
+
+        self.sectors = SectorTable(self.image_file, self.headers)
+
+        if index is not None:
+            index.save(self)
+
+    @property
+    def fingerprint(self):
+        "A fast fingerprint of the image contents: a hash of its size and of evenly spaced chunks of it"
+        if self._fingerprint is None:
+            size = len(self.image_file)
+            last = max(0, size - Disc.FINGERPRINT_CHUNK_SIZE)
+            h = hashlib.sha1(str(size).encode('ascii'))
+            for i in range(Disc.FINGERPRINT_CHUNKS):
+                offset = last * i // (Disc.FINGERPRINT_CHUNKS-1)
+                h.update(self.image_file[offset:offset+Disc.FINGERPRINT_CHUNK_SIZE])
+            self._fingerprint = h.hexdigest()
+        return self._fingerprint
 
     def _find_disclabel(self):
-        for idx, sector in enumerate(self.sectors):
-            # all data sectors until terminator are disc labels
-            if sector.subheader.data:
-                dl = DiscLabel(sector)
+        with stats.stage('disc label'):
+            for idx in np.flatnonzero(self.sectors.data):
+                # all data sectors until terminator are disc labels
+                idx = int(idx)
+                dl = DiscLabel(self[idx])
                 if self.block_offset is None:
                     self.block_offset = idx - Disc.FIRST_DISCLABEL_IDX
 
@@ -254,14 +901,18 @@ class Disc(object):
                 else:
                     self.disclabels.append(dl)
 
-        else:
-            if len(self.disclabels) == 0:
-                raise RuntimeError("Never found disc label sector in disc image")
             else:
-                raise RuntimeError("Never found disc label terminator sector in disc image")
+                if len(self.disclabels) == 0:
+                    raise RuntimeError("Never found disc label sector in disc image")
+                else:
+                    raise RuntimeError("Never found disc label terminator sector in disc image")
 
+        self._read_path_table()
+
+    def _read_path_table(self):
         # find path table
-        self.path_tbl = PathTable(self.block(self.disclabels[0].path_tbl_addr), self.disclabels[0].path_tbl_size)
+        with stats.stage('path table'):
+            self.path_tbl = PathTable(self.block(self.disclabels[0].path_tbl_addr), self.disclabels[0].path_tbl_size)
 
     def lbn2sector(self, lbn):
         "Convert a Logical Block Number to a sector index"
@@ -275,5 +926,430 @@ class Disc(object):
         "Returns the specified block"
         return self[self.lbn2sector(lbn)]
 
+    @property
+    def file_index(self):
+        "The FileIndex for this disc, built on first use"
+        if self._file_index is None:
+            with stats.stage('file index'):
+                self._file_index = FileIndex(self, self._cached_extents)
+        return self._file_index
+
+    def locate(self, sector):
+        "Returns (file, record, block) for the file owning the sector with the given index, or None"
+        return self.file_index.locate(sector)
+
+    def file_sectors(self, file):
+        """Sorted array of the indices of the sectors belonging to file.
+
+        Taken from the file index or a loaded DiscIndex when there is one, and
+        worked out for this file alone otherwise, so that reading one file
+        does not need the whole directory tree."""
+        if self._file_index is not None:
+            return self._file_index.members_of(file)
+        if self._cached_extents is not None and file.first_lbn in self._cached_extents:
+            return self._cached_extents[file.first_lbn]
+        return FileIndex.file_sectors(self, file)
+
+    def spans(self, indices):
+        """Returns the full sectors with the given indices as a list of read-only memoryviews.
+
+        Sectors that directly follow each other in the image share a single
+        memoryview, so a run of adjacent sectors comes back as one buffer."""
+        offsets = self.sectors.offset[np.asarray(indices, dtype=np.int64)]
+        if len(offsets) == 0:
+            return []
+
+        breaks = (np.flatnonzero(np.diff(offsets) != Sector.FULL_SIZE) + 1).tolist()
+        starts = [0] + breaks
+        ends   = breaks + [len(offsets)]
+        return [memoryview(self.buffer[offsets[s]:offsets[e-1]+Sector.FULL_SIZE]) for s, e in zip(starts, ends)]
+
+    # runs of at least this many adjacent sectors are written straight from the image, shorter ones are gathered first
+    DIRECT_RUN = 64
+    GATHER_SECTORS = 1024
+
+    def write_sectors(self, out, indices):
+        """Write the full sectors with the given indices to the file object out. Returns the number of bytes written.
+
+        Long runs of adjacent sectors are written from the image in a single
+        call each. Scattered sectors, and sectors separated by CD headers,
+        are gathered into larger chunks first, so every write call is large."""
+        indices = np.asarray(indices, dtype=np.int64)
+        offsets = self.sectors.offset[indices]
+        if len(offsets) == 0:
+            return 0
+
+        breaks = np.flatnonzero(np.diff(offsets) != Sector.FULL_SIZE) + 1
+        starts = np.concatenate(([0], breaks)).tolist()
+        ends   = np.concatenate((breaks, [len(offsets)])).tolist()
+
+        written = 0
+        pending = []
+        def flush():
+            if pending:
+                chunk = np.concatenate(pending)
+                out.write(self.buffer[chunk[:, np.newaxis] + np.arange(Sector.FULL_SIZE)].tobytes())
+                stats.count('bytes copied', len(chunk)*Sector.FULL_SIZE)
+                del pending[:]
+
+        with stats.stage('output'):
+            pending_count = 0
+            for s, e in zip(starts, ends):
+                if e - s >= Disc.DIRECT_RUN:
+                    flush()
+                    pending_count = 0
+                    out.write(memoryview(self.buffer[offsets[s]:offsets[e-1]+Sector.FULL_SIZE]))
+                else:
+                    pending.append(offsets[s:e])
+                    pending_count += e - s
+                    if pending_count >= Disc.GATHER_SECTORS:
+                        flush()
+                        pending_count = 0
+                written += (e - s)*Sector.FULL_SIZE
+            flush()
+
+        stats.count('bytes written', written)
+        return written
+
+    def lookup(self, path):
+        """Returns the File with the given full path, like '/CDI/IMAGES/TITLE.RTF'.
+
+        The first call reads all directories to build a dictionary of paths;
+        after that every lookup is a single dictionary access. Raises
+        KeyError if there is no such file."""
+        if self._paths is None:
+            paths = {}
+            for directory in self.path_tbl:
+                for f in directory:
+                    if f.name not in Directory.SELF_NAMES:
+                        paths[directory.path + f.name] = f
+            self._paths = paths
+
+        return self._paths[path]
+
+    def payload(self, key, size=None):
+        """Returns the data parts of many sectors as a 2-D uint8 array, one sector per row.
+
+        key selects sectors by index: a slice or a sequence of indices. size is
+        the number of data bytes per sector, by default that of the first
+        selected sector. When the selected sectors are evenly spaced, which
+        includes any slice, the result is a strided read-only view on the
+        image that does not copy any data; otherwise the rows are gathered
+        into a new array."""
+        if isinstance(key, slice):
+            indices = np.arange(len(self))[key]
+        else:
+            indices = np.asarray(key, dtype=np.int64)
+
+        offsets = self.sectors.offset[indices] + Subheader.SIZE
+        if size is None:
+            size = 2324 if (len(indices) > 0 and self.sectors.form2[indices[0]]) else 2048
+
+        if len(offsets) > 0 and offsets.max() + size > len(self.buffer):
+            raise IndexError("sector data extends past end of image")
+
+        if len(offsets) == 0:
+            return np.zeros((0, size), dtype=np.uint8)
+
+        steps = np.diff(offsets)
+        if len(steps) == 0 or (steps[0] > 0 and (steps == steps[0]).all()):
+            stride = int(steps[0]) if len(steps) > 0 else size
+            return np.lib.stride_tricks.as_strided(self.buffer[offsets[0]:], shape=(len(offsets), size),
+                                                   strides=(stride, 1), writeable=False)
+        else:
+            stats.count('bytes copied', len(offsets)*size)
+            return self.buffer[offsets[:, np.newaxis] + np.arange(size)]
+
+    def __len__(self):
+        return len(self.sectors)
+
     def __getitem__(self, key):
-        return self.sectors[key]
+        if isinstance(key, slice):
+            return [self[idx] for idx in range(*key.indices(len(self)))]
+
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError("sector index out of range")
+
+        return Sector(self, int(self.sectors.offset[key]))
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+class SectorFilter(object):
+    """A filter on sectors, compiled from an expression to a mask over the whole sector table.
+
+    An expression is a list of terms that must all hold, and 'or' between
+    such lists. A term is a field with a list of values, or a flag:
+
+        file=VALUES  channel=VALUES  coding=VALUES  submode=VALUES
+        sector=VALUES  lbn=VALUES  form=1|2
+        type=TYPES  (any of audio, video, data, empty, or just a, v, d, e)
+        eor  eof  realtime  trigger
+
+    VALUES is a comma-separated list of numbers and ranges in the format of
+    range_mask, so 'channel=0-4' stands for channels 0 to 3. Numbers may be
+    given in hex as 0x... A term preceded by 'not' or '!' matches the
+    sectors that the term does not match. For example:
+
+        type=audio channel=1,3 or type=video form=2 !eor"""
+
+    BYTE_FIELDS = {'file': 'file_number', 'channel': 'channel_number', 'coding': 'coding_raw', 'submode': 'submode_raw'}
+    FLAGS = ('eor', 'eof', 'realtime', 'trigger')
+    TYPES = {'audio': 'audio', 'a': 'audio', 'video': 'video', 'v': 'video', 'data': 'data', 'd': 'data', 'empty': 'empty', 'e': 'empty'}
+
+    def __init__(self, expression):
+        "Parse expression. Raises ValueError if it is malformed."
+        self.expression = expression
+        self.alternatives = [[]]
+        negate = False
+        for token in expression.split():
+            if token == 'or':
+                if negate or not self.alternatives[-1]:
+                    raise ValueError("Missing term before 'or' in '%s'" % expression)
+                self.alternatives.append([])
+            elif token in ('not', '!'):
+                negate = not negate
+            else:
+                while token.startswith('!'):
+                    negate = not negate
+                    token = token[1:]
+                self.alternatives[-1].append((negate, self._parse_term(token)))
+                negate = False
+
+        if negate or not self.alternatives[-1]:
+            raise ValueError("Missing term at the end of '%s'" % expression)
+
+    def _parse_term(self, token):
+        "Returns a term as a pair (field, values)"
+        if '=' not in token:
+            if token not in SectorFilter.FLAGS:
+                raise ValueError("Unknown flag '%s'" % token)
+            return token, None
+
+        field, values = token.split('=', 1)
+        if field in SectorFilter.BYTE_FIELDS or field in ('sector', 'lbn'):
+            # check the list now, so that mistakes show before the disc is read
+            range_mask(self._decimal(values), 256)
+            return field, self._decimal(values)
+        elif field == 'form':
+            if values not in ('1', '2'):
+                raise ValueError("Invalid form '%s'" % values)
+            return field, int(values)
+        elif field == 'type':
+            types = values.lower().split(',')
+            for t in types:
+                if t not in SectorFilter.TYPES:
+                    raise ValueError("Unknown sector type '%s'" % t)
+            return field, [SectorFilter.TYPES[t] for t in types]
+        else:
+            raise ValueError("Unknown field '%s'" % field)
+
+    @staticmethod
+    def _decimal(values):
+        "A range list with hex numbers converted to decimal"
+        return '-'.join(','.join(str(int(n, 0)) if n.strip() else n for n in part.split(',')) for part in values.split('-'))
+
+    def _term_mask(self, disc, field, values):
+        table = disc.sectors
+        if values is None:
+            return getattr(table, field)
+        elif field in SectorFilter.BYTE_FIELDS:
+            return range_mask(values, 256)[getattr(table, SectorFilter.BYTE_FIELDS[field])]
+        elif field == 'sector':
+            return range_mask(values, len(table))
+        elif field == 'lbn':
+            if disc.block_offset is None:
+                raise ValueError("Block numbers are not known without the disc label")
+            mask = np.zeros(len(table), dtype=bool)
+            lbns = range_mask(values, max(0, len(table) - disc.block_offset))
+            start = max(0, disc.block_offset)
+            mask[start:start+len(lbns)] = lbns[start-disc.block_offset:]
+            return mask
+        elif field == 'form':
+            return table.form2 if values == 2 else table.form1
+        else:
+            mask = np.zeros(len(table), dtype=bool)
+            for t in values:
+                mask |= getattr(table, t)
+            return mask
+
+    def mask(self, disc):
+        "Boolean mask of the sectors of disc that match the filter"
+        result = np.zeros(len(disc.sectors), dtype=bool)
+        for terms in self.alternatives:
+            matches = np.ones(len(disc.sectors), dtype=bool)
+            for negate, (field, values) in terms:
+                term = self._term_mask(disc, field, values)
+                matches &= ~term if negate else term
+            result |= matches
+        return result
+
+    def indices(self, disc):
+        "Sorted array of the indices of the sectors of disc that match the filter"
+        return np.flatnonzero(self.mask(disc))
+
+def demux(disc, file):
+    """Generator walking the sectors of a file in one pass, yielding (file, record, channel, run) events.
+
+    run is an array of the indices of successive sectors of the file that
+    are in the same record and channel; a new event starts whenever the
+    channel changes or a record ends. Records are numbered by the
+    end-of-record sectors before them, as in FileIndex.locate. Sinks like
+    ChannelWriter take these events one at a time with write(event)."""
+    members = disc.file_sectors(file)
+    if len(members) == 0:
+        return
+
+    channels = disc.sectors.channel_number[members]
+    records  = np.concatenate(([0], np.cumsum(disc.sectors.eor[members][:-1], dtype=np.int64)))
+
+    breaks = np.flatnonzero((np.diff(channels) != 0) | (np.diff(records) != 0)) + 1
+    starts = np.concatenate(([0], breaks)).astype(np.int64)
+    stats.count('records', int(records[-1]) + 1)
+    stats.count('channel runs', len(starts))
+    for start, run in zip(starts.tolist(), np.split(members, breaks)):
+        yield file, int(records[start]), int(channels[start]), run
+
+class FileReader(io.RawIOBase):
+    """Seekable raw binary reader of the data parts of the sectors of a file, optionally of one record and/or channel.
+
+    Sector boundaries are invisible: the data of successive sectors reads as
+    one stream. A file of Form 1 sectors only reads as its size in the
+    directory; files with Form 2 sectors read as all their sectors' data, as
+    the size does not count the larger Form 2 data parts. When all sectors
+    have the same data size, which is the usual case, a byte offset maps to
+    its sector with a division. Reads copy the data of the sectors they
+    cover straight from the image into the caller's buffer."""
+
+    def __init__(self, disc, file, record=None, channel=None):
+        if disc is None:
+            raise ValueError("File %s is not on a disc" % file.name)
+        self.disc = disc
+        self.file = file
+        self.name = file.name
+
+        members = disc.file_sectors(file)
+        table = disc.sectors
+        if record is not None:
+            records = np.concatenate(([0], np.cumsum(table.eor[members][:-1], dtype=np.int64))) if len(members) else members
+            members = members[records == record]
+        if channel is not None:
+            members = members[table.channel_number[members] == channel]
+
+        self.offsets = table.offset[members] + Subheader.SIZE
+        self.sizes = np.where(table.form2[members], 2324, 2048)
+        self.starts = np.concatenate(([0], np.cumsum(self.sizes, dtype=np.int64)))
+        self.uniform = int(self.sizes[0]) if len(members) and (self.sizes == self.sizes[0]).all() else None
+
+        self.length = int(self.starts[-1])
+        if record is None and channel is None and not table.form2[members].any():
+            self.length = min(self.length, file.size)
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.length + offset
+        else:
+            raise ValueError("Invalid whence %r" % whence)
+        if position < 0:
+            raise ValueError("Negative seek position %d" % position)
+        self.position = position
+        return position
+
+    def _sector_at(self, position):
+        "Index into the file's sectors of the one holding byte position"
+        if self.uniform is not None:
+            return position // self.uniform
+        return int(np.searchsorted(self.starts, position, side='right')) - 1
+
+    def readinto(self, b):
+        start = self.position
+        stop = min(self.length, start + len(b))
+        if stop <= start:
+            return 0
+
+        # copy the data part of each sector covered straight into b
+        view = memoryview(b)
+        first, last = self._sector_at(start), self._sector_at(stop-1)
+        done = 0
+        skip = start - int(self.starts[first])
+        for o, n in zip(self.offsets[first:last+1].tolist(), self.sizes[first:last+1].tolist()):
+            n = min(n - skip, stop - start - done)
+            view[done:done+n] = self.disc.buffer[o+skip:o+skip+n]
+            done += n
+            skip = 0
+        stats.count('bytes copied', stop-start)
+
+        self.position = stop
+        return stop-start
+
+    def __len__(self):
+        return self.length
+
+class ChannelWriter(object):
+    """Sink for demux events that writes every record and channel of a file to an output file of its own.
+
+    filename(file, record, channel) gives the name of each output file, which
+    receives the full sectors. Sectors are collected per channel as indices
+    and written out with Disc.write_sectors when their record ends or more
+    than buffer_size bytes are pending, so each output file is opened once
+    and written in a few large chunks, even for interleaved channels whose
+    sectors are scattered over the image. written
+    lists (file, record, channel) for every output file completed, in the
+    order in which they were completed."""
+
+    BUFFER_SIZE = 1 << 22
+
+    def __init__(self, disc, filename, buffer_size=BUFFER_SIZE):
+        self.disc = disc
+        self.filename = filename
+        self.buffer_size = buffer_size
+        self.written = []
+        self._record = None     # (file, record) of the channels being buffered
+        self._pending = {}      # channel -> [index arrays, byte count, already opened]
+
+    def write(self, event):
+        file, record, channel, run = event
+        if self._record != (file, record):
+            self._end_record()
+            self._record = (file, record)
+
+        pending = self._pending.setdefault(channel, [[], 0, False])
+        pending[0].append(run)
+        pending[1] += len(run)*Sector.FULL_SIZE
+        if pending[1] > self.buffer_size:
+            self._flush(channel)
+
+    def _flush(self, channel):
+        runs, size, opened = self._pending[channel]
+        file, record = self._record
+        with open(self.filename(file, record, channel), 'ab' if opened else 'wb') as f:
+            self.disc.write_sectors(f, np.concatenate(runs) if runs else runs)
+        self._pending[channel] = [[], 0, True]
+
+    def _end_record(self):
+        for channel in list(self._pending):
+            self._flush(channel)
+            self.written.append(self._record + (channel,))
+        self._pending = {}
+
+    def close(self):
+        "Write out everything still buffered"
+        self._end_record()
+        self._record = None
@@ -0,0 +1,318 @@
+from cdi import *
+import wave
+import numpy as np
+
+# a lookup list for the index of each parameter byte in the sound group header
+PARAM_IDX = range(4,12)
+
+SOUND_GROUP_SIZE   = 128    # bytes per sound group
+SOUND_GROUPS       = 18     # sound groups per sector
+SOUND_UNIT_SAMPLES = 28     # samples per sound unit
+
+# predictor filter coefficients, indexed by filter setting
+FILTER_K0 = [0., 0.9375,  1.796875,  1.53125 ]
+FILTER_K1 = [0., 0.,     -0.8125,   -0.859375]
+
+class ADPCMDec:
+    "ADPCM decoder"
+
+    def __init__(self):
+        self.delayed1 = 0.     # two delay lines
+        self.delayed2 = 0.
+        self.G        = 0      # gain
+        self.K0       = 0.     # first order filter coefficient
+        self.K1       = 0.     # second order filter coefficient
+
+    def set_params(self, G, F):
+        # set range (exponential gain) value
+        self.G = int(G)
+
+        # set predictor filter
+        if not 0 <= F < len(FILTER_K0):
+            raise ValueError("Invalid filter setting %d" % F)
+
+        self.K0 = FILTER_K0[F]
+        self.K1 = FILTER_K1[F]
+
+    def reset(self):
+        self.delayed1 = 0.
+        self.delayed2 = 0.
+
+    def propagate(self, data):
+        output = data * 2.**self.G  +  self.delayed1 * self.K0  +  self.delayed2 * self.K1
+        output = max(-2**15, min(2**15-1, int(output)))
+        self.delayed2 = self.delayed1
+        self.delayed1 = output
+        return output
+
+    def propagate_units(self, units, K0, K1):
+        """Run the filter over a sequence of sound units.
+
+        units holds one list of already gain-scaled samples per unit, K0 and K1
+        the filter coefficients for each unit. Gives exactly the same output
+        as calling set_params and propagate for each sample, with the filter
+        state kept in locals. Returns a flat list of output samples."""
+        delayed1, delayed2 = self.delayed1, self.delayed2
+        out = []
+        append = out.append
+        for unit, k0, k1 in zip(units, K0, K1):
+            for scaled in unit:
+                output = int(scaled  +  delayed1 * k0  +  delayed2 * k1)
+                if   output >  2**15-1: output =  2**15-1
+                elif output < -2**15:   output = -2**15
+                delayed2 = delayed1
+                delayed1 = output
+                append(output)
+
+        self.delayed1, self.delayed2 = delayed1, delayed2
+        return out
+
+
+def sector_sound_groups(data):
+    "View a run of complete sectors (subheader included) as an array of sound groups, one per row"
+    sectors = byte_array(data).reshape(-1, Sector.FULL_SIZE)
+    groups  = sectors[:, Subheader.SIZE:Subheader.SIZE+SOUND_GROUPS*SOUND_GROUP_SIZE]
+    return groups.reshape(-1, SOUND_GROUP_SIZE)
+
+def _sign_extend_nibbles(v):
+    "Convert an array of 4-bit two's complement values to signed integers"
+    v = v.astype(np.int16)
+    return v - ((v & (1<<3)) << 1)
+
+def _unit_params(params, gain_base):
+    "Per-unit gain factor and filter coefficients from an array of parameter bytes"
+    ranges  = params & 0b00001111
+    filters = (params & 0b11110000) >> 4
+    if (filters >= len(FILTER_K0)).any():
+        raise ValueError("Invalid filter setting %d" % filters[filters >= len(FILTER_K0)][0])
+
+    gains = np.ldexp(1., gain_base - ranges.astype(np.int64))
+    return gains, np.take(FILTER_K0, filters), np.take(FILTER_K1, filters)
+
+def _propagate(decoder, samples, params, gain_base):
+    "Scale an array of sound units (one per row) and run them through decoder"
+    gains, K0, K1 = _unit_params(params.ravel(), gain_base)
+    units = samples.reshape(-1, SOUND_UNIT_SAMPLES) * gains[:,np.newaxis]
+    return np.array(decoder.propagate_units(units.tolist(), K0.tolist(), K1.tolist()), dtype=np.int16)
+
+def decode_sound_groups(groups, sample_width, stereo, decoders):
+    """Decode an array of sound groups (one per row, as from sector_sound_groups).
+
+    decoders is a list of ADPCMDec objects, one for mono and (left, right) for
+    stereo, which carry the filter state from call to call. Returns an int16
+    array of samples, interleaved left/right for stereo. The output is
+    bit-identical to feeding every sample through ADPCMDec.propagate."""
+    with stats.stage('audio decode'):
+        samples = _decode_sound_groups(groups, sample_width, stereo, decoders)
+    stats.count('samples decoded', len(samples))
+    return samples
+
+def _decode_sound_groups(groups, sample_width, stereo, decoders):
+    groups = np.asarray(groups, dtype=np.uint8).reshape(-1, SOUND_GROUP_SIZE)
+
+    # sample bytes, indexed as [group, unit column, sample]
+    data = groups[:, 16:].reshape(-1, SOUND_UNIT_SAMPLES, 4).transpose(0, 2, 1)
+
+    if sample_width == 8:
+        # level A audio
+        header = groups[:, 0:16].reshape(-1, 4, 4)
+        assert (header == header[:, 0:1, :]).all()
+
+        return _propagate(decoders[0], data, groups[:, 0:4], 8)
+
+    elif sample_width == 4:
+        # level B or C audio
+        assert (groups[:, 0:4] == groups[:, 4: 8]).all()
+        assert (groups[:, 8:12] == groups[:, 12:16]).all()
+
+        low  = _sign_extend_nibbles(data & 0b00001111)
+        high = _sign_extend_nibbles((data & 0b11110000) >> 4)
+        params = groups[:, PARAM_IDX[0]:PARAM_IDX[-1]+1].reshape(-1, 4, 2)
+
+        if stereo:
+            left  = _propagate(decoders[0], low,  params[:, :, 0], 12)
+            right = _propagate(decoders[1], high, params[:, :, 1], 12)
+            return np.column_stack((left, right)).ravel()
+
+        else:
+            # unit 2*i is in the low nibbles of column i, unit 2*i+1 in the high nibbles
+            samples = np.stack((low, high), axis=2)
+            return _propagate(decoders[0], samples, params, 12)
+
+    else:
+        raise ValueError("Invalid sample width %d" % sample_width)
+
+
+class AudioDecoder(object):
+    """Streaming decoder for a sequence of audio sectors that all have the same coding.
+
+    The ADPCM filter state is kept from one call to the next, so a track can
+    be decoded a sector or a record at a time in constant memory. The coding
+    is taken from the first sector decoded, unless it is given up front."""
+
+    def __init__(self, coding_raw=None):
+        self.coding_raw = None
+        if coding_raw is not None:
+            self._set_coding(coding_raw)
+
+    def _set_coding(self, coding_raw):
+        assert not (coding_raw & (1<<5)), "Reserved sample width specified in encoding"
+        assert not (coding_raw & (1<<3)), "Reserved sample rate specified in encoding"
+        assert not (coding_raw & (1<<1)), "Reserved channel number specified in encoding"
+
+        self.coding_raw   = coding_raw
+        self.sample_width = 8 if (coding_raw & (1<<4)) else 4
+        self.sample_rate  = 18900 if (coding_raw & (1<<2)) else 37800
+        self.stereo       = True if (coding_raw & (1<<0)) else False
+        self.decoders     = [ADPCMDec(), ADPCMDec()] if self.stereo else [ADPCMDec()]
+
+    channels = property(lambda self: 2 if self.stereo else 1, doc="The number of output channels")
+
+    def reset(self):
+        for decoder in self.decoders:
+            decoder.reset()
+
+    def decode(self, data):
+        "Decode a run of complete sectors (subheader included). Returns an int16 array of samples."
+        return decode_sound_groups(sector_sound_groups(data), self.sample_width, self.stereo, self.decoders)
+
+    def decode_sector(self, sector):
+        "Decode a single Sector. Returns an int16 array of samples."
+        sh = sector.subheader
+        if self.coding_raw is None:
+            self._set_coding(sh.coding_raw)
+        else:
+            assert self.coding_raw == sh.coding_raw, "Entire file must have same encoding"
+
+        return self.decode(sector.view)
+
+    def blocks(self, sectors, ignore_other=False):
+        "Generator that decodes Sectors one by one, yielding an int16 array of samples per sector"
+        for sector in sectors:
+            if not sector.subheader.audio:
+                if ignore_other:
+                    continue
+                else:
+                    raise RuntimeError("Found non-audio sector in file")
+
+            yield self.decode_sector(sector)
+
+    def records(self, sectors, ignore_other=False):
+        "Generator that decodes Sectors, yielding an int16 array of samples per record"
+        blocks = []
+        for sector in sectors:
+            blocks.extend(self.blocks([sector], ignore_other))
+
+            if sector.subheader.eor and blocks:
+                yield np.concatenate(blocks)
+                blocks = []
+
+        if blocks:
+            yield np.concatenate(blocks)
+
+
+def write_wav(filename, decoder, blocks):
+    """Write sample blocks to a WAV file as they are produced.
+
+    The file is only created once the first block arrives, at which point
+    decoder has seen the coding of the track. Returns the number of samples
+    written."""
+    outfile = None
+    num_samples = 0
+    try:
+        for block in blocks:
+            if outfile is None:
+                outfile = wave.open(filename, 'wb')
+                outfile.setnchannels(decoder.channels)
+                outfile.setsampwidth(2)
+                outfile.setframerate(decoder.sample_rate)
+
+            with stats.stage('output'):
+                outfile.writeframes(block.astype('<i2').tobytes())
+            stats.count('bytes written', 2*len(block))
+            num_samples += len(block)
+    finally:
+        if outfile is not None:
+            outfile.close()
+
+    return num_samples
+
+
+class WavWriter(object):
+    """Sink for demux events that decodes the audio of every record and channel of a file to a WAV file of its own.
+
+    filename(file, record, channel) gives the name of each output file. Every
+    record and channel has its own AudioDecoder and open WAV file, so the
+    sectors of an interleaved file are read and decoded in a single pass,
+    and the samples go straight to their outputs, however many channels
+    there are. Each record and channel starts with a fresh decoder, as when
+    they are dumped separately and decoded one by one. Non-audio sectors are
+    skipped, and no file is written for channels without audio. written lists
+    (file, record, channel, samples) for every output file completed, in the
+    order in which they were completed; samples counts sample frames, one
+    per left/right pair for stereo."""
+
+    def __init__(self, disc, filename):
+        self.disc = disc
+        self.filename = filename
+        self.written = []
+        self._record = None     # (file, record) of the open outputs
+        self._outputs = {}      # channel -> [decoder, WAV file, sample frames written]
+
+    def write(self, event):
+        file, record, channel, run = event
+        if self._record != (file, record):
+            self._end_record()
+            self._record = (file, record)
+
+        run = run[self.disc.sectors.audio[run]]
+        if len(run) == 0:
+            return
+
+        codings = self.disc.sectors.coding_raw[run]
+        output = self._outputs.get(channel)
+        if output is None:
+            decoder = AudioDecoder(int(codings[0]))
+            outfile = wave.open(self.filename(file, record, channel), 'wb')
+            outfile.setnchannels(decoder.channels)
+            outfile.setsampwidth(2)
+            outfile.setframerate(decoder.sample_rate)
+            output = self._outputs[channel] = [decoder, outfile, 0]
+
+        decoder, outfile, _ = output
+        assert (codings == decoder.coding_raw).all(), "Entire file must have same encoding"
+
+        for view in self.disc.spans(run):
+            block = decoder.decode(view)
+            with stats.stage('output'):
+                outfile.writeframes(block.astype('<i2').tobytes())
+            stats.count('bytes written', 2*len(block))
+            output[2] += len(block) // decoder.channels
+
+    def _end_record(self):
+        for channel in sorted(self._outputs):
+            _, outfile, samples = self._outputs[channel]
+            outfile.close()
+            self.written.append(self._record + (channel, samples))
+        self._outputs = {}
+
+    def close(self):
+        "Finish all open WAV files"
+        self._end_record()
+        self._record = None
+
+
+def record_wavs(disc, file, filename):
+    """Decode the audio of every record and channel of a file on disc to a WAV file of its own, in a single pass.
+
+    filename(file, record, channel) gives the name of each output file, see
+    WavWriter. Returns a list of (record, channel, samples) for the files
+    written, samples counting sample frames."""
+    writer = WavWriter(disc, filename)
+    try:
+        for event in demux(disc, file):
+            writer.write(event)
+    finally:
+        writer.close()
+
+    return [(record, channel, samples) for _, record, channel, samples in writer.written]
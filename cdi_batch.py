@@ -0,0 +1,148 @@
+from __future__ import print_function
+from cdi import *
+from cdi_audio import record_wavs
+from cdi_dump_files import dump_file
+from cdi_ls import list_disc
+import argparse
+import glob
+import io
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+
+MODES = ('ls', 'dump', 'audio')
+
+def find_images(patterns):
+    """Expand image arguments to a sorted list of image files.
+
+    Every argument may be a file, a glob pattern or a directory, which stands
+    for all files in it. Index files written by --cache are skipped."""
+    images = set()
+    for pattern in patterns:
+        for name in (glob.glob(pattern) or [pattern]):
+            if os.path.isdir(name):
+                names = [os.path.join(name, entry) for entry in os.listdir(name)]
+                images.update(n for n in names if os.path.isfile(n))
+            else:
+                images.add(name)
+
+    return sorted(name for name in images if not name.endswith(DiscIndex.SUFFIX))
+
+def image_output_dir(output_dir, image_file):
+    "The directory that the output for an image goes to: a subdirectory named after the image"
+    return os.path.join(output_dir, os.path.splitext(os.path.basename(image_file))[0])
+
+def process_image(task):
+    """Run one tool on one image. Returns a report dictionary for the image.
+
+    Any error is caught and reported, so one damaged image does not stop
+    the batch."""
+    image_file, mode, output_dir, headers, cache, cache_dir, with_stats = task
+    if with_stats and not stats.enabled:
+        stats.enable()
+    report = {'image': image_file, 'mode': mode, 'status': 'ok'}
+    start = time.time()
+    try:
+        with open(image_file, 'rb') as cdifile:
+            disc = Disc(cdifile, headers)
+            disc.read(DiscIndex(image_file, cache_dir) if cache or cache_dir else None)
+            report['sectors'] = len(disc)
+
+            if mode == 'ls':
+                out = io.StringIO() if str is not bytes else io.BytesIO()
+                list_disc(disc, out)
+                report['listing'] = out.getvalue()
+
+            else:
+                target = image_output_dir(output_dir, image_file)
+                outputs = 0
+                for directory in disc.path_tbl:
+                    path = directory.path
+                    for file in directory:
+                        if mode == 'dump':
+                            outputs += len(dump_file(disc, path, file, target))
+
+                        elif not file.attributes.directory:
+                            if not os.path.isdir(target + path):
+                                os.makedirs(target + path)
+                            filename = lambda file, record, channel: '%s%s%s.r%04dch%02d.wav' % (target, path, file.name, record, channel)
+                            outputs += len(record_wavs(disc, file, filename))
+
+                report['outputs'] = outputs
+
+    except Exception as e:
+        report['status'] = 'error'
+        report['error'] = '%s: %s' % (type(e).__name__, e)
+        report['traceback'] = traceback.format_exc()
+
+    report['seconds'] = round(time.time() - start, 3)
+    if stats.enabled:
+        report['stats'] = stats.take()
+    return report
+
+if __name__ == '__main__':
+    # parse command-line arguments
+    parser = argparse.ArgumentParser(description='Run a tool on many CD-I disc images in parallel')
+    parser.add_argument('mode', choices=MODES, help='ls: list contents, dump: extract all records and channels, audio: decode all audio to WAV files')
+    parser.add_argument('images', nargs='+', help='Image files, glob patterns or directories of images')
+    parser.add_argument('--output-dir', '-o', help='Directory to write to, with a subdirectory per image (required for dump and audio)')
+    parser.add_argument('--headers', '-H', action='store_true', help='Image files include CD headers')
+    parser.add_argument('--jobs', '-j', type=int, default=multiprocessing.cpu_count(), help='Number of images to process in parallel')
+    parser.add_argument('--report', metavar='FILE', help='Write a JSON report of every image to FILE')
+    parser.add_argument('--cache', action='store_true', help='Keep an index of each image next to it, so that later runs do not have to scan it')
+    parser.add_argument('--cache-dir', metavar='DIR', help='Keep the indices in DIR instead (implies --cache)')
+    parser.add_argument('--stats', action='store_true', help='Print a breakdown of where the time went, over all images, to stderr when done')
+    parser.add_argument('--stats-json', metavar='FILE', help='Write the time breakdown and counters over all images to FILE as JSON')
+
+    args = parser.parse_args()
+
+    if args.mode != 'ls' and args.output_dir is None:
+        parser.error("--output-dir is required for mode %s" % args.mode)
+
+    images = find_images(args.images)
+    tasks = [(image, args.mode, args.output_dir, args.headers, args.cache, args.cache_dir, bool(args.stats or args.stats_json)) for image in images]
+
+    start = time.time()
+    if args.jobs > 1 and len(tasks) > 1:
+        # at most jobs images are open at a time; one task per worker process keeps memory from building up
+        pool = multiprocessing.Pool(min(args.jobs, len(tasks)), maxtasksperchild=1)
+        results = pool.imap(process_image, tasks)
+    else:
+        pool = None
+        results = (process_image(task) for task in tasks)
+
+    # results come back in image order
+    reports = []
+    total_stats = Stats()
+    for report in results:
+        reports.append(report)
+        if 'stats' in report:
+            total_stats.merge(report['stats'])
+        if report['status'] == 'ok':
+            if 'listing' in report:
+                print("%s:" % report['image'])
+                sys.stdout.write(report.pop('listing'))
+            print("%-40s ok     %8.3fs" % (report['image'], report['seconds']), file=sys.stderr)
+        else:
+            print("%-40s FAILED %8.3fs  %s" % (report['image'], report['seconds'], report['error']), file=sys.stderr)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    failed = [report for report in reports if report['status'] != 'ok']
+    print("%d images, %d ok, %d failed in %.3fs" % (len(reports), len(reports)-len(failed), len(failed), time.time()-start), file=sys.stderr)
+
+    if args.stats:
+        total_stats.report(sys.stderr)
+    if args.stats_json:
+        total_stats.write_json(args.stats_json)
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump({'mode': args.mode, 'images': reports, 'failed': len(failed), 'seconds': round(time.time()-start, 3)}, f, indent=2)
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,250 @@
+from __future__ import print_function
+from cdi import *
+from cdi_audio import AudioDecoder
+from cdi_ls import list_disc
+from cdi_synth import VIDEO_CLUT7, VIDEO_DYUV, write_image
+from cdi_verify import verify_range
+from cdi_video import clut7_frames, dyuv_frames
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None      # Python 2: no peak memory figures
+
+MB = 1024*1024
+
+# minimum time of a timed run of a benchmark, in seconds
+MIN_TIME = 0.2
+
+class NullWriter(object):
+    "File-like object that throws away everything written to it"
+    def write(self, data):
+        pass
+
+def read_disc(image_file, headers):
+    "Open and fully read a disc image"
+    disc = Disc(open(image_file, 'rb'), headers)
+    disc.read()
+    return disc
+
+def all_files(disc):
+    for directory in disc.path_tbl:
+        for f in directory:
+            if not f.attributes.directory:
+                yield f
+
+def file_runs(disc, mask):
+    "Per file and channel, the indices of its sectors that are in mask"
+    for f in all_files(disc):
+        channels = {}
+        for _, _, channel, run in demux(disc, f):
+            run = run[mask[run]]
+            if len(run) > 0:
+                channels.setdefault(channel, []).append(run)
+
+        for channel in sorted(channels):
+            yield np.concatenate(channels[channel])
+
+# Each benchmark is a pair of functions: setup(image_file, headers) returns the state that
+# run(state) works on, and run returns the number of sectors it processed. Only run is timed.
+
+def bench_scan(image_file, headers):
+    "Disc.read_sectors: build the sector table"
+    def run(state):
+        disc = Disc(open(image_file, 'rb'), headers)
+        disc.read_sectors()
+        return len(disc)
+    return None, run
+
+def bench_read(image_file, headers):
+    "Disc.read: sector table, disc label and path table"
+    def run(state):
+        return len(read_disc(image_file, headers))
+    return None, run
+
+def bench_directories(image_file, headers):
+    "Directory parsing of the whole tree and building the file index"
+    def run(disc):
+        disc._read_path_table()
+        disc._file_index = None
+        for directory in disc.path_tbl:
+            len(directory)
+        disc.file_index
+        return len(disc)
+    return read_disc(image_file, headers), run
+
+def bench_ls(image_file, headers):
+    "cdi_ls.list_disc on a disc that has been read"
+    def run(disc):
+        disc._read_path_table()
+        disc._file_index = None
+        list_disc(disc, NullWriter())
+        return len(disc)
+    return read_disc(image_file, headers), run
+
+def bench_sectors(image_file, headers):
+    "cdi_sectors.py run as a separate process, including interpreter startup"
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cdi_sectors.py')
+    command = [sys.executable, script, image_file] + (['--headers'] if headers else [])
+    def run(sectors):
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(command, stdout=devnull)
+        return sectors
+    return len(read_disc(image_file, headers)), run
+
+def bench_audio(image_file, headers):
+    "ADPCM decoding of all audio sectors"
+    disc = read_disc(image_file, headers)
+    runs = list(file_runs(disc, disc.sectors.audio))
+    def run(state):
+        count = 0
+        for indices in runs:
+            decoder = AudioDecoder()
+            for block in decoder.blocks(disc[int(idx)] for idx in indices):
+                count += 1
+        return count
+    return None, run
+
+def _bench_video(coding, frames):
+    def bench(image_file, headers):
+        disc = read_disc(image_file, headers)
+        runs = list(file_runs(disc, disc.sectors.video & (disc.sectors.coding_raw == coding)))
+        def run(state):
+            for indices in runs:
+                for frame in frames(disc[int(idx)] for idx in indices):
+                    pass
+            return sum(len(indices) for indices in runs)
+        return None, run
+    return bench
+
+bench_dyuv  = _bench_video(VIDEO_DYUV, dyuv_frames)
+bench_dyuv.__doc__ = "DYUV decoding of all DYUV video sectors"
+bench_clut7 = _bench_video(VIDEO_CLUT7, clut7_frames)
+bench_clut7.__doc__ = "CLUT7 decoding of all CLUT7 video sectors"
+
+def bench_verify(image_file, headers):
+    "cdi_verify.verify_range: EDC, ECC and subheader checks of all sectors in one process"
+    def run(disc):
+        verify_range(disc.buffer, headers, 0, len(disc))
+        return len(disc)
+    return read_disc(image_file, headers), run
+
+BENCHMARKS = [('scan', bench_scan), ('read', bench_read), ('directories', bench_directories), ('ls', bench_ls),
+              ('sectors', bench_sectors), ('audio', bench_audio), ('dyuv', bench_dyuv), ('clut7', bench_clut7),
+              ('verify', bench_verify)]
+
+def measure(bench, image_file, headers, repeat, memory=True):
+    """Time a benchmark, best of repeat runs.
+
+    Every run calls the benchmark as often as needed to take at least
+    MIN_TIME seconds, so that short benchmarks can be timed reliably.
+    Returns a dictionary with the time per call, throughput in sectors/s and
+    MB/s, and the peak memory allocated during a call in MB. Tracing
+    allocations slows Python code down a lot, so the peak memory is taken
+    from a separate, untimed call; it is None if memory is False or it
+    cannot be measured."""
+    state, run = bench(image_file, headers)
+    best = None
+    for _ in range(repeat):
+        calls = 0
+        start = time.time()
+        while True:
+            sectors = run(state)
+            calls += 1
+            elapsed = time.time() - start
+            if elapsed >= MIN_TIME:
+                break
+        best = elapsed / calls if best is None else min(best, elapsed / calls)
+
+    peak = None
+    if memory and tracemalloc is not None:
+        tracemalloc.start()
+        run(state)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    best = max(best, 1e-9)
+    return {'seconds':       round(best, 6),
+            'sectors':       sectors,
+            'sectors_per_s': round(sectors / best, 1),
+            'mb_per_s':      round(sectors*Sector.FULL_SIZE / best / MB, 2),
+            'peak_mb':       None if peak is None else round(float(peak) / MB, 2)}
+
+if __name__ == '__main__':
+    # parse command-line arguments
+    parser = argparse.ArgumentParser(description='Time the main code paths of the CD-I tools')
+    parser.add_argument('--image', help='Image file to run on (default: a synthetic image written to a temporary directory)')
+    parser.add_argument('--headers', '-H', action='store_true', help='Image file includes CD headers')
+    parser.add_argument('--size', '-s', type=float, default=20., help='Size of the synthetic image in MB (default: 20)')
+    parser.add_argument('--only', help='Comma-separated list of benchmarks to run, out of: %s' % ', '.join(name for name, _ in BENCHMARKS))
+    parser.add_argument('--repeat', '-r', type=int, default=3, help='Number of runs of each benchmark, the best one counts (default: 3)')
+    parser.add_argument('--no-memory', action='store_true', help='Skip measuring peak memory, which takes an extra, slow run of each benchmark')
+    parser.add_argument('--baseline', metavar='FILE', help='Compare against the results stored in FILE')
+    parser.add_argument('--save-baseline', metavar='FILE', help='Store the results in FILE')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Fraction of throughput that may be lost before a benchmark counts as a regression (default: 0.2)')
+
+    args = parser.parse_args()
+
+    benchmarks = BENCHMARKS
+    if args.only:
+        names = args.only.split(',')
+        unknown = set(names) - set(name for name, _ in BENCHMARKS)
+        if unknown:
+            parser.error("Unknown benchmark(s): %s" % ', '.join(sorted(unknown)))
+        benchmarks = [(name, bench) for name, bench in BENCHMARKS if name in names]
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+    tmpdir = None
+    image_file, headers = args.image, args.headers
+    if image_file is None:
+        tmpdir = tempfile.mkdtemp(prefix='cdi_bench')
+        image_file = os.path.join(tmpdir, 'synth.bin')
+        print("Writing %.1f MB synthetic image..." % args.size, file=sys.stderr)
+        with open(image_file, 'wb') as out:
+            write_image(out, int(args.size*MB / Sector.FULL_SIZE), headers=headers)
+
+    try:
+        results = {}
+        regressions = []
+        print("%-12s %10s %12s %9s %9s %9s" % ('benchmark', 'seconds', 'sectors/s', 'MB/s', 'peak MB', 'baseline'))
+        for name, bench in benchmarks:
+            result = measure(bench, image_file, headers, args.repeat, not args.no_memory)
+            results[name] = result
+
+            compared = ''
+            if baseline is not None and name in baseline:
+                ratio = result['sectors_per_s'] / baseline[name]['sectors_per_s']
+                compared = '%8.2fx' % ratio
+                if ratio < 1. - args.tolerance:
+                    compared += ' REGRESSION'
+                    regressions.append(name)
+
+            print("%-12s %10.4f %12.0f %9.2f %9s %9s" % (name, result['seconds'], result['sectors_per_s'], result['mb_per_s'],
+                                                        '-' if result['peak_mb'] is None else '%.2f' % result['peak_mb'], compared))
+
+        if args.save_baseline:
+            image = {'size': os.path.getsize(image_file), 'synthetic': args.image is None, 'headers': headers}
+            with open(args.save_baseline, 'w') as f:
+                json.dump({'image': image, 'python': sys.version.split()[0], 'results': results}, f, indent=2, sort_keys=True)
+
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+
+    if regressions:
+        print("Regressions in: %s" % ', '.join(regressions), file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,238 @@
+from cdi import *
+from cdi_audio import AudioDecoder
+from cdi_video import WIDTH, HEIGHT, DYUV_INITIAL, CLUT_DECODERS, dyuv_frames, greyscale_clut, payload_frames
+import collections
+import hashlib
+import json
+import os
+import numpy as np
+
+class DecodedCache(object):
+    """Size-bounded LRU cache of decoded audio and video, for tools that decode the same records again and again.
+
+    Entries are numpy arrays under keys made by DecodedCache.key, which start
+    with the fingerprint of the disc image, so entries of a changed image are
+    never found. At most max_bytes of arrays are kept in memory, and the least
+    recently used entries are evicted to make room for new ones. With
+    cache_dir, entries are also written to .npy files there, which are looked
+    at on a miss in memory; max_disk_bytes bounds the size of those in the
+    same way. Arrays handed out are read-only, as they are shared.
+
+    hits, disk_hits, misses, evictions and disk_evictions count the lookups
+    and removals, for sizing the cache; they also go to the global
+    statistics as 'cache ...' counters."""
+
+    MAX_BYTES = 256 << 20
+    SUFFIX    = '.npy'
+
+    def __init__(self, max_bytes=MAX_BYTES, cache_dir=None, max_disk_bytes=None):
+        self.max_bytes      = max_bytes
+        self.cache_dir      = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.size           = 0     # bytes of the arrays in memory
+        self.hits = self.disk_hits = self.misses = self.evictions = self.disk_evictions = 0
+        self._entries = collections.OrderedDict()   # key -> array, least recently used first
+
+        self._disk = {}     # file name -> size, of the entries on disk
+        if cache_dir is not None:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            for name in os.listdir(cache_dir):
+                if name.endswith(DecodedCache.SUFFIX):
+                    self._disk[name] = os.path.getsize(os.path.join(cache_dir, name))
+
+    @staticmethod
+    def key(disc, file, record, channel, kind, *params):
+        "The key of the decoded contents of a record and channel of a file, with a kind of decoding and its parameters"
+        return (disc.fingerprint, file.first_lbn, record, channel, kind) + tuple(params)
+
+    def get(self, key):
+        "Returns the array stored under key, or None"
+        value = self._entries.pop(key, None)
+        if value is not None:
+            self._entries[key] = value
+            self.hits += 1
+            stats.count('cache hits')
+            return value
+
+        value = self._load(key)
+        if value is not None:
+            self.disk_hits += 1
+            stats.count('cache disk hits')
+            self._remember(key, value)
+            return value
+
+        self.misses += 1
+        stats.count('cache misses')
+        return None
+
+    def put(self, key, value):
+        "Store an array under key. Returns the read-only array as stored."
+        value = np.array(value)
+        value.flags.writeable = False
+        self._remember(key, value)
+        self._save(key, value)
+        return value
+
+    def decoded(self, key, decode):
+        "Returns the array stored under key, calling decode() for it and storing the result on a miss"
+        value = self.get(key)
+        if value is None:
+            value = self.put(key, decode())
+        return value
+
+    def counters(self):
+        "The counters and sizes of the cache as a dictionary"
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses, 'evictions': self.evictions, 'disk_evictions': self.disk_evictions,
+                'entries': len(self._entries), 'bytes': self.size, 'disk_entries': len(self._disk), 'disk_bytes': sum(self._disk.values())}
+
+    def clear(self):
+        "Drop all entries in memory; the ones on disk stay"
+        self._entries.clear()
+        self.size = 0
+
+    def _remember(self, key, value):
+        if key in self._entries:
+            self.size -= self._entries.pop(key).nbytes
+        if value.nbytes > self.max_bytes:
+            return
+
+        while self._entries and self.size + value.nbytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= evicted.nbytes
+            self.evictions += 1
+            stats.count('cache evictions')
+
+        self._entries[key] = value
+        self.size += value.nbytes
+
+    def _disk_name(self, key):
+        return hashlib.sha1(json.dumps(list(key)).encode('utf-8')).hexdigest() + DecodedCache.SUFFIX
+
+    def _load(self, key):
+        if self.cache_dir is None:
+            return None
+        name = self._disk_name(key)
+        if name not in self._disk:
+            return None
+
+        filename = os.path.join(self.cache_dir, name)
+        try:
+            value = np.load(filename)
+            os.utime(filename, None)    # the modification time orders the files by use
+        except (IOError, OSError, ValueError, EOFError):
+            # gone, or left empty or half written by a process that was killed
+            del self._disk[name]
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            return None
+
+        value.flags.writeable = False
+        return value
+
+    def _save(self, key, value):
+        if self.cache_dir is None or (self.max_disk_bytes is not None and value.nbytes > self.max_disk_bytes):
+            return
+        name = self._disk_name(key)
+        filename = os.path.join(self.cache_dir, name)
+
+        # write to a temporary file first, so a concurrent reader never sees half an entry
+        tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+        with stats.stage('output'):
+            with open(tmp_filename, 'wb') as f:
+                np.save(f, value)
+            os.rename(tmp_filename, filename)
+        self._disk[name] = os.path.getsize(filename)
+        self._trim_disk()
+
+    def _trim_disk(self):
+        "Remove the least recently used files until the entries on disk fit in max_disk_bytes"
+        if self.max_disk_bytes is None:
+            return
+        total = sum(self._disk.values())
+        if total <= self.max_disk_bytes:
+            return
+
+        def mtime(name):
+            try:
+                return os.path.getmtime(os.path.join(self.cache_dir, name))
+            except OSError:
+                return 0
+        for name in sorted(self._disk, key=mtime):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+            total -= self._disk.pop(name)
+            self.disk_evictions += 1
+            stats.count('cache disk evictions')
+
+def channel_sectors(disc, file, record, channel):
+    "Sorted array of the indices of the sectors of a file that are in the given record and channel"
+    runs = []
+    for _, r, c, run in demux(disc, file):
+        if r > record:
+            break
+        if r == record and c == channel:
+            runs.append(run)
+    return np.concatenate(runs) if runs else np.zeros(0, dtype=np.int64)
+
+def record_audio(disc, file, record, channel, cache=None):
+    """The decoded audio of a record and channel of a file, as an int16 array of samples, interleaved left/right for stereo.
+
+    Looked up in cache first, if given. Returns the array and the AudioDecoder
+    that describes the samples, or None for it if there is no audio."""
+    indices = channel_sectors(disc, file, record, channel)
+    indices = indices[disc.sectors.audio[indices]]
+    if len(indices) == 0:
+        return np.zeros(0, dtype=np.int16), None
+
+    codings = disc.sectors.coding_raw[indices]
+    assert (codings == codings[0]).all(), "Entire file must have same encoding"
+    decoder = AudioDecoder(int(codings[0]))
+
+    def decode():
+        return np.concatenate([decoder.decode(view) for view in disc.spans(indices)])
+    if cache is None:
+        return decode(), decoder
+    return cache.decoded(DecodedCache.key(disc, file, record, channel, 'audio', decoder.coding_raw), decode), decoder
+
+def record_frames(disc, file, record, channel, coding='dyuv', cache=None, width=WIDTH, height=HEIGHT, initial=DYUV_INITIAL, clut=None):
+    """The decoded video frames of a record and channel of a file, as a (frames, height, width, 3) uint8 array of RGB pixels.
+
+    coding is 'dyuv' or one of the colour lookup table codings of
+    CLUT_DECODERS, such as 'clut7' or 'rl7'; initial only applies to DYUV and
+    clut to the others, greyscale if None. Looked up in cache first, if
+    given."""
+    if coding != 'dyuv' and coding not in CLUT_DECODERS:
+        raise ValueError("Unknown video coding '%s'" % coding)
+    if coding != 'dyuv' and clut is None:
+        clut = greyscale_clut(CLUT_DECODERS[coding][2])
+
+    indices = channel_sectors(disc, file, record, channel)
+    indices = indices[disc.sectors.video[indices]]
+
+    def decode():
+        if coding in ('rl3', 'rl7') or not disc.sectors.form2[indices].all():
+            # run-length frames go by record; Form 1 video has data parts of another size
+            sectors = (disc[int(idx)] for idx in indices)
+            if coding == 'dyuv':
+                frames = list(dyuv_frames(sectors, width, height, initial))
+            else:
+                frames = list(CLUT_DECODERS[coding][0](sectors, clut, width, height))
+        else:
+            # the data parts straight from the image
+            frames = list(payload_frames(disc.payload(indices), coding, clut, width, height, initial))
+        return np.array(frames, dtype=np.uint8).reshape(len(frames), height, width, 3)
+
+    if cache is None:
+        return decode()
+    if coding == 'dyuv':
+        params = (width, height) + tuple(int(v) for v in initial)
+    else:
+        params = (width, height, hashlib.sha1(np.ascontiguousarray(clut, dtype=np.uint8).tobytes()).hexdigest())
+    return cache.decoded(DecodedCache.key(disc, file, record, channel, coding, *params), decode)
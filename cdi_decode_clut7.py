@@ -1,89 +1,57 @@
+from __future__ import print_function
 from cdi import *
+from cdi_video import *
 import argparse
+import sys
 
 # parse command-line arguments
-parser = argparse.ArgumentParser(description='Decode CLUT7 image data from an extracted CD-I video track')
+parser = argparse.ArgumentParser(description='Decode CLUT7 (or CLUT4, CLUT8, RL3, RL7) image data from an extracted CD-I video track')
 parser.add_argument('input_file',   help='Track file to decode')
 parser.add_argument('--offset',     help='Offset into the file that the image starts at', type=int, default=0)
 parser.add_argument('-i', '--ignore-other', help='Ignore non-video data in file', action="store_true")
-parser.add_argument('--clut', '-l', help='Colour lookup table file', type=str, default=None)
+parser.add_argument('--clut', '-l', help='Colour lookup table file (default: greyscale)', type=str, default=None)
+parser.add_argument('--coding', '-c', choices=sorted(CLUT_DECODERS), default='clut7', help='Video coding of the image data (default: clut7)')
+parser.add_argument('--width',      help='Image width in pixels', type=int, default=WIDTH)
+parser.add_argument('--height',     help='Image height in pixels', type=int, default=HEIGHT)
 parser.add_argument('output_base',  help='Output file name base')
+parser.add_argument('--format', '-F', choices=('pnm',) + FrameStream.FORMATS, default='pnm',
+                    help='Write a PNM file per frame (default), or a single YUV4MPEG2 or raw RGB24 stream to OUTPUT_BASE, - for standard output')
+parser.add_argument('--rate', type=parse_rate, default='25', help='Frame rate of a stream, as N or N:D frames per second (default: %(default)s)')
+parser.add_argument('--queue', type=int, default=FRAME_QUEUE, help='Number of decoded frames that may wait to be written (default: %(default)d)')
+parser.add_argument('--stats', action='store_true', help='Print a breakdown of where the time went to stderr when done')
+parser.add_argument('--stats-json', metavar='FILE', help='Write the time breakdown and counters to FILE as JSON')
 
 args = parser.parse_args()
 
+if args.stats or args.stats_json:
+    stats.enable()
+
 # initialize
 infile  = open(args.input_file, 'rb')   # input file
 indisc  = Disc(infile)                  # input Disc object (not a full disc image)
 
-WIDTH = 384
-HEIGHT = 240
-
-def open_pnm(file_index):
-    global args, WIDTH, HEIGHT
-    f = open("%s%04d.pnm"%(args.output_base, file_index), 'w')
-    f.write("P3\n")
-    f.write("%d %d\n" % (WIDTH, HEIGHT))
-    f.write("255\n")
-    return f
-
 # open CLUT
+decode_frames, coding, entries = CLUT_DECODERS[args.coding]
 if args.clut is None:
-    clut = ["%d %d %d" % () for i in range(128)]
+    clut = greyscale_clut(entries)
 else:
-    clut = []
-    with open(args.clut) as cf:
-        for l in cf.readlines():
-            v = l.strip().split()
-            col = " ".join((str(int(comp, 16)) for comp in v[1:]))
-            clut.append(col)
-
-file_index = 0
-outfile = None
-
-y = 0
-x = 0
-
-num_pixels = 0
-offset = args.offset
-while offset < indisc.image_file.size():
-    sector = Sector(indisc, offset)
-
-    sh = sector.subheader
-    if args.ignore_other:
-        if (not sh.video) or sh.coding_raw != 0b00000001:
-            offset += sector.FULL_SIZE
-            continue
-    else:
-        assert sh.video, "Found non-video sector in file"
+    clut = load_clut(args.clut, entries)
 
-    i = 0
-    while i < sector.data_size:
-        if outfile is None:
-            print "%s%04d.pnm:"%(args.output_base, file_index),
-            outfile = open_pnm(file_index)
-            num_pixels = 0
-
-        b = ord(sector.data[i])
-
-        num_pixels += 1
-        outfile.write(clut[b] + " ")
-
-        x += 1
-        i += 1
-        if x >= WIDTH:
-            outfile.write("\n")
-            x  = 0
-            y += 1
-            if y >= HEIGHT:
-                y = 0
-                file_index += 1
-                print "%d pixels written." % num_pixels
-                outfile.close()
-                outfile = None
-
-    offset += sector.FULL_SIZE
-
-if not (outfile is None):
-    print "%d pixels written." % num_pixels
-    outfile.close()
+sectors = (Sector(indisc, offset) for offset in range(args.offset, indisc.image_file.size(), Sector.FULL_SIZE))
+frames  = frame_pipeline(sectors, lambda sectors: decode_frames(sectors, clut, args.width, args.height, args.ignore_other, coding if args.ignore_other else None), args.queue)
 
+if args.format == 'pnm':
+    for file_index, frame in enumerate(frames):
+        print("%s%04d.pnm:"%(args.output_base, file_index), end=' ')
+        write_pnm("%s%04d.pnm"%(args.output_base, file_index), frame)
+        print("%d pixels written." % (args.width*args.height))
+else:
+    count = stream_frames(frames, args.output_base, args.format, args.width, args.height, args.rate)
+    if count is None:
+        sys.exit(1)     # the reader went away, which it already knows
+    print("%d frames written." % count, file=sys.stderr)
+
+if args.stats:
+    stats.report(sys.stderr)
+if args.stats_json:
+    stats.write_json(args.stats_json)
@@ -1,54 +1,94 @@
+from __future__ import print_function
 from cdi import *
 import argparse
+import multiprocessing
+import os
 import sys
 
-# parse command-line arguments
-parser = argparse.ArgumentParser(description='Dumps all directories, files, records and channels from a CD-I disc image')
-parser.add_argument('image_file',  help='Image file to dump')
-parser.add_argument('output_dir',  help='Directory to write to')
-parser.add_argument('--headers', '-H', action='store_true', help='Image file includes CD headers')
-
-args = parser.parse_args()
-
-with open(args.image_file, 'rb') as cdifile:
-    disc = Disc(cdifile, args.headers)
-    disc.read()
-
-    for directory in disc.path_tbl:
-        # print path name
-        path = '/'
-        d = directory
-        while d.parent != 1:
-            path = '/' + d.name + path
-            d = disc.path_tbl[d.parent]
-
-        for file in directory:
-            if not file.attributes.directory:
-                lbn  = file.first_lbn
-                byte = 0
-                channels = {}
-                record_num = 0
-                while True:
-                    block = disc.block(lbn)
-                    sh = block.subheader
-                    if not sh.channel_number in channels:
-                        channels[sh.channel_number] = open('%s%s%s.r%04dch%02d' % (args.output_dir, path, file.name, record_num, sh.channel_number), 'wb')
-
-                    channels[sh.channel_number].write(block[:])
-
-                    byte += block.data_size
-                    lbn  += 1
-
-                    if block.subheader.eor or block.subheader.eof:
-                        print "%-20s record %4d channel %2d" % (path+file.name, record_num, sh.channel_number)
-
-                        channels[sh.channel_number].close()
-                        del channels[sh.channel_number]
-                        record_num += 1
-
-                    if block.subheader.eof:
-                        for v in channels.keys():
-                            channels[v].close()
-                            del channels[v]
-                        break
-            print
+def dump_file(disc, path, file, output_dir):
+    "Write all records and channels of a file to separate files. Returns the log lines."
+    log = []
+    if not file.attributes.directory:
+        try:
+            os.makedirs(output_dir + path)
+        except OSError:
+            if not os.path.isdir(output_dir + path):
+                raise
+
+        filename = lambda file, record, channel: '%s%s%s.r%04dch%02d' % (output_dir, path, file.name, record, channel)
+        writer = ChannelWriter(disc, filename)
+        for event in demux(disc, file):
+            writer.write(event)
+        writer.close()
+
+        for _, record, channel in writer.written:
+            log.append("%-20s record %4d channel %2d" % (path+file.name, record, channel))
+    return log
+
+# per-process disc for worker processes, each with its own read-only mmap of the image
+_worker_disc = None
+
+def _init_worker(image_file, headers, block_offset, index, with_stats):
+    global _worker_disc
+    if with_stats:
+        stats.enable()
+    _worker_disc = Disc(open(image_file, 'rb'), headers)
+    _worker_disc.read_sectors(index)
+    _worker_disc.block_offset = block_offset
+
+def _dump_task(task):
+    "Dump one file in a worker process. Returns the log lines and the statistics of this task, if enabled."
+    path, file, output_dir = task
+    log = dump_file(_worker_disc, path, file, output_dir)
+    return log, (stats.take() if stats.enabled else None)
+
+if __name__ == '__main__':
+    # parse command-line arguments
+    parser = argparse.ArgumentParser(description='Dumps all directories, files, records and channels from a CD-I disc image')
+    parser.add_argument('image_file',  help='Image file to dump')
+    parser.add_argument('output_dir',  help='Directory to write to')
+    parser.add_argument('--headers', '-H', action='store_true', help='Image file includes CD headers')
+    parser.add_argument('--jobs', '-j', type=int, default=1, help='Number of files to extract in parallel')
+    parser.add_argument('--cache', action='store_true', help='Keep an index of the image next to it, so that later runs do not have to scan it')
+    parser.add_argument('--cache-dir', metavar='DIR', help='Keep the index in DIR instead (implies --cache)')
+    parser.add_argument('--stats', action='store_true', help='Print a breakdown of where the time went to stderr when done')
+    parser.add_argument('--stats-json', metavar='FILE', help='Write the time breakdown and counters to FILE as JSON')
+
+    args = parser.parse_args()
+
+    if args.stats or args.stats_json:
+        stats.enable()
+
+    with open(args.image_file, 'rb') as cdifile:
+        disc = Disc(cdifile, args.headers)
+        index = DiscIndex(args.image_file, args.cache_dir) if args.cache or args.cache_dir else None
+        disc.read(index)
+
+        # plan the work: one task per file, in path table order
+        tasks = []
+        for directory in disc.path_tbl:
+            for file in directory:
+                tasks.append((directory.path, file, args.output_dir))
+
+        if args.jobs > 1:
+            pool = multiprocessing.Pool(args.jobs, _init_worker, (args.image_file, args.headers, disc.block_offset, index, stats.enabled))
+            results = pool.imap(_dump_task, tasks)
+        else:
+            results = ((dump_file(disc, path, file, output_dir), None) for path, file, output_dir in tasks)
+
+        # results come back in task order, so the log is the same for any number of jobs
+        for log, task_stats in results:
+            if task_stats is not None:
+                stats.merge(task_stats)
+            for line in log:
+                print(line)
+            print()
+
+        if args.jobs > 1:
+            pool.close()
+            pool.join()
+
+    if args.stats:
+        stats.report(sys.stderr)
+    if args.stats_json:
+        stats.write_json(args.stats_json)
@@ -1,11 +1,14 @@
+from __future__ import print_function
 from cdi import *
 import argparse
 import sys
 
 # parse command-line arguments
-parser = argparse.ArgumentParser(description='Dump information about a CD-I disc image')
+parser = argparse.ArgumentParser(description='Dump information about a CD-I disc image',
+                                 epilog='Filter expressions: ' + SectorFilter.__doc__.split('\n', 1)[1].replace('\n    ', '\n'),
+                                 formatter_class=argparse.RawDescriptionHelpFormatter)
 parser.add_argument('image_file',   help='Image file to dump')
-parser.add_argument('sector_spec',  help='Sectors to export')
+parser.add_argument('sector_spec',  help="Sectors to export, by index: a comma-separated list of ranges like '16-32,100,200-'")
 parser.add_argument('output_file',  help='Output file name')
 
 parser.add_argument('-c', '--channel', type=int, default=None, help='Export only the specified channel')
@@ -13,24 +16,51 @@ parser.add_argument('-a', '--audio', action='store_true', help='Export audio sec
 parser.add_argument('-v', '--video', action='store_true', help='Export video sectors')
 parser.add_argument('-d', '--data',  action='store_true', help='Export data sectors')
 parser.add_argument('-e', '--empty', action='store_true', help='Export empty sectors')
+parser.add_argument('-w', '--where', help='Export only sectors matching this filter expression, see below')
+parser.add_argument('--headers', '-H', action='store_true', help='Image file includes CD headers')
+parser.add_argument('--raw', '-R', action='store_true', help='Image file does not have full file system')
+parser.add_argument('--cache', action='store_true', help='Keep an index of the image next to it, so that later runs do not have to scan it')
+parser.add_argument('--cache-dir', metavar='DIR', help='Keep the index in DIR instead (implies --cache)')
+parser.add_argument('--stats', action='store_true', help='Print a breakdown of where the time went to stderr when done')
+parser.add_argument('--stats-json', metavar='FILE', help='Write the time breakdown and counters to FILE as JSON')
 args = parser.parse_args()
 
-with open(args.image_file, 'rb') as cdifile:
-    disc = Disc(cdifile)
-    disc.read()
+if args.stats or args.stats_json:
+    stats.enable()
+
+# the options make up a filter expression; type flags select any of their types, all types if none is given
+terms = ['sector=' + args.sector_spec]
+if args.channel is not None:
+    terms.append('channel=%d' % args.channel)
+types = [t for t, flag in (('audio', args.audio), ('video', args.video), ('data', args.data), ('empty', args.empty)) if flag]
+if types:
+    terms.append('type=' + ','.join(types))
 
-    sectors = args.sector_spec.split('-')
-    if len(sectors) > 2:
-        print "barf"
-        sys.exit(2)
+try:
+    sector_filter = SectorFilter(' '.join(terms))
+    where = SectorFilter(args.where) if args.where else None
+except ValueError as e:
+    parser.error(str(e))
 
-    if len(sectors) == 1:
-        sector_list = [int(sectors[0])]
+with open(args.image_file, 'rb') as cdifile:
+    disc = Disc(cdifile, args.headers)
+    index = DiscIndex(args.image_file, args.cache_dir) if args.cache or args.cache_dir else None
+    if args.raw:
+        disc.read_sectors(index)
     else:
-        sector_list = range(int(sectors[0]), int(sectors[1]))
+        disc.read(index)
+
+    try:
+        mask = sector_filter.mask(disc)
+        if where is not None:
+            mask &= where.mask(disc)
+    except ValueError as e:
+        parser.error(str(e))
 
     with open(args.output_file, 'wb') as outfile:
-        for sector in sector_list:
-            if args.channel == None or args.channel == sector.subheader.channel_number:
-                if (disc[sector].subheader.data  and args.data) or (disc[sector].subheader.audio and args.audio) or (disc[sector].subheader.video and args.video) or (disc[sector].subheader.empty and args.empty):
-                    outfile.write(disc[sector][:])
+        disc.write_sectors(outfile, np.flatnonzero(mask))
+
+if args.stats:
+    stats.report(sys.stderr)
+if args.stats_json:
+    stats.write_json(args.stats_json)
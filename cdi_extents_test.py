@@ -0,0 +1,85 @@
+from __future__ import print_function
+from cdi import *
+from cdi_synth import write_image
+import argparse
+import copy
+import shutil
+import sys
+import tempfile
+
+IMAGE_SECTORS = 3000
+
+class Checks(object):
+    "Runs named checks, printing each outcome and counting the failures"
+    def __init__(self):
+        self.failures = 0
+
+    def check(self, name, condition, detail=''):
+        print("%-4s %s%s" % ('ok' if condition else 'FAIL', name, '' if condition else ': %r' % (detail,)))
+        if not condition:
+            self.failures += 1
+
+def with_interleave(f, unit, gap):
+    "A copy of File f with other interleave parameters"
+    f = copy.copy(f)
+    f.interleave_a, f.interleave_b = unit, gap
+    return f
+
+def run_checks(disc, label):
+    "Compare the extents from the interleave parameters with those from scanning, for every file of disc. Returns the number of failed checks."
+    c = Checks()
+    files = [(directory.path + f.name, f) for directory in disc.path_tbl for f in directory
+             if f.name not in Directory.SELF_NAMES and not f.attributes.directory]
+
+    differ = [path for path, f in files if not np.array_equal(FileIndex.file_sectors(disc, f), FileIndex.scanned_extent(disc, f))]
+    c.check('%s: extents of all %d files match the scan' % (label, len(files)), not differ, differ)
+
+    interleaved = [(path, f) for path, f in files if f.interleave_a and f.interleave_b]
+    taken = [path for path, f in interleaved if FileIndex.interleaved_extent(disc, f) is not None]
+    c.check('%s: %d interleaved files take their extents from the interleave parameters' % (label, len(interleaved)),
+            interleaved and len(taken) == len(interleaved), sorted(set(path for path, _ in interleaved) - set(taken)))
+
+    # the sectors of an interleaved pair are all of the kind of their file
+    wrong = []
+    for path, f in interleaved:
+        idx = FileIndex.file_sectors(disc, f)
+        kind = disc.sectors.video if path.endswith('.RTF') else disc.sectors.audio
+        if len(idx) != (f.size + 2047) // 2048 or not kind[idx].all():
+            wrong.append(path)
+    c.check('%s: interleaved files get only their own sectors' % label, not wrong, wrong)
+
+    # wrong interleave parameters, including gaps holding sectors of the file itself, fall back to the scan
+    wrong = []
+    for path, f in files:
+        if path.endswith('.RTF') and 'MOVIE' in path or f.interleave_a:
+            for unit, gap in ((1, 1), (2, 1), (f.interleave_a + 1, f.interleave_b or 1)):
+                bad = with_interleave(f, unit, gap)
+                if FileIndex.interleaved_extent(disc, bad) is not None or \
+                   not np.array_equal(FileIndex.file_sectors(disc, bad), FileIndex.scanned_extent(disc, f)):
+                    wrong.append((path, unit, gap))
+    c.check('%s: wrong interleave parameters are not trusted' % label, not wrong, wrong)
+
+    return c.failures
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check that file extents taken from interleave parameters match those found by scanning, over synthetic disc images')
+    parser.add_argument('--sectors', type=int, default=IMAGE_SECTORS, help='Size of the synthetic images in sectors (default: %(default)d)')
+    args = parser.parse_args()
+
+    failures = 0
+    tmpdir = tempfile.mkdtemp(prefix='cdi_extents_test')
+    try:
+        for headers in (False, True):
+            image_file = os.path.join(tmpdir, 'synth.bin')
+            with open(image_file, 'wb') as out:
+                write_image(out, args.sectors, headers=headers)
+            with open(image_file, 'rb') as cdifile:
+                disc = Disc(cdifile, headers)
+                disc.read()
+                failures += run_checks(disc, 'with headers' if headers else 'without headers')
+                del disc
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print("%d checks failed" % failures if failures else "all checks passed")
+    sys.exit(1 if failures else 0)
@@ -1,64 +1,69 @@
+from __future__ import print_function
 from cdi import *
 import argparse
+import itertools
 import sys
 
-# parse command-line arguments
-parser = argparse.ArgumentParser(description='List all directories, files, records and channels from a CD-I disc image')
-parser.add_argument('image_file',  help='Image file to list')
-
-args = parser.parse_args()
-
-with open(args.image_file, 'rb') as cdifile:
-    disc = Disc(cdifile)
-    disc.read()
-
+def list_disc(disc, out=sys.stdout):
+    "Print all directories, files, records and channels of a disc that has been read"
     for directory in disc.path_tbl:
-        # print path name
-        path = '/'
-        d = directory
-        while d.parent != 1:
-            path = '/' + d.name + path
-            d = disc.path_tbl[d.parent]
+        path = directory.path
 
         for file in directory:
             if not file.attributes.directory:
-                lbn  = file.first_lbn
-                byte = 0
-                channels = {}
-                record_num = 0
-                while True:
-                    block = disc.block(lbn)
-                    sh = block.subheader
-                    if not sh.channel_number in channels:
-                        channels[sh.channel_number] = [0]*4
+                records = 0
+                for record, events in itertools.groupby(demux(disc, file), key=lambda event: event[1]):
+                    channels = {}
+                    for _, _, channel, run in events:
+                        if not channel in channels:
+                            channels[channel] = [0]*4
+
+                        contents = channels[channel]
+                        contents[0] += int(disc.sectors.empty[run].sum())
+                        contents[1] += int(disc.sectors.data[run].sum())
+                        contents[2] += int(disc.sectors.audio[run].sum())
+                        contents[3] += int(disc.sectors.video[run].sum())
+
+                    for channel, contents in channels.items():
+                        print("%-20s record %4d channel %2d:" % (path+file.name, record, channel), end=' ', file=out)
+                        if contents[0] > 0: print("%4d empty" % contents[0], end=' ', file=out)
+                        else:               print("          ", end=' ', file=out)
+                        if contents[1] > 0: print("%4d data " % contents[1], end=' ', file=out)
+                        else:               print("          ", end=' ', file=out)
+                        if contents[2] > 0: print("%4d audio" % contents[2], end=' ', file=out)
+                        else:               print("          ", end=' ', file=out)
+                        if contents[3] > 0: print("%4d video" % contents[3], file=out)
+                        else:               print("          ", file=out)
+
+                    if len(channels) > 1:
+                        print(file=out)
+                    records += 1
+
+                if records > 1:
+                    print(file=out)
+            print(file=out)
+
+if __name__ == '__main__':
+    # parse command-line arguments
+    parser = argparse.ArgumentParser(description='List all directories, files, records and channels from a CD-I disc image')
+    parser.add_argument('image_file',  help='Image file to list')
+    parser.add_argument('--cache', action='store_true', help='Keep an index of the image next to it, so that later runs do not have to scan it')
+    parser.add_argument('--cache-dir', metavar='DIR', help='Keep the index in DIR instead (implies --cache)')
+    parser.add_argument('--stats', action='store_true', help='Print a breakdown of where the time went to stderr when done')
+    parser.add_argument('--stats-json', metavar='FILE', help='Write the time breakdown and counters to FILE as JSON')
 
-                    if sh.empty: channels[sh.channel_number][0] += 1
-                    if sh.data:  channels[sh.channel_number][1] += 1
-                    if sh.audio: channels[sh.channel_number][2] += 1
-                    if sh.video: channels[sh.channel_number][3] += 1
+    args = parser.parse_args()
 
-                    byte += block.data_size
-                    lbn += 1
+    if args.stats or args.stats_json:
+        stats.enable()
 
-                    if block.subheader.eor or block.subheader.eof or byte >= file.size:
-                        for channel, contents in channels.items():
-                            print "%-20s record %4d channel %2d:" % (path+file.name, record_num, channel),
-                            if contents[0] > 0: print "%4d empty" % contents[0],
-                            else:               print "          ",
-                            if contents[1] > 0: print "%4d data " % contents[1],
-                            else:               print "          ",
-                            if contents[2] > 0: print "%4d audio" % contents[2],
-                            else:               print "          ",
-                            if contents[3] > 0: print "%4d video" % contents[3]
-                            else:               print "          "
+    with open(args.image_file, 'rb') as cdifile:
+        disc = Disc(cdifile)
+        disc.read(DiscIndex(args.image_file, args.cache_dir) if args.cache or args.cache_dir else None)
 
-                        if len(channels) > 1:
-                            print
-                        channels = {}
-                        record_num += 1
+        list_disc(disc)
 
-                    if block.subheader.eof or byte >= file.size:
-                        break
-                if record_num > 1:
-                    print
-            print
+    if args.stats:
+        stats.report(sys.stderr)
+    if args.stats_json:
+        stats.write_json(args.stats_json)
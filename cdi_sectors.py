@@ -2,6 +2,10 @@ from cdi import *
 import sys
 
 import argparse
+import csv
+import json
+
+import numpy as np
 
 # ANSI escape codes
 RESET = "\033[0m"
@@ -17,169 +21,278 @@ UNDERLINE = "\033[4m"
 VIDEO_CODINGS = ['CLUT4', 'CLUT7', 'CLUT8', 'RL3', 'RL7', 'DYUV', 'RGB555L', 'RGB555U', 'QHY']
 HEADERS=['address', 'sector', 'block', 'file', 'channel', 'type', 'filename', 'fileidx', 'record', 'encoding', 'form', 'trig', 'realtime', 'EOR', 'EOF']
 
-# parse command-line arguments
-parser = argparse.ArgumentParser(description='Dump information about a CD-I disc image')
-parser.add_argument('image_file', help='Image file to dump')
-parser.add_argument('--headers', '-H', action='store_true', help='Image file has CD headers')
-parser.add_argument('--raw', '-R', action='store_true', help='Image file does not have full file system')
-args = parser.parse_args()
-
-col_widths = [len(h) for h in HEADERS]
-record_index = 0
-with open(args.image_file, 'rb') as cdifile:
-    disc = Disc(cdifile, headers=args.headers)
-    if args.raw:
-        disc.read_sectors()
-    else:
-        disc.read()
+# extra fields with the raw subheader bytes, for the machine-readable formats
+RAW_FIELDS = ['submode', 'coding']
 
-    table = []
-    current_files = {}
-    file_bytes    = {}
-    for sector_index, sector in enumerate(disc):
-        row = {}
-        row['address'] = "%08X" % sector.offset
-        row['sector']  = "%06d" % sector_index
-        if args.raw:
-            row['block'] = '-'*6
-        else:
-            row['block']   = "%06d" % disc.sector2lbn(sector_index)
-
-        h = sector.subheader
-        row['file']    = "%02d" % h.file_number
-        row['channel'] = "%02d" % h.channel_number
-
-        if not args.raw:
-            for d in disc.path_tbl:
-                for f in d:
-                    if f.first_lbn == disc.sector2lbn(sector_index):
-                        current_files[f.number] = f
-                        file_bytes[f.number]    = 0
-                        record_index = 0
-
-        if h.file_number in current_files:
-            current_idx = h.file_number
-        else:
-            current_idx = 0
+# column widths of the streaming text format, wide enough for any value
+TEXT_WIDTHS = {'address': 8, 'sector': 6, 'block': 6, 'file': 4, 'channel': 7, 'type': 4, 'filename': 34, 'fileidx': 8,
+               'record': 6, 'encoding': 32, 'form': 4, 'trig': 4, 'realtime': 8, 'EOR': 3, 'EOF': 3, 'submode': 7, 'coding': 6}
 
-        try:
-            row['filename'] = repr(current_files[current_idx].name)
-            row['fileidx']  = "%8d" % file_bytes[current_idx]
-        except KeyError:
-            row['filename'] = ""
-            row['fileidx']  = "-"*8
+FORMATS = ('table', 'text', 'csv', 'jsonl')
 
-        if h.video:
-            row['type'] = "V"
+# number of rows to write between flushes of the output in the streaming formats
+FLUSH_ROWS = 1024
 
-            if h.coding_raw == 0b00001111:
-                row['encoding'] = "MPEG"
-            else:
-                if h.coding_raw & (1<<7):
-                    row['encoding'] = "app-specific"
-                else:
-                    try:                row['encoding'] = VIDEO_CODINGS[h.coding_raw & 0b00001111]
-                    except IndexError:  row['encoding'] = "<reserved>"
-
-                    if h.coding_raw & (1<<6):       row['encoding'] += ", odd lines"
-                    else:                           row['encoding'] += ", even lines"
-
-                    if h.coding_raw & (1<<5):
-                        if h.coding_raw & (1<<4):   row['encoding'] += ", high res"
-                    else:
-                        if h.coding_raw & (1<<4):   row['encoding'] += ", double res"
-                        else:                       row['encoding'] += ", normal res"
-
-        if h.audio:
-            row['type'] = "A"
-            if h.coding_raw == 0b01111111:
-                row['encoding'] = "MPEG"
+def encoding_name(submode_raw, coding_raw):
+    "Describe the coding of a sector, or return None for sectors that are neither video nor audio"
+    encoding = None
+    if submode_raw & (1<<1):
+        # video
+        if coding_raw == 0b00001111:
+            encoding = "MPEG"
+        else:
+            if coding_raw & (1<<7):
+                encoding = "app-specific"
             else:
-                if h.coding_raw & (1<<2):   row['encoding']  = "18.9kHz"
-                else:                       row['encoding']  = "37.8kHz"
-
-                if h.coding_raw & (1<<4):   row['encoding'] += ", 8bit"
-                else:                       row['encoding'] += ", 4bit"
-
-                if h.coding_raw & (1<<6):   row['encoding'] += ", emphasis, "
-                else:                       row['encoding'] += ",           "
+                try:                encoding = VIDEO_CODINGS[coding_raw & 0b00001111]
+                except IndexError:  encoding = "<reserved>"
 
-                if h.coding_raw & (1<<0):   row['encoding'] += "stereo"
-                else:                       row['encoding'] += "mono"
+                if coding_raw & (1<<6):       encoding += ", odd lines"
+                else:                         encoding += ", even lines"
 
-        if h.data:      row['type'] = "D"
-        if h.empty:     row['type'] = "E"
-
-        if h.form1:     row['form'] = "1"
-        else:           row['form'] = "2"
-
-        if h.trigger:   row['trig'] = "T"
+                if coding_raw & (1<<5):
+                    if coding_raw & (1<<4):   encoding += ", high res"
+                else:
+                    if coding_raw & (1<<4):   encoding += ", double res"
+                    else:                     encoding += ", normal res"
 
-        if h.realtime:  row['realtime'] = "RT"
+    if submode_raw & (1<<2):
+        # audio
+        if coding_raw == 0b01111111:
+            encoding = "MPEG"
+        else:
+            if coding_raw & (1<<2):   encoding  = "18.9kHz"
+            else:                     encoding  = "37.8kHz"
+
+            if coding_raw & (1<<4):   encoding += ", 8bit"
+            else:                     encoding += ", 4bit"
+
+            if coding_raw & (1<<6):   encoding += ", emphasis, "
+            else:                     encoding += ",           "
+
+            if coding_raw & (1<<0):   encoding += "stereo"
+            else:                     encoding += "mono"
+
+    return encoding
+
+def record_numbers(table):
+    """The record number of every sector, counting end-of-record sectors since the last end-of-file sector.
+
+    This numbering is used for sectors that do not belong to any file."""
+    eor = table.eor.astype(np.int64)
+    eor_before = np.concatenate(([0], np.cumsum(eor)[:-1]))
+
+    # the record count starts over after every end-of-file sector
+    restart = np.concatenate(([True], table.eof[:-1]))
+    last_restart = np.maximum.accumulate(np.where(restart, np.arange(len(table)), 0))
+    return eor_before - eor_before[last_restart]
+
+def sector_fields(disc, indices, raw=False):
+    """Generator yielding a dictionary of the raw fields of each sector with an index in indices.
+
+    Values are numbers, booleans, strings or None, ready for CSV or JSON."""
+    table = disc.sectors
+    records = record_numbers(table)
+    for start in range(0, len(indices), FLUSH_ROWS):
+        chunk = indices[start:start+FLUSH_ROWS]
+        columns = zip(chunk.tolist(), table.offset[chunk].tolist(), table.file_number[chunk].tolist(),
+                      table.channel_number[chunk].tolist(), table.submode_raw[chunk].tolist(),
+                      table.coding_raw[chunk].tolist(), records[chunk].tolist())
+        for sector_index, offset, file_number, channel_number, submode_raw, coding_raw, record in columns:
+            fields = {'address': offset, 'sector': sector_index, 'block': None if raw else disc.sector2lbn(sector_index),
+                      'file': file_number, 'channel': channel_number, 'submode': submode_raw, 'coding': coding_raw}
+
+            location = None if raw else disc.locate(sector_index)
+            if location is not None:
+                f, file_record, file_block = location
+                fields['filename'] = f.name
+                fields['fileidx']  = file_block*2048
+                fields['record']   = file_record
+            else:
+                fields['filename'] = None
+                fields['fileidx']  = None
+                fields['record']   = record
+
+            if submode_raw & (1<<1): fields['type'] = "V"
+            if submode_raw & (1<<2): fields['type'] = "A"
+            if submode_raw & (1<<3): fields['type'] = "D"
+            if not submode_raw & 0b00001110: fields['type'] = "E"
+
+            fields['encoding'] = encoding_name(submode_raw, coding_raw)
+            fields['form']     = 2 if submode_raw & (1<<5) else 1
+            fields['trig']     = bool(submode_raw & (1<<4))
+            fields['realtime'] = bool(submode_raw & (1<<6))
+            fields['EOR']      = bool(submode_raw & (1<<0))
+            fields['EOF']      = bool(submode_raw & (1<<7))
+            yield fields
+
+def display_row(fields):
+    "The cells of a sector's row in the text formats, keyed by field name"
+    row = {}
+    row['address']  = "%08X" % fields['address']
+    row['sector']   = "%06d" % fields['sector']
+    row['block']    = '-'*6 if fields['block'] is None else "%06d" % fields['block']
+    row['file']     = "%02d" % fields['file']
+    row['channel']  = "%02d" % fields['channel']
+    row['type']     = fields['type']
+    row['filename'] = "" if fields['filename'] is None else repr(fields['filename'])
+    row['fileidx']  = "-"*8 if fields['fileidx'] is None else "%8d" % fields['fileidx']
+    row['record']   = "%d" % fields['record']
+    row['encoding'] = fields['encoding'] or ""
+    row['form']     = "%d" % fields['form']
+    row['trig']     = "T" if fields['trig'] else ""
+    row['realtime'] = "RT" if fields['realtime'] else ""
+    row['EOR']      = "EOR" if fields['EOR'] else ""
+    row['EOF']      = "EOF" if fields['EOF'] else ""
+    row['submode']  = "%02X" % fields['submode']
+    row['coding']   = "%02X" % fields['coding']
+    return row
+
+def centered(cell, width):
+    padding = width - len(cell)
+    pad_left  = int(padding/2)
+    pad_right = padding - pad_left
+    return " "*pad_left + cell + " "*pad_right
+
+def write_table(out, rows, columns):
+    "The original format: a coloured table, with columns as wide as their widest cell. Needs all rows up front."
+    table = []
+    col_widths = [len(c) for c in columns]
+    for fields in rows:
+        row = display_row(fields)
+        r = [row[key] for key in columns]
+        for i, cell in enumerate(r):
+            col_widths[i] = max(col_widths[i], len(cell))
+        table.append((fields, r))
 
-        if h.eor:       row['EOR'] = "EOR"
-        if h.eof:       row['EOF'] = "EOF"
+    for i in range(len(col_widths)):
+        col_widths[i] += 2
 
-        row['record'] = "%d" % record_index
+    # make fancy table
+    with stats.stage('output'):
+        out.write(BOLD)
+        out.write(UNDERLINE)
+        for i, col in enumerate(columns):
+            out.write(centered(col, col_widths[i]))
+        out.write(RESET+"\n")
+
+        for fields, row in table:
+            if fields['type'] == 'D':
+                out.write(BLUE)
+            elif fields['type'] == 'A':
+                out.write(GREEN)
+            elif fields['type'] == 'V':
+                out.write(RED)
+
+            if fields['EOR'] or fields['EOF']:
+                out.write(UNDERLINE)
+
+            if fields['trig']:
+                out.write(BOLD)
+
+            for i, cell in enumerate(row):
+                out.write(centered(cell, col_widths[i]))
+            out.write(RESET + "\n")
+
+def write_text(out, rows, columns):
+    "Plain fixed-width text, written as the rows come in"
+    widths = [max(len(c), TEXT_WIDTHS[c]) + 2 for c in columns]
+    out.write("".join(centered(c, w) for c, w in zip(columns, widths)).rstrip() + "\n")
+    for count, fields in enumerate(rows):
+        row = display_row(fields)
+        out.write("".join(centered(row[c], w) for c, w in zip(columns, widths)).rstrip() + "\n")
+        if count % FLUSH_ROWS == 0:
+            out.flush()
+
+def write_csv(out, rows, columns):
+    "CSV with a header line and raw values, written as the rows come in"
+    writer = csv.writer(out, lineterminator='\n')
+    writer.writerow(columns)
+    for count, fields in enumerate(rows):
+        writer.writerow(['' if fields[c] is None else int(fields[c]) if isinstance(fields[c], bool) else fields[c] for c in columns])
+        if count % FLUSH_ROWS == 0:
+            out.flush()
+
+def write_jsonl(out, rows, columns):
+    "One JSON object per line with raw values, written as the rows come in"
+    for count, fields in enumerate(rows):
+        out.write(json.dumps(dict((c, fields[c]) for c in columns), sort_keys=True) + "\n")
+        if count % FLUSH_ROWS == 0:
+            out.flush()
+
+WRITERS = {'table': write_table, 'text': write_text, 'csv': write_csv, 'jsonl': write_jsonl}
+
+def selected_sectors(disc, args):
+    "The indices of the sectors matching the range and field options"
+    table = disc.sectors
+    mask = np.ones(len(table), dtype=bool)
+    if args.range is not None:
+        mask &= range_mask(args.range, len(table))
+    if args.file is not None:
+        mask &= table.file_number == args.file
+    if args.channel is not None:
+        mask &= table.channel_number == args.channel
+    if args.type is not None:
+        types = {'A': table.audio, 'V': table.video, 'D': table.data, 'E': table.empty}
+        type_mask = np.zeros(len(table), dtype=bool)
+        for t in args.type.upper():
+            if t not in types:
+                raise ValueError("Invalid sector type '%s'" % t)
+            type_mask |= types[t]
+        mask &= type_mask
+    if args.where is not None:
+        mask &= SectorFilter(args.where).mask(disc)
+    return np.flatnonzero(mask)
+
+if __name__ == '__main__':
+    # parse command-line arguments
+    parser = argparse.ArgumentParser(description='Dump information about a CD-I disc image')
+    parser.add_argument('image_file', help='Image file to dump')
+    parser.add_argument('--headers', '-H', action='store_true', help='Image file has CD headers')
+    parser.add_argument('--raw', '-R', action='store_true', help='Image file does not have full file system')
+    parser.add_argument('--format', '-f', choices=FORMATS, default='table', help='Output format: the coloured table (default, only printed once all sectors are read), '
+                                                                                 'plain fixed-width text, CSV or JSON Lines; all but the table are streamed')
+    parser.add_argument('--range', '-r', help="Sectors to show, by index: a comma-separated list of ranges like '16-32,100,200-'")
+    parser.add_argument('--file', type=int, help='Show only sectors with this subheader file number')
+    parser.add_argument('--channel', '-c', type=int, help='Show only sectors of this channel')
+    parser.add_argument('--type', '-t', help='Show only sectors of these types: any of A (audio), V (video), D (data) and E (empty)')
+    parser.add_argument('--where', '-w', help="Show only sectors matching a filter expression like 'type=audio channel=1,3 or eof', see cdi.SectorFilter")
+    parser.add_argument('--fields', help='Comma-separated list of the fields to show, out of: %s' % ', '.join(HEADERS + RAW_FIELDS))
+    parser.add_argument('--cache', action='store_true', help='Keep an index of the image next to it, so that later runs do not have to scan it')
+    parser.add_argument('--cache-dir', metavar='DIR', help='Keep the index in DIR instead (implies --cache)')
+    parser.add_argument('--stats', action='store_true', help='Print a breakdown of where the time went to stderr when done')
+    parser.add_argument('--stats-json', metavar='FILE', help='Write the time breakdown and counters to FILE as JSON')
+    args = parser.parse_args()
+
+    if args.stats or args.stats_json:
+        stats.enable()
+
+    if args.fields is not None:
+        columns = args.fields.split(',')
+        unknown = [c for c in columns if c not in HEADERS + RAW_FIELDS]
+        if unknown:
+            parser.error("Unknown field(s): %s" % ', '.join(unknown))
+    elif args.format in ('csv', 'jsonl'):
+        columns = HEADERS + RAW_FIELDS
+    else:
+        columns = HEADERS
 
-        if h.eor:       record_index += 1
-        if h.eof:       record_index  = 0
+    with open(args.image_file, 'rb') as cdifile:
+        disc = Disc(cdifile, headers=args.headers)
+        index = DiscIndex(args.image_file, args.cache_dir) if args.cache or args.cache_dir else None
+        if args.raw:
+            disc.read_sectors(index)
+        else:
+            disc.read(index)
 
         try:
-            file_bytes[current_idx] += 2048
-            if h.eof or (file_bytes[current_idx] >= current_files[current_idx].size):
-                del current_files[current_idx]
-                del file_bytes[current_idx]
-        except KeyError:
-            pass
-
-        r = []
-        for i, key in enumerate(HEADERS):
-            try:
-                r.append(row[key])
-                col_widths[i] = max(col_widths[i], len(row[key]))
-            except KeyError:
-                r.append("")
-        table.append(r)
+            indices = selected_sectors(disc, args)
+        except ValueError as e:
+            parser.error(str(e))
 
-    for i in range(len(col_widths)):
-        col_widths[i] += 2
+        WRITERS[args.format](sys.stdout, sector_fields(disc, indices, args.raw), columns)
 
-    # make fancy table
-    sys.stdout.write(BOLD)
-    sys.stdout.write(UNDERLINE)
-    for i, col in enumerate(HEADERS):
-        padding = col_widths[i] - len(col)
-        if padding%2 == 0:
-            pad_left  = int(padding/2)
-            pad_right = int(padding/2)
-        else:
-            pad_left  = int(padding/2)
-            pad_right = int(padding/2)+1
-        sys.stdout.write(" "*pad_left + col + " "*pad_right)
-    sys.stdout.write(RESET+"\n")
-
-    for row in table:
-        if row[5] == 'D':
-            sys.stdout.write(BLUE)
-        elif row[5] == 'A':
-            sys.stdout.write(GREEN)
-        elif row[5] == 'V':
-            sys.stdout.write(RED)
-
-        if row[-1] != "" or row[-2] != "":
-            sys.stdout.write(UNDERLINE)
-
-        if row[-4] != "":
-            sys.stdout.write(BOLD)
-
-        for i, cell in enumerate(row):
-            padding = col_widths[i] - len(cell)
-            if padding%2 == 0:
-                pad_left  = int(padding/2)
-                pad_right = int(padding/2)
-            else:
-                pad_left  = int(padding/2)
-                pad_right = int(padding/2)+1
-            sys.stdout.write(" "*pad_left + cell + " "*pad_right)
-        sys.stdout.write(RESET + "\n")
+    if args.stats:
+        stats.report(sys.stderr)
+    if args.stats_json:
+        stats.write_json(args.stats_json)
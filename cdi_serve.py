@@ -0,0 +1,388 @@
+from cdi import *
+from cdi_cache import DecodedCache, record_audio, record_frames
+from cdi_video import WIDTH, HEIGHT, CLUT_DECODERS, load_clut, GREYSCALE_CLUT
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import os
+import sys
+import traceback
+import urllib.parse
+
+# Python 3 only: this uses asyncio to serve many clients from a single thread
+
+RESPONSES = {200: 'OK', 206: 'Partial Content', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+             416: 'Range Not Satisfiable', 500: 'Internal Server Error'}
+
+# bytes written to a connection before waiting for the client to take them
+WRITE_CHUNK = 1 << 20
+
+class HTTPError(Exception):
+    "An error response; length is the length of the body a 416 range was outside of"
+    def __init__(self, status, message=None, length=None):
+        Exception.__init__(self, message or RESPONSES[status])
+        self.status = status
+        self.length = length
+
+class Body(object):
+    "A response body made of a list of buffers, like the memoryviews of runs of sectors, that is never joined"
+    def __init__(self, segments, content_type):
+        self.segments = [memoryview(s).cast('B') for s in segments]
+        self.length = sum(len(s) for s in self.segments)
+        self.content_type = content_type
+
+    def slice(self, start, stop):
+        "The buffers making up bytes start to stop of the body"
+        pos = 0
+        for segment in self.segments:
+            end = pos + len(segment)
+            if end > start and pos < stop:
+                yield segment[max(0, start-pos):min(len(segment), stop-pos)]
+            pos = end
+            if pos >= stop:
+                break
+
+def json_body(value):
+    return Body([json.dumps(value, indent=2, sort_keys=True).encode('utf-8') + b'\n'], 'application/json')
+
+def parse_range(header, length):
+    """Parse a Range header into (start, stop) for a body of length bytes.
+
+    Returns None for anything but a single valid byte range, so that the
+    whole body is sent, as HTTP allows. Raises HTTPError 416 if the range is
+    outside the body."""
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+    first, sep, last = spec.strip().partition('-')
+    try:
+        if not sep:
+            return None
+        elif not first:
+            suffix = int(last)
+            if suffix == 0:
+                raise HTTPError(416, length=length)
+            start, stop = max(0, length - suffix), length
+        else:
+            start = int(first)
+            stop = int(last) + 1 if last else max(length, start + 1)
+    except ValueError:
+        return None
+
+    if start < 0 or stop <= start:
+        return None     # not a valid range, such as bytes=5-2
+    if start >= length:
+        raise HTTPError(416, length=length)
+    return start, min(length, stop)
+
+class DiscServer(object):
+    """HTTP server for the files on one or more disc images, read straight from the images.
+
+    images maps the name each image is served under to an open Disc. For an
+    image served as NAME, these are the endpoints, all for GET and HEAD:
+
+        /                                   JSON list of the images
+        /NAME/DIR/                          JSON listing of a directory
+        /NAME/PATH                          the full sectors of a file, subheaders included, in disc order
+        /NAME/PATH?info                     JSON list of the records and channels of a file
+        /NAME/PATH?record=R&channel=C       the sectors of one record and channel
+        ...&decode=wav                      their audio, decoded to a WAV file
+        ...&decode=dyuv|clut7&frame=N       a decoded video frame as a binary PNM file;
+                                            also clut4, clut8, rl3 and rl7
+
+    clut is used for the 128-colour codings CLUT7 and RL7; the others are
+    shown in greyscale. Byte ranges can be requested of every endpoint. Decoding is done on a
+    single worker thread, through a DecodedCache, so the event loop keeps
+    serving other clients while a record is decoded."""
+
+    def __init__(self, images, cache=None, clut=GREYSCALE_CLUT, log=None):
+        self.images = images
+        self.cache = cache if cache is not None else DecodedCache()
+        self.clut = clut
+        self.log = log
+        self.decoder = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._directories = {}
+
+    def directories(self, name):
+        "Dictionary of the directories of an image by path"
+        if name not in self._directories:
+            self._directories[name] = dict((directory.path, directory) for directory in self.images[name].path_tbl)
+        return self._directories[name]
+
+    async def handle(self, reader, writer):
+        "Serve the requests on one connection, keeping it open as long as the client wants"
+        peer = writer.get_extra_info('peername')
+        try:
+            while True:
+                try:
+                    request = await self.read_request(reader)
+                except (ValueError, HTTPError):
+                    # over-long lines and bad headers leave no telling where the next request starts
+                    await self.send_error(writer, HTTPError(400), False, False)
+                    break
+                if request is None:
+                    break
+                method, target, version, request_headers = request
+
+                keep_alive = version == 'HTTP/1.1' and request_headers.get('connection', '').lower() != 'close'
+                head = method == 'HEAD'
+                try:
+                    if method not in ('GET', 'HEAD'):
+                        raise HTTPError(405)
+                    body = await self.route(target)
+                    sent = await self.send(writer, body, request_headers.get('range'), head, keep_alive)
+                except HTTPError as e:
+                    sent = await self.send_error(writer, e, head, keep_alive)
+                except Exception as e:
+                    # a damaged image should not take the server down
+                    traceback.print_exc()
+                    sent = await self.send_error(writer, HTTPError(500, '%s: %s' % (type(e).__name__, e)), head, keep_alive)
+
+                if self.log is not None:
+                    print('%s "%s %s" %d %d' % (peer[0] if peer else '-', method, target, sent[0], sent[1]), file=self.log)
+                if not keep_alive:
+                    break
+
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def read_request(self, reader):
+        """Read a request line, its headers and any body. Returns the method, target, version and a dictionary of the headers, or None at the end of the connection.
+
+        Raises ValueError or HTTPError 400 for a malformed request."""
+        line = await reader.readline()
+        if not line:
+            return None
+
+        request_headers = {}
+        while True:
+            header = await reader.readline()
+            if header in (b'\r\n', b'\n', b''):
+                break
+            key, _, value = header.decode('latin-1').partition(':')
+            request_headers[key.strip().lower()] = value.strip()
+
+        parts = line.decode('latin-1').split()
+        if len(parts) != 3:
+            raise HTTPError(400)
+        method, target, version = parts
+
+        # requests have no body we care about, but it must not be taken for the next request
+        length = int(request_headers.get('content-length', 0) or 0)
+        if length < 0:
+            raise HTTPError(400)
+        if length:
+            await reader.readexactly(length)
+        return method, target, version, request_headers
+
+    async def send(self, writer, body, range_header, head, keep_alive):
+        "Send a body, or the requested range of it. Returns the status and the number of body bytes sent."
+        start, stop = 0, body.length
+        status = 200
+        if range_header:
+            requested = parse_range(range_header, body.length)
+            if requested is not None:
+                start, stop = requested
+                status = 206
+
+        headers = [('Content-Type', body.content_type), ('Content-Length', str(stop - start)), ('Accept-Ranges', 'bytes')]
+        if status == 206:
+            headers.append(('Content-Range', 'bytes %d-%d/%d' % (start, stop-1, body.length)))
+        self.write_head(writer, status, headers, keep_alive)
+
+        sent = 0
+        if not head:
+            with stats.stage('output'):
+                for segment in body.slice(start, stop):
+                    for pos in range(0, len(segment), WRITE_CHUNK):
+                        chunk = segment[pos:pos+WRITE_CHUNK]
+                        writer.write(chunk)
+                        sent += len(chunk)
+                        await writer.drain()
+            stats.count('bytes written', sent)
+        await writer.drain()
+        return status, sent
+
+    async def send_error(self, writer, error, head, keep_alive):
+        message = ('%d %s\n' % (error.status, error)).encode('utf-8')
+        headers = [('Content-Type', 'text/plain; charset=utf-8'), ('Content-Length', str(len(message)))]
+        if error.status == 416 and error.length is not None:
+            headers.append(('Content-Range', 'bytes */%d' % error.length))
+        self.write_head(writer, error.status, headers, keep_alive)
+        if not head:
+            writer.write(message)
+        await writer.drain()
+        return error.status, 0 if head else len(message)
+
+    def write_head(self, writer, status, headers, keep_alive):
+        lines = ['HTTP/1.1 %d %s' % (status, RESPONSES[status])]
+        lines += ['%s: %s' % header for header in headers]
+        lines.append('Connection: %s' % ('keep-alive' if keep_alive else 'close'))
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+
+    async def route(self, target):
+        "Returns the Body for a request target, or raises HTTPError"
+        url = urllib.parse.urlsplit(target)
+        path = urllib.parse.unquote(url.path)
+        query = urllib.parse.parse_qs(url.query, keep_blank_values=True)
+
+        if path == '/':
+            return json_body(sorted(self.images))
+
+        name, _, file_path = path[1:].partition('/')
+        if name not in self.images:
+            raise HTTPError(404, "No image %s" % name)
+        disc = self.images[name]
+        file_path = '/' + file_path
+
+        directories = self.directories(name)
+        if file_path in directories or file_path + '/' in directories:
+            directory = directories[file_path if file_path in directories else file_path + '/']
+            return json_body(self.directory_listing(directory))
+
+        try:
+            file = disc.lookup(file_path)
+        except KeyError:
+            raise HTTPError(404, "No file %s on image %s" % (file_path, name))
+
+        if 'info' in query:
+            return json_body(self.file_info(disc, file_path, file))
+
+        if 'record' not in query and 'channel' not in query:
+            return Body(disc.spans(disc.file_sectors(file)), 'application/octet-stream')
+
+        try:
+            record  = int(query.get('record', ['0'])[0])
+            channel = int(query.get('channel', ['0'])[0])
+            frame   = int(query.get('frame', ['0'])[0])
+        except ValueError:
+            raise HTTPError(400, "record, channel and frame must be numbers")
+        decode = query.get('decode', [None])[0]
+
+        if decode is None:
+            indices = [run for _, r, c, run in demux(disc, file) if r == record and c == channel]
+            if not indices:
+                raise HTTPError(404, "No record %d channel %d in %s" % (record, channel, file_path))
+            return Body(disc.spans(np.concatenate(indices)), 'application/octet-stream')
+
+        loop = asyncio.get_event_loop()
+        if decode == 'wav':
+            samples, decoder = await loop.run_in_executor(self.decoder, record_audio, disc, file, record, channel, self.cache)
+            if decoder is None:
+                raise HTTPError(404, "No audio in record %d channel %d of %s" % (record, channel, file_path))
+            return Body([wav_header(decoder, len(samples)), samples.astype('<i2')], 'audio/wav')
+
+        elif decode == 'dyuv' or decode in CLUT_DECODERS:
+            clut = self.clut if decode in ('clut7', 'rl7') else None
+            frames = await loop.run_in_executor(self.decoder, lambda: record_frames(disc, file, record, channel, decode, self.cache, clut=clut))
+            if not 0 <= frame < len(frames):
+                raise HTTPError(404, "No frame %d in record %d channel %d of %s" % (frame, record, channel, file_path))
+            header = ("P6\n%d %d\n255\n" % (WIDTH, HEIGHT)).encode('ascii')
+            return Body([header, np.ascontiguousarray(frames[frame])], 'image/x-portable-pixmap')
+
+        else:
+            raise HTTPError(400, "Unknown decoding %s, use wav, dyuv or %s" % (decode, ', '.join(sorted(CLUT_DECODERS))))
+
+    def directory_listing(self, directory):
+        entries = []
+        for f in directory:
+            if f.name not in Directory.SELF_NAMES:
+                entries.append({'name': f.name, 'directory': bool(f.attributes.directory), 'size': f.size,
+                                'first_lbn': f.first_lbn, 'number': f.number})
+        return {'path': directory.path, 'entries': entries}
+
+    def file_info(self, disc, path, file):
+        channels = []
+        for _, record, channel, run in demux(disc, file):
+            if channels and channels[-1]['record'] == record and channels[-1]['channel'] == channel:
+                entry = channels[-1]
+            else:
+                entry = {'record': record, 'channel': channel, 'sectors': 0, 'empty': 0, 'data': 0, 'audio': 0, 'video': 0}
+                channels.append(entry)
+            entry['sectors'] += len(run)
+            for kind in ('empty', 'data', 'audio', 'video'):
+                entry[kind] += int(getattr(disc.sectors, kind)[run].sum())
+
+        # a channel may come back within a record, after runs of other channels
+        merged = {}
+        for entry in channels:
+            key = (entry['record'], entry['channel'])
+            if key in merged:
+                for kind in ('sectors', 'empty', 'data', 'audio', 'video'):
+                    merged[key][kind] += entry[kind]
+            else:
+                merged[key] = entry
+        return {'path': path, 'size': file.size, 'first_lbn': file.first_lbn, 'number': file.number,
+                'channels': [merged[key] for key in sorted(merged)]}
+
+def wav_header(decoder, samples):
+    "The 44-byte header of a WAV file holding samples int16 samples in the format of an AudioDecoder, as the wave module writes it"
+    size = 2*samples
+    rate, channels = decoder.sample_rate, decoder.channels
+    return struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', 36 + size, b'WAVE', b'fmt ', 16, 1, channels, rate,
+                       rate*channels*2, channels*2, 16, b'data', size)
+
+def image_names(image_files):
+    "Names to serve images under: the file name without extension, numbered if they clash"
+    names = {}
+    for image_file in image_files:
+        base = os.path.splitext(os.path.basename(image_file))[0]
+        name, n = base, 2
+        while name in names:
+            name = '%s-%d' % (base, n)
+            n += 1
+        names[name] = image_file
+    return names
+
+if __name__ == '__main__':
+    # parse command-line arguments
+    parser = argparse.ArgumentParser(description='Serve the files, records and channels of CD-I disc images over HTTP, straight from the images')
+    parser.add_argument('images', nargs='+', help='Image files to serve, each under its file name without extension')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', '-p', type=int, default=8000, help='Port to listen on (default: 8000)')
+    parser.add_argument('--headers', '-H', action='store_true', help='Image files include CD headers')
+    parser.add_argument('--clut', help='Colour lookup table file for CLUT7 and RL7 frames')
+    parser.add_argument('--decoded-cache-mb', type=float, default=DecodedCache.MAX_BYTES / float(1 << 20), help='Memory for decoded audio and frames, in MB (default: %(default)d)')
+    parser.add_argument('--decoded-cache-dir', metavar='DIR', help='Also keep decoded audio and frames in DIR')
+    parser.add_argument('--quiet', '-q', action='store_true', help='Do not log requests to stderr')
+    parser.add_argument('--cache', action='store_true', help='Keep an index of each image next to it, so that later runs do not have to scan it')
+    parser.add_argument('--cache-dir', metavar='DIR', help='Keep the indices in DIR instead (implies --cache)')
+    parser.add_argument('--stats', action='store_true', help='Print a breakdown of where the time went to stderr when stopped')
+    parser.add_argument('--stats-json', metavar='FILE', help='Write the time breakdown and counters to FILE as JSON when stopped')
+    args = parser.parse_args()
+
+    if args.stats or args.stats_json:
+        stats.enable()
+
+    images = {}
+    for name, image_file in sorted(image_names(args.images).items()):
+        disc = Disc(open(image_file, 'rb'), args.headers)
+        disc.read(DiscIndex(image_file, args.cache_dir) if args.cache or args.cache_dir else None)
+        images[name] = disc
+        print("Serving %s as /%s/" % (image_file, name), file=sys.stderr)
+
+    cache = DecodedCache(int(args.decoded_cache_mb * (1 << 20)), args.decoded_cache_dir)
+    server = DiscServer(images, cache, load_clut(args.clut) if args.clut else GREYSCALE_CLUT, None if args.quiet else sys.stderr)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    listener = loop.run_until_complete(asyncio.start_server(server.handle, args.host, args.port))
+    print("Listening on http://%s:%d/" % (args.host, args.port), file=sys.stderr)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        loop.run_until_complete(listener.wait_closed())
+        loop.close()
+        server.decoder.shutdown()
+
+    if args.stats:
+        stats.report(sys.stderr)
+        print("decoded cache: %s" % cache.counters(), file=sys.stderr)
+    if args.stats_json:
+        stats.write_json(args.stats_json)
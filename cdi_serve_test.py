@@ -0,0 +1,156 @@
+from cdi import *
+from cdi_serve import DiscServer
+from cdi_synth import write_image
+import argparse
+import asyncio
+import http.client
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+
+# Python 3 only, like cdi_serve.py
+
+IMAGE_SECTORS = 2000
+
+class Checks(object):
+    "Runs named checks against a server, printing each outcome and counting the failures"
+    def __init__(self, port):
+        self.port = port
+        self.failures = 0
+
+    def connection(self):
+        return http.client.HTTPConnection('127.0.0.1', self.port, timeout=30)
+
+    def request(self, method, target, headers={}, conn=None):
+        "Make a request, on a new connection unless one is given. Returns the response and its body."
+        conn = conn or self.connection()
+        conn.request(method, target, headers=headers)
+        response = conn.getresponse()
+        return response, response.read()
+
+    def check(self, name, condition, detail=''):
+        print("%-4s %s%s" % ('ok' if condition else 'FAIL', name, '' if condition else ': %r' % (detail,)))
+        if not condition:
+            self.failures += 1
+
+def run_checks(disc, name, port):
+    "Check the endpoints of a server serving disc as name. Returns the number of failed checks."
+    c = Checks(port)
+    paths = dict((f.name.split('.')[0].rstrip('0123456789'), directory.path + f.name)
+                 for directory in disc.path_tbl for f in directory if f.name not in Directory.SELF_NAMES and '.' in f.name)
+
+    response, body = c.request('GET', '/')
+    c.check('image list', response.status == 200 and json.loads(body.decode('utf-8')) == [name], body)
+
+    # a file, whole and in ranges
+    path = '/%s%s' % (name, paths['DATA'])
+    expected = b''.join(bytes(s) for s in disc.spans(disc.file_sectors(disc.lookup(paths['DATA']))))
+    length = len(expected)
+    response, body = c.request('GET', path)
+    c.check('full GET', response.status == 200 and body == expected and int(response.getheader('Content-Length')) == length,
+            (response.status, len(body), length))
+
+    response, body = c.request('GET', path, {'Range': 'bytes=100-2099'})
+    c.check('single range', response.status == 206 and body == expected[100:2100] and
+            response.getheader('Content-Range') == 'bytes 100-2099/%d' % length, (response.status, response.getheader('Content-Range')))
+
+    response, body = c.request('GET', path, {'Range': 'bytes=-500'})
+    c.check('suffix range', response.status == 206 and body == expected[-500:] and
+            response.getheader('Content-Range') == 'bytes %d-%d/%d' % (length-500, length-1, length), response.getheader('Content-Range'))
+
+    response, body = c.request('GET', path, {'Range': 'bytes=%d-' % length})
+    c.check('unsatisfiable range', response.status == 416 and response.getheader('Content-Range') == 'bytes */%d' % length,
+            (response.status, response.getheader('Content-Range')))
+
+    response, body = c.request('GET', path, {'Range': 'bytes=5-2'})
+    c.check('invalid range ignored', response.status == 200 and body == expected, response.status)
+
+    response, body = c.request('HEAD', path)
+    c.check('HEAD', response.status == 200 and body == b'' and int(response.getheader('Content-Length')) == length,
+            (response.status, len(body), response.getheader('Content-Length')))
+
+    # several requests on one connection
+    conn = c.connection()
+    responses = [c.request('GET', path, {'Range': 'bytes=0-9'}, conn) for _ in range(3)]
+    sock = conn.sock
+    response, body = c.request('GET', '/', conn=conn)
+    c.check('keep-alive', all(r.status == 206 and b == expected[:10] for r, b in responses) and response.status == 200 and conn.sock is sock)
+    conn.close()
+
+    response, body = c.request('POST', path)
+    c.check('other methods', response.status == 405, response.status)
+
+    response, body = c.request('GET', '/%s/NO/SUCH/FILE' % name)
+    c.check('missing file', response.status == 404, response.status)
+
+    # malformed requests get a 400, not a dropped connection
+    for label, request in (('bad Content-Length', b'GET / HTTP/1.1\r\nContent-Length: abc\r\n\r\n'),
+                           ('over-long request line', b'GET /' + b'x'*(1 << 17) + b' HTTP/1.1\r\n\r\n')):
+        sock = socket.create_connection(('127.0.0.1', port), timeout=30)
+        try:
+            sock.sendall(request)
+            reply = sock.recv(4096)
+        except OSError as e:
+            reply = repr(e).encode('utf-8')    # the server dropped the connection
+        sock.close()
+        c.check(label, reply.startswith(b'HTTP/1.1 400 '), reply[:40])
+
+    # decoded audio and video
+    response, body = c.request('GET', '/%s%s?info' % (name, paths['SOUND']))
+    channels = json.loads(body.decode('utf-8'))['channels']
+    audio = [ch for ch in channels if ch['audio']][0]
+    response, body = c.request('GET', '/%s%s?record=%d&channel=%d&decode=wav' % (name, paths['SOUND'], audio['record'], audio['channel']))
+    c.check('wav', response.status == 200 and body[:4] == b'RIFF' and body[8:12] == b'WAVE' and
+            struct.unpack('<I', body[40:44])[0] == len(body) - 44 > 0, (response.status, body[:12]))
+
+    response, body = c.request('GET', '/%s%s?info' % (name, paths['MOVIE']))
+    channels = json.loads(body.decode('utf-8'))['channels']
+    video = [ch for ch in channels if ch['video']][0]
+    response, body = c.request('GET', '/%s%s?record=%d&channel=%d&decode=dyuv&frame=0' % (name, paths['MOVIE'], video['record'], video['channel']))
+    header = b'P6\n384 240\n255\n'
+    c.check('dyuv', response.status == 200 and body.startswith(header) and len(body) == len(header) + 384*240*3,
+            (response.status, body[:16], len(body)))
+
+    response, body = c.request('GET', '/%s%s?record=%d&channel=%d&decode=dyuv&frame=100000' % (name, paths['MOVIE'], video['record'], video['channel']))
+    c.check('missing frame', response.status == 404, response.status)
+
+    return c.failures
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check cdi_serve.py against a localhost client, over a synthetic disc image')
+    parser.add_argument('--sectors', type=int, default=IMAGE_SECTORS, help='Size of the synthetic image in sectors (default: %(default)d)')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix='cdi_serve_test')
+    try:
+        image_file = os.path.join(tmpdir, 'synth.bin')
+        with open(image_file, 'wb') as out:
+            write_image(out, args.sectors)
+        disc = Disc(open(image_file, 'rb'))
+        disc.read()
+        server = DiscServer({'synth': disc})
+
+        # serve from a thread of its own, on a port the system picks
+        loop = asyncio.new_event_loop()
+        listener = loop.run_until_complete(asyncio.start_server(server.handle, '127.0.0.1', 0))
+        port = listener.sockets[0].getsockname()[1]
+        thread = threading.Thread(target=loop.run_forever)
+        thread.daemon = True
+        thread.start()
+
+        try:
+            failures = run_checks(disc, 'synth', port)
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            listener.close()
+            loop.run_until_complete(listener.wait_closed())
+            loop.close()
+            server.decoder.shutdown()
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print("%d checks failed" % failures if failures else "all checks passed")
+    sys.exit(1 if failures else 0)
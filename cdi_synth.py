@@ -0,0 +1,373 @@
+from __future__ import print_function
+from cdi import *
+import argparse
+import struct
+
+import numpy as np
+
+# submode bits
+EOR      = 1<<0
+VIDEO    = 1<<1
+AUDIO    = 1<<2
+DATA     = 1<<3
+TRIGGER  = 1<<4
+FORM2    = 1<<5
+REALTIME = 1<<6
+EOF      = 1<<7
+
+# raw coding values
+AUDIO_LEVEL_A    = 0b00010000   # 8 bit, 37800Hz
+AUDIO_LEVEL_B    = 0b00000000   # 4 bit, 37800Hz
+AUDIO_LEVEL_C    = 0b00000100   # 4 bit, 18900Hz
+AUDIO_STEREO     = 0b00000001
+VIDEO_CLUT7      = 0b00000001
+VIDEO_DYUV       = 0b00000101
+
+FORM1_DATA_SIZE = 2048
+FORM2_DATA_SIZE = 2324
+SYNC = b'\x00' + b'\xff'*10 + b'\x00'
+
+# video frames at the default resolution, and how many sectors that takes
+FRAME_SIZE    = 384*240
+FRAME_SECTORS = (FRAME_SIZE + FORM2_DATA_SIZE - 1) // FORM2_DATA_SIZE
+
+FILES_PER_DIR = 40
+
+# sectors that get their EDC and ECC computed at once
+BATCH_SECTORS = 256
+
+def subheader(file_number, channel, submode, coding):
+    "The 8 bytes of a sub-header, with the redundant copy"
+    sh = struct.pack('>BBBB', file_number, channel, submode, coding)
+    return sh + sh
+
+def sector(file_number, channel, submode, coding, payload=b''):
+    "A full sector of Sector.FULL_SIZE bytes, with the payload padded or cut to the sector's data size"
+    size = FORM2_DATA_SIZE if submode & FORM2 else FORM1_DATA_SIZE
+    payload = bytes(payload[:size])
+    data = subheader(file_number, channel, submode, coding) + payload + b'\x00'*(size-len(payload))
+    return data + b'\x00'*(Sector.FULL_SIZE-len(data))
+
+def finished(sectors):
+    """Fill in the error detection and correction codes of a list of sectors. Returns them as a 2-D array, one sector per row.
+
+    Every sector gets an EDC, and Form 1 sectors get their ECC as well."""
+    block = np.frombuffer(b''.join(sectors), dtype=np.uint8).reshape(len(sectors), Sector.FULL_SIZE).copy()
+    form2 = (block[:, 2] & FORM2) != 0
+    edc = sector_edc(block, form2).astype('<u4').view(np.uint8).reshape(-1, 4)
+    block[form2, EDC_FORM2_SIZE:EDC_FORM2_SIZE+4] = edc[form2]
+    block[~form2, EDC_FORM1_SIZE:EDC_FORM1_SIZE+4] = edc[~form2]
+    block[~form2, ECC_P_OFFSET:] = sector_ecc(block[~form2])
+    return block
+
+def header(index):
+    "The CD header of the sector with the given index: sync pattern, BCD address and mode 2"
+    frames = index + 150
+    bcd = lambda v: ((v // 10) << 4) | (v % 10)
+    return SYNC + struct.pack('>BBBB', bcd(frames // (60*75)), bcd(frames // 75 % 60), bcd(frames % 75), 2)
+
+def _padded(s, size, fill=b' '):
+    s = s.encode('ascii') if not isinstance(s, bytes) else s
+    return s[:size] + fill*(size-len(s[:size]))
+
+def disc_label(volume_size, path_tbl_size, path_tbl_addr, volume_id='SYNTHETIC'):
+    "The data part of a standard disc label"
+    date = b'1993010112000000'
+    none = b'0'*16
+    return DiscLabel.LAYOUT.pack(DiscLabel.STANDARD, b'CD-I ', 1, 0, _padded('CD-RTOS', 32), _padded(volume_id, 32),
+                                 volume_size, _padded('', 32), 1, 1, FORM1_DATA_SIZE, path_tbl_size, path_tbl_addr,
+                                 _padded('', 128), _padded('', 128), _padded('', 128), _padded('', 128),
+                                 _padded('', 32), _padded('', 32), _padded('', 32), date, date, none, none, 1)
+
+def terminator():
+    "The data part of a disc label terminator"
+    return struct.pack('>B5s', DiscLabel.TERMINATOR, b'CD-I ')
+
+def dir_record(name, first_lbn, size, attributes, number=0, interleave=(0, 0)):
+    "A directory file record"
+    name = _padded(name, len(name))
+    record = (Directory.RECORD_HEAD.pack(0, 0, first_lbn, size, bytes(bytearray([93, 1, 1, 12, 0, 0])),
+                                         0, interleave[0], interleave[1], 1, len(name)) +
+              name + Directory.RECORD_TAIL.pack(0, attributes, number))
+    if len(record) % 2:
+        record += b'\x00'
+    return struct.pack('>B', len(record)) + record[1:]
+
+def path_record(name, lbn, parent):
+    "A path table record"
+    name = _padded(name, len(name))
+    return PathTable.RECORD_HEAD.pack(len(name), 0, lbn, parent) + name + b'\x00'*(len(name) % 2)
+
+def data_payload(rng, size):
+    "size random bytes"
+    return rng.randint(0, 256, size).astype(np.uint8).tobytes()
+
+def adpcm_payload(rng, level_a=False):
+    "The data part of an audio sector: 18 random sound groups with valid parameters"
+    groups = np.zeros((18, 128), dtype=np.uint8)
+    groups[:, 16:] = rng.randint(0, 256, (18, 112))
+    if level_a:
+        params = rng.randint(0, 9, (18, 4)) | (rng.randint(0, 4, (18, 4)) << 4)
+        groups[:, 0:16] = np.tile(params, 4)
+    else:
+        params = rng.randint(0, 13, (18, 8)) | (rng.randint(0, 4, (18, 8)) << 4)
+        groups[:, 0:4]   = params[:, 0:4]
+        groups[:, 4:12]  = params
+        groups[:, 12:16] = params[:, 4:8]
+    return groups.tobytes()
+
+class SynthFile(object):
+    """A file to be laid out on the synthetic disc: its name, file number and a function producing its sectors.
+
+    A file interleaved with a partner file has interleave (unit, gap) and
+    produces the sectors of both; the partner is only listed in the
+    directory, with its own interleave parameters."""
+    def __init__(self, name, number, nsectors, size, sectors, interleave=(0, 0), partner=None):
+        self.name     = name
+        self.number   = number
+        self.nsectors = nsectors
+        self.size     = size
+        self.sectors  = sectors     # function taking a random state, returning a generator of sectors
+        self.interleave = interleave
+        self.partner  = partner
+        self.first_lbn = None
+
+def data_file(name, number, nbytes):
+    "A Form 1 data file"
+    nsectors = max(1, (nbytes + FORM1_DATA_SIZE - 1) // FORM1_DATA_SIZE)
+    def sectors(rng):
+        for idx in range(nsectors):
+            submode = DATA | ((EOR|EOF) if idx == nsectors-1 else 0)
+            yield sector(0, 0, submode, 0, data_payload(rng, FORM1_DATA_SIZE))
+    return SynthFile(name, number, nsectors, nbytes, sectors)
+
+def sound_file(name, number, nsectors, coding):
+    "A real-time audio file of a single record"
+    def sectors(rng):
+        for idx in range(nsectors):
+            submode = FORM2 | REALTIME | AUDIO | ((EOR|EOF) if idx == nsectors-1 else 0)
+            yield sector(number, 0, submode, coding, adpcm_payload(rng, coding & AUDIO_LEVEL_A))
+    return SynthFile(name, number, nsectors, nsectors*FORM1_DATA_SIZE, sectors)
+
+def image_file(name, number, frames):
+    "A real-time CLUT7 image file with one record per frame"
+    nsectors = frames*FRAME_SECTORS
+    def sectors(rng):
+        for idx in range(nsectors):
+            submode = FORM2 | REALTIME | VIDEO
+            if idx % FRAME_SECTORS == FRAME_SECTORS-1: submode |= EOR
+            if idx == nsectors-1:                      submode |= EOF
+            yield sector(number, 0, submode, VIDEO_CLUT7, data_payload(rng, FORM2_DATA_SIZE))
+    return SynthFile(name, number, nsectors, nsectors*FORM1_DATA_SIZE, sectors)
+
+def movie_file(name, number, records, frames_per_record, audio_channels=1):
+    """A real-time file with DYUV video on channel 0 interleaved with Level B stereo audio on channels 1 and up.
+
+    Every fourth sector is an audio sector, taking turns between the audio channels."""
+    video_sectors = frames_per_record*FRAME_SECTORS
+    per_record = video_sectors + (video_sectors + 2) // 3
+    layout = []
+    for idx in range(per_record):
+        if idx % 4 == 3:
+            layout.append(1 + (idx // 4) % audio_channels)
+        else:
+            layout.append(0)
+
+    nsectors = records*per_record
+    def sectors(rng):
+        for record in range(records):
+            for idx, channel in enumerate(layout):
+                submode = FORM2 | REALTIME
+                if idx == per_record-1:
+                    submode |= EOR
+                    if record == records-1:
+                        submode |= EOF
+
+                if channel == 0:
+                    yield sector(number, channel, submode | VIDEO, VIDEO_DYUV, data_payload(rng, FORM2_DATA_SIZE))
+                else:
+                    yield sector(number, channel, submode | AUDIO, AUDIO_LEVEL_B | AUDIO_STEREO, adpcm_payload(rng))
+    return SynthFile(name, number, nsectors, nsectors*FORM1_DATA_SIZE, sectors)
+
+def interleaved_files(name, partner_name, number, partner_number, frames, unit=3, gap=1):
+    """A real-time DYUV video file interleaved block by block with a Level C audio file, as ISO 9660 interleaving does.
+
+    Units of unit video sectors alternate with gap audio sectors, and both
+    files carry matching interleave parameters in their directory records.
+    Returns the video file, with the audio file as its partner."""
+    video_sectors = frames*FRAME_SECTORS
+    units = (video_sectors + unit - 1) // unit
+    audio_sectors = (units - 1)*gap
+    partner = SynthFile(partner_name, partner_number, audio_sectors, audio_sectors*FORM1_DATA_SIZE, None, (gap, unit))
+
+    def sectors(rng):
+        for pos in range(video_sectors + audio_sectors):
+            u, r = divmod(pos, unit + gap)
+            if r < unit:
+                idx = u*unit + r
+                submode = FORM2 | REALTIME | VIDEO
+                if idx % FRAME_SECTORS == FRAME_SECTORS-1: submode |= EOR
+                if idx == video_sectors-1:                 submode |= EOF
+                yield sector(number, 0, submode, VIDEO_DYUV, data_payload(rng, FORM2_DATA_SIZE))
+            else:
+                idx = u*gap + r - unit
+                submode = FORM2 | REALTIME | AUDIO | ((EOR|EOF) if idx == audio_sectors-1 else 0)
+                yield sector(partner_number, 0, submode, AUDIO_LEVEL_C, adpcm_payload(rng))
+    return SynthFile(name, number, video_sectors + audio_sectors, video_sectors*FORM1_DATA_SIZE, sectors, (unit, gap), partner)
+
+def plan_files(target_sectors, rng, audio_channels=1):
+    "A list of SynthFiles, taking turns between the kinds of file, that together fill about target_sectors sectors"
+    files = []
+    total = 0
+    while total < target_sectors or not files:
+        idx    = len(files)
+        number = 1 + idx % 255
+        kind   = idx % 7
+        if   kind == 0: f = data_file('DATA%04d.BIN' % idx, number, int(rng.randint(1, 16*FORM1_DATA_SIZE)))
+        elif kind == 1: f = movie_file('MOVIE%04d.RTF' % idx, number, 2, 2, audio_channels)
+        elif kind == 2: f = sound_file('SOUND%04d.AUD' % idx, number, 20, AUDIO_LEVEL_C)
+        elif kind == 3: f = image_file('IMAGE%04d.C7' % idx, number, 2)
+        elif kind == 4: f = sound_file('SOUND%04d.AUD' % idx, number, 20, AUDIO_LEVEL_A)
+        elif kind == 5: f = sound_file('SOUND%04d.AUD' % idx, number, 20, AUDIO_LEVEL_B | AUDIO_STEREO)
+        else:           f = interleaved_files('TRACK%04d.RTF' % idx, 'TRACK%04d.AUD' % idx, number, (number + 127) % 255 + 1, 2)
+        files.append(f)
+        total += f.nsectors
+    return files
+
+def _dir_blocks(records):
+    "Cut a list of directory records into blocks, as records may not cross a block boundary"
+    blocks = [b'']
+    for record in records:
+        if len(blocks[-1]) + len(record) > FORM1_DATA_SIZE:
+            blocks.append(b'')
+        blocks[-1] += record
+    return blocks
+
+def write_image(out, target_sectors, seed=1, headers=False, audio_channels=1, files_per_dir=FILES_PER_DIR, damage=0):
+    """Write a synthetic CD-I disc image of about target_sectors sectors to the file object out.
+
+    The disc has a disc label, a path table, a /CDI directory with a
+    subdirectory per files_per_dir files, and files of every kind the
+    tools deal with: Form 1 data, ADPCM audio at all levels, interleaved
+    real-time movies with DYUV video and stereo audio, CLUT7 images, and
+    DYUV video files block-interleaved with audio files, with interleave
+    parameters in their directory records.
+    Every sector has a valid EDC and ECC, except for damage sectors of
+    files that get a byte of their data flipped afterwards, for testing
+    cdi_verify.py. Block numbers equal sector indices. The image is written a sector at a
+    time, so it can be much larger than memory. Returns the number of
+    sectors written."""
+    rng = np.random.RandomState(seed)
+    files = plan_files(target_sectors, rng, audio_channels)
+    groups = [files[i:i+files_per_dir] for i in range(0, len(files), files_per_dir)]
+
+    attributes = 0x8000 | 0x0111
+    dir_names = ['D%03d' % i for i in range(len(groups))]
+
+    # each directory's size depends only on its records, which only need fixed-size numbers, so lay out with zeros first
+    def cdi_records(cdi_lbn, cdi_size, sub_lbns, sub_sizes):
+        return ([dir_record(b'\x00', cdi_lbn, cdi_size, attributes), dir_record(b'\x01', 19, FORM1_DATA_SIZE, attributes)] +
+                [dir_record(name, lbn, size, attributes) for name, lbn, size in zip(dir_names, sub_lbns, sub_sizes)])
+
+    def listed(group):
+        "The files of a group as listed in their directory, partners following the files they are interleaved with"
+        for f in group:
+            yield f
+            if f.partner is not None:
+                yield f.partner
+
+    def sub_records(lbn, size, cdi_lbn, cdi_size, group):
+        return ([dir_record(b'\x00', lbn, size, attributes), dir_record(b'\x01', cdi_lbn, cdi_size, attributes)] +
+                [dir_record(f.name, f.first_lbn or 0, f.size, 0x0111, f.number, f.interleave) for f in listed(group)])
+
+    cdi_lbn    = 20
+    cdi_blocks = len(_dir_blocks(cdi_records(0, 0, [0]*len(groups), [0]*len(groups))))
+    lbn        = cdi_lbn + cdi_blocks
+    sub_lbns, sub_blocks = [], []
+    for group in groups:
+        sub_lbns.append(lbn)
+        sub_blocks.append(len(_dir_blocks(sub_records(0, 0, 0, 0, group))))
+        lbn += sub_blocks[-1]
+
+    for f in files:
+        f.first_lbn = lbn
+        if f.partner is not None:
+            f.partner.first_lbn = lbn + f.interleave[0]
+        lbn += f.nsectors
+    volume_size = lbn
+
+    cdi_size  = cdi_blocks*FORM1_DATA_SIZE
+    sub_sizes = [n*FORM1_DATA_SIZE for n in sub_blocks]
+
+    path_tbl = [path_record(b'\x00', 19, 1), path_record('CDI', cdi_lbn, 1)]
+    path_tbl += [path_record(name, sub_lbn, 2) for name, sub_lbn in zip(dir_names, sub_lbns)]
+    path_tbl = b''.join(path_tbl)
+    if len(path_tbl) > FORM1_DATA_SIZE:
+        raise ValueError("Too many directories for a single block path table, use more files per directory")
+
+    def system_sectors():
+        for idx in range(Disc.FIRST_DISCLABEL_IDX):
+            yield sector(0, 0, 0, 0)
+        yield sector(0, 0, DATA | EOR, 0, disc_label(volume_size, len(path_tbl), 18))
+        yield sector(0, 0, DATA | EOR | EOF, 0, terminator())
+        yield sector(0, 0, DATA | EOR | EOF, 0, path_tbl)
+
+        root = [dir_record(b'\x00', 19, FORM1_DATA_SIZE, attributes), dir_record(b'\x01', 19, FORM1_DATA_SIZE, attributes),
+                dir_record('CDI', cdi_lbn, cdi_size, attributes)]
+        directories = [_dir_blocks(root), _dir_blocks(cdi_records(cdi_lbn, cdi_size, sub_lbns, sub_sizes))]
+        directories += [_dir_blocks(sub_records(sub_lbn, size, cdi_lbn, cdi_size, group))
+                        for sub_lbn, size, group in zip(sub_lbns, sub_sizes, groups)]
+        for blocks in directories:
+            for idx, block in enumerate(blocks):
+                yield sector(0, 0, DATA | ((EOR|EOF) if idx == len(blocks)-1 else 0), 0, block)
+
+    def all_sectors():
+        for s in system_sectors():
+            yield s
+        for f in files:
+            for s in f.sectors(rng):
+                yield s
+
+    # sectors of files to damage, picked without touching the random contents
+    first_file = files[0].first_lbn
+    damaged = set((np.random.RandomState(seed + 1).permutation(volume_size - first_file)[:damage] + first_file).tolist())
+
+    count = 0
+    batch = []
+    def write_batch():
+        block = finished(batch)
+        for idx, row in enumerate(block, count - len(batch)):
+            if idx in damaged:
+                row[8 + idx % FORM1_DATA_SIZE] ^= 0xff
+            if headers:
+                out.write(header(idx))
+            out.write(row.tobytes())
+        del batch[:]
+
+    for s in all_sectors():
+        batch.append(s)
+        count += 1
+        if len(batch) == BATCH_SECTORS:
+            write_batch()
+    if batch:
+        write_batch()
+
+    assert count == volume_size
+    return count
+
+if __name__ == '__main__':
+    # parse command-line arguments
+    parser = argparse.ArgumentParser(description='Write a synthetic CD-I disc image, for testing and benchmarking the tools')
+    parser.add_argument('output_file',  help='Image file to write')
+    parser.add_argument('--size', '-s', type=float, default=10., help='Approximate size of the image in MB (default: 10)')
+    parser.add_argument('--seed', type=int, default=1, help='Seed for the random contents')
+    parser.add_argument('--headers', '-H', action='store_true', help='Write CD headers before every sector')
+    parser.add_argument('--audio-channels', type=int, default=1, help='Number of audio channels in the movie files (default: 1)')
+    parser.add_argument('--damage', type=int, default=0, help='Number of file sectors to damage after computing their EDC and ECC (default: 0)')
+    parser.add_argument('--files-per-dir', type=int, default=FILES_PER_DIR, help='Number of files per directory (default: %d)' % FILES_PER_DIR)
+
+    args = parser.parse_args()
+
+    with open(args.output_file, 'wb') as out:
+        count = write_image(out, int(args.size*1024*1024 / Sector.FULL_SIZE), args.seed, args.headers, args.audio_channels, args.files_per_dir, args.damage)
+    print("%s: %d sectors written." % (args.output_file, count))
@@ -0,0 +1,191 @@
+from __future__ import print_function
+from cdi import *
+import argparse
+import multiprocessing
+import sys
+
+# problems found in a sector, as bits of its flags
+BAD_SUBHEADER = 1<<0    # the two copies of the subheader differ
+BAD_EDC       = 1<<1
+BAD_ECC       = 1<<2
+BAD_HEADER    = 1<<3    # wrong sync pattern, mode or address in the CD header
+NO_EDC        = 1<<4    # Form 2 sector with an EDC of zero, which means it has none; not a problem
+
+PROBLEMS = ((BAD_SUBHEADER, 'subheader'), (BAD_EDC, 'EDC'), (BAD_ECC, 'ECC'), (BAD_HEADER, 'header'))
+BAD = BAD_SUBHEADER | BAD_EDC | BAD_ECC | BAD_HEADER
+
+BLOCK_SECTORS = 1024    # sectors checked at once
+CHUNK_SECTORS = 16384   # sectors per task for a worker process
+
+SYNC = np.frombuffer(b'\x00' + b'\xff'*10 + b'\x00', dtype=np.uint8)
+
+def header_addresses(headers):
+    """The sector addresses in the CD headers of a block, as numbers of frames from 00:00:00.
+
+    Addresses that are not valid BCD come out as -1."""
+    msf = headers[:, 12:15].astype(np.int64)
+    tens, units = msf >> 4, msf & 0xf
+    valid = ((tens < 10) & (units < 10)).all(axis=1)
+    m, s, f = (tens*10 + units).T
+    return np.where(valid, (m*60 + s)*75 + f, -1)
+
+def read_block(buffer, headers, start, stop):
+    """The full sectors with indices start to stop as a 2-D array, and their CD headers if the image has them.
+
+    A truncated last sector is padded with zeros, so it shows as damaged."""
+    stride = (Sector.FULL_SIZE+Disc.HEADER_LEN) if headers else Sector.FULL_SIZE
+    raw = buffer[start*stride:stop*stride]
+    if len(raw) < (stop-start)*stride:
+        raw = np.concatenate((raw, np.zeros((stop-start)*stride - len(raw), dtype=np.uint8)))
+    raw = raw.reshape(stop-start, stride)
+    if headers:
+        return raw[:, Disc.HEADER_LEN:], raw[:, :Disc.HEADER_LEN]
+    return raw, None
+
+def verify_block(block, headers=None, first_index=0, address_offset=0):
+    """Check a block of full sectors, and their CD headers if given. Returns the flags of every sector as a uint8 array.
+
+    The EDC is checked for all sectors and the ECC for Form 1 sectors.
+    The address in the header of sector i should be address_offset + i
+    frames, i counting from first_index for the first row."""
+    flags = np.zeros(len(block), dtype=np.uint8)
+    flags[(block[:, 0:4] != block[:, 4:8]).any(axis=1)] |= BAD_SUBHEADER
+
+    form2 = (block[:, 2] & (1<<5)) != 0
+    stored = stored_edc(block, form2)
+    no_edc = form2 & (stored == 0)
+    flags[no_edc] |= NO_EDC
+    flags[(sector_edc(block, form2) != stored) & ~no_edc] |= BAD_EDC
+
+    form1 = np.flatnonzero(~form2)
+    if len(form1):
+        ecc = sector_ecc(block[form1])
+        flags[form1[(ecc != block[form1, ECC_P_OFFSET:]).any(axis=1)]] |= BAD_ECC
+
+    if headers is not None:
+        expected = address_offset + first_index + np.arange(len(block))
+        bad = (headers[:, :12] != SYNC).any(axis=1) | (headers[:, 15] != 2) | (header_addresses(headers) != expected)
+        flags[bad] |= BAD_HEADER
+
+    return flags
+
+def verify_range(buffer, headers, start, stop, address_offset=0):
+    "Check the sectors with indices start to stop of an image, a block at a time. Returns their flags."
+    flags = []
+    with stats.stage('verify'):
+        for block_start in range(start, stop, BLOCK_SECTORS):
+            block_stop = min(stop, block_start + BLOCK_SECTORS)
+            block, header_block = read_block(buffer, headers, block_start, block_stop)
+            flags.append(verify_block(block, header_block, block_start, address_offset))
+    stats.count('sectors verified', stop - start)
+    return np.concatenate(flags) if flags else np.zeros(0, dtype=np.uint8)
+
+# per-process image for worker processes, each with its own read-only mmap
+_worker_disc = None
+
+def _init_worker(image_file, headers, with_stats):
+    global _worker_disc
+    if with_stats:
+        stats.enable()
+    _worker_disc = Disc(open(image_file, 'rb'), headers)
+
+def _verify_task(task):
+    "Check a chunk of sectors in a worker process. Returns the flags and the statistics of this task, if enabled."
+    start, stop, address_offset = task
+    flags = verify_range(_worker_disc.buffer, _worker_disc.headers, start, stop, address_offset)
+    return flags, (stats.take() if stats.enabled else None)
+
+def file_paths(disc):
+    "Dictionary of the full paths of all files on a disc, by first block number"
+    paths = {}
+    for directory in disc.path_tbl:
+        for f in directory:
+            if f.name not in Directory.SELF_NAMES:
+                paths[f.first_lbn] = directory.path + f.name
+    return paths
+
+def problems(flags):
+    "The names of the problems in the flags of a sector"
+    return [name for bit, name in PROBLEMS if flags & bit]
+
+if __name__ == '__main__':
+    # parse command-line arguments
+    parser = argparse.ArgumentParser(description='Check the EDC, ECC, subheaders and CD headers of all sectors of a CD-I disc image')
+    parser.add_argument('image_file', help='Image file to check')
+    parser.add_argument('--headers', '-H', action='store_true', help='Image file includes CD headers, which are checked as well')
+    parser.add_argument('--raw', '-R', action='store_true', help='Do not read the file system, only report sector numbers')
+    parser.add_argument('--jobs', '-j', type=int, default=multiprocessing.cpu_count(), help='Number of processes to check the image with')
+    parser.add_argument('--quiet', '-q', action='store_true', help='Only print the summary')
+    parser.add_argument('--cache', action='store_true', help='Keep an index of the image next to it, so that later runs do not have to scan it')
+    parser.add_argument('--cache-dir', metavar='DIR', help='Keep the index in DIR instead (implies --cache)')
+    parser.add_argument('--stats', action='store_true', help='Print a breakdown of where the time went to stderr when done')
+    parser.add_argument('--stats-json', metavar='FILE', help='Write the time breakdown and counters to FILE as JSON')
+    args = parser.parse_args()
+
+    if args.stats or args.stats_json:
+        stats.enable()
+
+    with open(args.image_file, 'rb') as cdifile:
+        disc = Disc(cdifile, args.headers)
+        index = DiscIndex(args.image_file, args.cache_dir) if args.cache or args.cache_dir else None
+
+        # the file system of a damaged image may not be readable; the sectors can still be checked
+        has_files = False
+        if not args.raw:
+            try:
+                disc.read(index)
+                has_files = disc.block_offset is not None
+            except Exception as e:
+                print("Cannot read the file system (%s: %s), only reporting sector numbers" % (type(e).__name__, e), file=sys.stderr)
+        if disc.sectors is None:
+            disc.read_sectors(index)
+
+        # addresses count on from that of the first sector
+        count = len(disc)
+        address_offset = 0
+        if args.headers and count:
+            address_offset = int(header_addresses(read_block(disc.buffer, True, 0, 1)[1])[0])
+
+        tasks = [(start, min(count, start + CHUNK_SECTORS), address_offset) for start in range(0, count, CHUNK_SECTORS)]
+        if args.jobs > 1 and len(tasks) > 1:
+            pool = multiprocessing.Pool(min(args.jobs, len(tasks)), _init_worker, (args.image_file, args.headers, stats.enabled))
+            results = pool.imap(_verify_task, tasks)
+        else:
+            pool = None
+            results = ((verify_range(disc.buffer, args.headers, start, stop, offset), None) for start, stop, offset in tasks)
+
+        flags = []
+        for chunk_flags, task_stats in results:
+            if task_stats is not None:
+                stats.merge(task_stats)
+            flags.append(chunk_flags)
+        flags = np.concatenate(flags) if flags else np.zeros(0, dtype=np.uint8)
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        bad = np.flatnonzero(flags & BAD)
+        if not args.quiet and len(bad):
+            paths = file_paths(disc) if has_files else {}
+            for idx in bad.tolist():
+                line = "sector %6d" % idx
+                if has_files:
+                    line += "  block %6d" % disc.sector2lbn(idx)
+                location = disc.locate(idx) if has_files else None
+                if location is not None:
+                    f, record, _ = location
+                    line += "  %-24s record %4d" % (paths.get(f.first_lbn, f.name), record)
+                line += "  channel %2d: %s" % (disc.sectors.channel_number[idx], ' '.join(problems(flags[idx])))
+                print(line)
+
+        print("%d sectors, %d ok, %d damaged: %s; %d Form 2 sectors without EDC" %
+              (count, count - len(bad), len(bad), ', '.join('%d %s' % (int(((flags & bit) != 0).sum()), name) for bit, name in PROBLEMS),
+               int(((flags & NO_EDC) != 0).sum())))
+
+    if args.stats:
+        stats.report(sys.stderr)
+    if args.stats_json:
+        stats.write_json(args.stats_json)
+
+    sys.exit(1 if len(bad) else 0)
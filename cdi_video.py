@@ -0,0 +1,520 @@
+from __future__ import print_function
+from cdi import *
+import errno
+import sys
+import threading
+import numpy as np
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue   # Python 2
+
+# default image size
+WIDTH  = 384
+HEIGHT = 240
+
+# raw coding value of CLUT7 video sectors at normal resolution, even lines
+CLUT7_CODING = 0b00000001
+
+# raw coding values of the other colour lookup table and run-length codings; the
+# upper bits give the resolution and odd/even lines, so only these bits are compared
+CODING_MASK  = 0b00001111
+CLUT4_CODING = 0b00000000
+CLUT8_CODING = 0b00000010
+RL3_CODING   = 0b00000011
+RL7_CODING   = 0b00000100
+
+def greyscale_clut(entries):
+    "A greyscale palette with the given number of entries, as an (entries, 3) uint8 array"
+    return np.repeat((np.arange(entries) * 255 // (entries - 1)).astype(np.uint8)[:, np.newaxis], 3, axis=1)
+
+# built-in greyscale palette, used when no colour lookup table file is given
+GREYSCALE_CLUT = greyscale_clut(128)
+
+# frames and sectors that may wait between the stages of a frame pipeline
+FRAME_QUEUE  = 8
+SECTOR_QUEUE = 256
+
+# DYUV delta quantization table
+DYUV_QUANT = np.array([ 0, 1, 4, 9, 16, 27, 44, 79, 128, 177, 212, 229, 240, 247, 252, 255 ], dtype=np.int64)
+
+# DYUV start values for each scanline
+DYUV_INITIAL = (0, 128, 0)
+
+def video_sectors(sectors, ignore_other=True, coding=None, coding_mask=0xff):
+    """Generator yielding the video sectors in a sequence of Sectors.
+
+    If coding is given, only video sectors with that raw coding value in the
+    bits of coding_mask count as video."""
+    for sector in sectors:
+        sh = sector.subheader
+        if (not sh.video) or (coding is not None and (sh.coding_raw & coding_mask) != coding):
+            if ignore_other:
+                continue
+            else:
+                raise RuntimeError("Found non-video sector in file")
+
+        yield sector
+
+def video_payloads(sectors, ignore_other=True, coding=None, coding_mask=0xff):
+    "Generator yielding the data part of each video sector in a sequence of Sectors, see video_sectors"
+    for sector in video_sectors(sectors, ignore_other, coding, coding_mask):
+        yield sector.data_view
+
+def frame_chunks(payloads, frame_size):
+    """Cut a stream of payloads into frames of frame_size bytes.
+
+    Frames may start and end anywhere within a payload. Yields a uint8 array
+    per complete frame; trailing bytes that do not make up a frame are
+    dropped."""
+    pending = []
+    pending_size = 0
+    for payload in payloads:
+        data = byte_array(payload)
+        while len(data) > 0:
+            take = min(frame_size - pending_size, len(data))
+            pending.append(data[:take])
+            pending_size += take
+            data = data[take:]
+
+            if pending_size == frame_size:
+                yield np.concatenate(pending)
+                pending = []
+                pending_size = 0
+
+def _dyuv_chroma(deltas, initial):
+    "Reconstruct a chroma component for all pixels from its per-pixel-pair deltas, one scanline per row"
+    # delta decoding on even pixels
+    even = (initial + np.cumsum(DYUV_QUANT[deltas], axis=1)) % 256
+
+    # odd pixels are interpolated from the next delta, except for the last one
+    odd = np.empty_like(even)
+    odd[:, :-1] = (even[:, :-1] + DYUV_QUANT[deltas[:, 1:] // 2]) % 256
+    odd[:, -1]  = (even[:, -1]  + DYUV_QUANT[deltas[:, -1]]) % 256
+
+    return np.stack((even, odd), axis=2).reshape(deltas.shape[0], -1)
+
+def decode_dyuv(data, width=WIDTH, height=HEIGHT, initial=DYUV_INITIAL):
+    """Decode a DYUV frame of width*height bytes.
+
+    Every byte pair holds the deltas (U, Y) and (V, Y) for two pixels. The
+    deltas are decoded as a running sum modulo 256 per scanline. Returns a
+    (height, width, 3) uint8 array of RGB pixels."""
+    with stats.stage('video decode'):
+        frame = _decode_dyuv(data, width, height, initial)
+    stats.count('pixels decoded', width*height)
+    return frame
+
+def _decode_dyuv(data, width, height, initial):
+    pairs = np.asarray(data, dtype=np.uint8)[:width*height].reshape(height, width//2, 2)
+
+    delta_u = (pairs[:, :, 0] & 0xf0) >> 4
+    delta_v = (pairs[:, :, 1] & 0xf0) >> 4
+    delta_y = (pairs & 0x0f).reshape(height, width)
+
+    y_initial, u_initial, v_initial = initial
+    Y = (y_initial + np.cumsum(DYUV_QUANT[delta_y], axis=1)) % 256
+    U = _dyuv_chroma(delta_u, u_initial)
+    V = _dyuv_chroma(delta_v, v_initial)
+
+    # matrixing to get RGB
+    B = Y + (U - 128) * 1.733
+    R = Y + (V - 128) * 1.371
+    G = (Y - 0.299 * R - 0.114 * B) / 0.587
+
+    rgb = np.stack((R, G, B), axis=2)
+    return np.clip(np.trunc(rgb), 0, 255).astype(np.uint8)
+
+def dyuv_frames(sectors, width=WIDTH, height=HEIGHT, initial=DYUV_INITIAL):
+    "Generator decoding the video sectors in a sequence of Sectors to DYUV frames"
+    for chunk in frame_chunks(video_payloads(sectors), width*height):
+        yield decode_dyuv(chunk, width, height, initial)
+
+def load_clut(filename, entries=128):
+    """Read a colour lookup table file.
+
+    Each line holds an index followed by the hexadecimal component values of
+    one colour; entries are taken in file order. Returns an (entries, 3)
+    uint8 array, with unused entries black."""
+    clut = np.zeros((entries, 3), dtype=np.uint8)
+    with open(filename) as cf:
+        colours = [l.strip().split()[1:] for l in cf.readlines() if l.strip()]
+
+    for idx, col in enumerate(colours[:entries]):
+        clut[idx] = [int(comp, 16) for comp in col]
+    return clut
+
+def decode_clut7(data, clut=GREYSCALE_CLUT, width=WIDTH, height=HEIGHT):
+    """Decode a CLUT7 frame of width*height bytes, one byte per pixel.
+
+    Returns a (height, width, 3) uint8 array of RGB pixels, gathered from
+    the (128, 3) palette clut."""
+    with stats.stage('video decode'):
+        pixels = np.asarray(data, dtype=np.uint8)[:width*height] & 0x7f
+        frame = clut[pixels].reshape(height, width, 3)
+    stats.count('pixels decoded', width*height)
+    return frame
+
+def clut7_frames(sectors, clut=GREYSCALE_CLUT, width=WIDTH, height=HEIGHT, ignore_other=True, coding=None):
+    "Generator decoding the video sectors in a sequence of Sectors to CLUT7 frames"
+    for chunk in frame_chunks(video_payloads(sectors, ignore_other, coding), width*height):
+        yield decode_clut7(chunk, clut, width, height)
+
+def decode_clut8(data, clut=None, width=WIDTH, height=HEIGHT):
+    """Decode a CLUT8 frame of width*height bytes, one byte per pixel.
+
+    Returns a (height, width, 3) uint8 array of RGB pixels, gathered from
+    the (256, 3) palette clut, greyscale if None."""
+    if clut is None:
+        clut = greyscale_clut(256)
+    with stats.stage('video decode'):
+        pixels = np.asarray(data, dtype=np.uint8)[:width*height]
+        frame = clut[pixels].reshape(height, width, 3)
+    stats.count('pixels decoded', width*height)
+    return frame
+
+def clut8_frames(sectors, clut=None, width=WIDTH, height=HEIGHT, ignore_other=True, coding=None):
+    "Generator decoding the video sectors in a sequence of Sectors to CLUT8 frames"
+    for chunk in frame_chunks(video_payloads(sectors, ignore_other, coding, CODING_MASK), width*height):
+        yield decode_clut8(chunk, clut, width, height)
+
+def decode_clut4(data, clut=None, width=WIDTH, height=HEIGHT):
+    """Decode a CLUT4 frame of width*height/2 bytes, two pixels per byte with the left one in the upper four bits.
+
+    Returns a (height, width, 3) uint8 array of RGB pixels, gathered from
+    the (16, 3) palette clut, greyscale if None."""
+    if clut is None:
+        clut = greyscale_clut(16)
+    with stats.stage('video decode'):
+        packed = np.asarray(data, dtype=np.uint8)[:width*height//2]
+        pixels = np.empty((len(packed), 2), dtype=np.uint8)
+        pixels[:, 0] = packed >> 4
+        pixels[:, 1] = packed & 0x0f
+        frame = clut[pixels.reshape(-1)].reshape(height, width, 3)
+    stats.count('pixels decoded', width*height)
+    return frame
+
+def clut4_frames(sectors, clut=None, width=WIDTH, height=HEIGHT, ignore_other=True, coding=None):
+    "Generator decoding the video sectors in a sequence of Sectors to CLUT4 frames"
+    for chunk in frame_chunks(video_payloads(sectors, ignore_other, coding, CODING_MASK), width*height//2):
+        yield decode_clut4(chunk, clut, width, height)
+
+def _rl_runs(data):
+    """Parse run-length coded data into its codes, without regard for lines.
+
+    A byte with the upper bit clear is a single code; one with the upper bit
+    set is followed by a run length byte, which may have any value. Returns
+    the offsets of the codes and their run lengths, 1 for single codes and 0
+    for runs to the end of the line. A run cut off by the end of the data is
+    left out."""
+    data = np.asarray(data, dtype=np.uint8)
+    idx = np.arange(len(data))
+    flagged = (data & 0x80) != 0
+
+    # the byte after an unflagged byte is always a code, so in a stretch of
+    # flagged bytes every other byte is a code, counting from its start
+    stretch_start = np.maximum.accumulate(np.where(flagged, 0, idx + 1))
+    run_codes = flagged & ((idx - stretch_start) % 2 == 0)
+    codes = np.ones(len(data), dtype=bool)
+    codes[1:] = ~run_codes[:-1]
+    if len(data) and run_codes[-1]:
+        codes[-1] = False
+
+    offsets = np.flatnonzero(codes)
+    lengths = np.ones(len(offsets), dtype=np.int64)
+    runs = run_codes[offsets]
+    lengths[runs] = data[offsets[runs] + 1]
+    return offsets, lengths
+
+def _rl_lines(lengths, line_length, height):
+    """Fit the run lengths of parsed codes into height lines of line_length units.
+
+    Runs of length 0 and runs that reach the end of a line end it. Returns
+    the run lengths of the codes that make up the frame, cut to fit, or
+    raises ValueError if there are not enough codes for the whole frame."""
+    ends = np.cumsum(lengths)
+    to_line_end = np.flatnonzero(lengths == 0)
+    fitted = lengths.copy()
+
+    code = 0
+    start = 0   # units before the current line
+    for line in range(height):
+        last = int(np.searchsorted(ends, start + line_length))
+        stop = int(np.searchsorted(to_line_end, code))
+        if stop < len(to_line_end):
+            last = min(last, int(to_line_end[stop]))
+        if last >= len(lengths):
+            raise ValueError("Run-length data ends in line %d of %d" % (line, height))
+
+        fitted[last] = start + line_length - (ends[last - 1] if last > 0 else 0)
+        code = last + 1
+        start = ends[last]
+
+    return fitted[:code]
+
+def _decode_rl(data, width, height, pair):
+    "Parse and expand a run-length coded frame. Returns a flat array of colour indices and the number of bytes used."
+    data = np.asarray(data, dtype=np.uint8)
+    offsets, lengths = _rl_runs(data)
+    lengths = _rl_lines(lengths, width//2 if pair else width, height)
+    offsets = offsets[:len(lengths)]
+
+    codes = data[offsets]
+    if pair:
+        colours = np.empty((len(codes), 2), dtype=np.uint8)
+        colours[:, 0] = (codes >> 4) & 0x07
+        colours[:, 1] = codes & 0x07
+    else:
+        colours = codes & 0x7f
+
+    used = int(offsets[-1]) + (2 if codes[-1] & 0x80 else 1) if len(codes) else 0
+    return np.repeat(colours, lengths, axis=0).reshape(-1), used
+
+def decode_rl7(data, clut=GREYSCALE_CLUT, width=WIDTH, height=HEIGHT):
+    """Decode an RL7 frame from the start of data.
+
+    Every byte holds a 7-bit colour; if its upper bit is set, the next byte
+    repeats it that many times, or to the end of the line if 0. Returns a
+    (height, width, 3) uint8 array of RGB pixels, gathered from the (128, 3)
+    palette clut, and the number of bytes used. Raises ValueError if data
+    ends before the frame does."""
+    with stats.stage('video decode'):
+        pixels, used = _decode_rl(data, width, height, False)
+        frame = clut[pixels].reshape(height, width, 3)
+    stats.count('pixels decoded', width*height)
+    return frame, used
+
+def decode_rl3(data, clut=None, width=WIDTH, height=HEIGHT):
+    """Decode an RL3 frame from the start of data.
+
+    Every byte holds the 3-bit colours of two pixels, the left one in bits 4
+    to 6; if its upper bit is set, the next byte repeats the pair that many
+    times, or to the end of the line if 0. Returns a (height, width, 3)
+    uint8 array of RGB pixels, gathered from the (8, 3) palette clut,
+    greyscale if None, and the number of bytes used. Raises ValueError if
+    data ends before the frame does."""
+    if clut is None:
+        clut = greyscale_clut(8)
+    with stats.stage('video decode'):
+        pixels, used = _decode_rl(data, width, height, True)
+        frame = clut[pixels].reshape(height, width, 3)
+    stats.count('pixels decoded', width*height)
+    return frame, used
+
+def _rl_frames(decode, sectors, clut, width, height, ignore_other, coding):
+    """Decode the frame at the start of each record of video sectors; the rest of a record is padding.
+
+    A record that does not hold a whole frame gives a black frame and a
+    warning on stderr, so frame numbers stay those of the records."""
+    def frame(pending, record):
+        try:
+            return decode(np.concatenate(pending), clut, width, height)[0]
+        except ValueError as e:
+            print("Warning: video record %d: %s, writing a black frame" % (record, e), file=sys.stderr)
+            return np.zeros((height, width, 3), dtype=np.uint8)
+
+    pending = []
+    record = 0
+    for sector in video_sectors(sectors, ignore_other, coding, CODING_MASK):
+        pending.append(byte_array(sector.data_view))
+        if sector.subheader.eor:
+            yield frame(pending, record)
+            pending = []
+            record += 1
+
+    if pending:
+        yield frame(pending, record)
+
+def rl7_frames(sectors, clut=GREYSCALE_CLUT, width=WIDTH, height=HEIGHT, ignore_other=True, coding=None):
+    "Generator decoding the video sectors in a sequence of Sectors to RL7 frames, one per record"
+    return _rl_frames(decode_rl7, sectors, clut, width, height, ignore_other, coding)
+
+def rl3_frames(sectors, clut=None, width=WIDTH, height=HEIGHT, ignore_other=True, coding=None):
+    "Generator decoding the video sectors in a sequence of Sectors to RL3 frames, one per record"
+    return _rl_frames(decode_rl3, sectors, clut, width, height, ignore_other, coding)
+
+def payload_frames(payload, coding, clut=None, width=WIDTH, height=HEIGHT, initial=DYUV_INITIAL):
+    """Generator decoding frames of a fixed-size coding, 'dyuv', 'clut4', 'clut7' or 'clut8', from the data parts of video sectors.
+
+    payload holds the data part of a sector per row, as Disc.payload gives
+    them; the rows are views on the image, so each frame is copied once,
+    when its bytes are put together. clut applies to the CLUT codings,
+    greyscale if None, and initial to DYUV."""
+    if coding == 'dyuv':
+        size, decode = width*height, lambda chunk: decode_dyuv(chunk, width, height, initial)
+    elif coding in ('clut4', 'clut7', 'clut8'):
+        entries = CLUT_DECODERS[coding][2]
+        clut = greyscale_clut(entries) if clut is None else clut
+        size = width*height//2 if coding == 'clut4' else width*height
+        decoder = {'clut4': decode_clut4, 'clut7': decode_clut7, 'clut8': decode_clut8}[coding]
+        decode = lambda chunk: decoder(chunk, clut, width, height)
+    else:
+        raise ValueError("Frames of coding '%s' have no fixed size" % coding)
+
+    for chunk in frame_chunks(payload, size):
+        yield decode(chunk)
+
+# frame generators and raw coding values by name, for the scripts
+CLUT_DECODERS = {
+    'clut4': (clut4_frames, CLUT4_CODING, 16),
+    'clut7': (clut7_frames, CLUT7_CODING, 128),
+    'clut8': (clut8_frames, CLUT8_CODING, 256),
+    'rl3':   (rl3_frames,   RL3_CODING,   8),
+    'rl7':   (rl7_frames,   RL7_CODING,   128),
+}
+
+def write_pnm(filename, frame):
+    "Write an RGB frame as a binary PNM file"
+    height, width = frame.shape[:2]
+    with stats.stage('output'):
+        with open(filename, 'wb') as f:
+            f.write(("P6\n%d %d\n255\n" % (width, height)).encode('ascii'))
+            f.write(np.ascontiguousarray(frame, dtype=np.uint8).tobytes())
+    stats.count('bytes written', frame.size)
+
+def prefetch(iterable, depth):
+    """Generator yielding the items of iterable, which are produced ahead on a background thread.
+
+    At most depth items wait in a queue in between, so a slow consumer holds
+    back the producer instead of piling up items in memory. An exception in
+    the producer is raised again in the consumer; when the consumer stops
+    early, the producer stops at its next item."""
+    items = queue.Queue(depth)
+    stopped = threading.Event()
+    end = object()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except Exception as e:
+            put((end, e))
+        else:
+            put((end, None))
+        finally:
+            # let a generator, and any prefetch it reads from, finish now
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is end:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stopped.set()
+
+def frame_pipeline(sectors, decode_frames, depth=FRAME_QUEUE):
+    """Generator yielding the frames of decode_frames(sectors), with the sectors read on one background thread and decoded on another.
+
+    Reading, decoding and whatever the caller does with the frames overlap,
+    with at most depth decoded frames waiting."""
+    return prefetch(decode_frames(prefetch(sectors, SECTOR_QUEUE)), depth)
+
+def parse_rate(rate):
+    "A frame rate given as 'N' or 'N:D' frames per second, as a tuple (N, D)"
+    numerator, _, denominator = str(rate).partition(':')
+    rate = (int(numerator), int(denominator or 1))
+    if rate[0] <= 0 or rate[1] <= 0:
+        raise ValueError("Frame rate must be positive")
+    return rate
+
+def rgb_to_ycbcr(frame):
+    "Convert an RGB frame to a (3, height, width) uint8 array of Y, Cb and Cr planes, in the BT.601 studio range"
+    rgb = np.asarray(frame, dtype=np.float32)
+    R, G, B = rgb[:, :, 0], rgb[:, :, 1], rgb[:, :, 2]
+    Y  =  16 + ( 65.481*R + 128.553*G +  24.966*B) / 255
+    Cb = 128 + (-37.797*R -  74.203*G + 112.0  *B) / 255
+    Cr = 128 + (112.0  *R -  93.786*G -  18.214*B) / 255
+    return np.clip(np.rint(np.stack((Y, Cb, Cr))), 0, 255).astype(np.uint8)
+
+def open_output(filename):
+    "A binary file object to write a stream to: standard output for '-', otherwise a new file"
+    if filename == '-':
+        return getattr(sys.stdout, 'buffer', sys.stdout)
+    return open(filename, 'wb')
+
+def stream_frames(frames, filename, format='y4m', width=WIDTH, height=HEIGHT, rate=(25, 1)):
+    """Write a sequence of frames to filename, '-' for standard output, as a single FrameStream.
+
+    Returns the number of frames written, or None if the reading end of a
+    pipe went away first, like a player that was closed; frames is then
+    closed, so a frame_pipeline stops its threads."""
+    out = open_output(filename)
+    stream = FrameStream(out, format, width, height, rate)
+    try:
+        for frame in frames:
+            stream.write(frame)
+        stream.flush()
+    except (IOError, OSError) as e:
+        if e.errno != errno.EPIPE:
+            raise
+        if hasattr(frames, 'close'):
+            frames.close()
+        if filename == '-':
+            # nothing more can reach the reader; keep the exit from failing to flush as well
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return None
+    finally:
+        if filename != '-':
+            out.close()
+    return stream.frames
+
+class FrameStream(object):
+    """Writes RGB frames one after the other to a binary file object, as a single video stream.
+
+    format 'y4m' writes a YUV4MPEG2 stream with 4:4:4 chroma, which video
+    encoders read directly; 'rgb' writes the bare RGB24 pixels, so the
+    reader has to be told the size and rate. rate is the frame rate as a
+    tuple (N, D) of N/D frames per second."""
+
+    FORMATS = ('y4m', 'rgb')
+
+    def __init__(self, out, format='y4m', width=WIDTH, height=HEIGHT, rate=(25, 1)):
+        if format not in FrameStream.FORMATS:
+            raise ValueError("Unknown stream format '%s'" % format)
+        self.out    = out
+        self.format = format
+        self.width  = width
+        self.height = height
+        self.rate   = tuple(rate)
+        self.frames = 0
+
+        if format == 'y4m':
+            self._write(("YUV4MPEG2 W%d H%d F%d:%d Ip A1:1 C444\n" % ((width, height) + self.rate)).encode('ascii'))
+
+    def write(self, frame):
+        "Write a (height, width, 3) frame"
+        if frame.shape[:2] != (self.height, self.width):
+            raise ValueError("Frame of %dx%d pixels in a %dx%d stream" % (frame.shape[1], frame.shape[0], self.width, self.height))
+        if self.format == 'y4m':
+            self._write(b'FRAME\n')
+            self._write(rgb_to_ycbcr(frame).tobytes())
+        else:
+            self._write(np.ascontiguousarray(frame, dtype=np.uint8).tobytes())
+        self.frames += 1
+
+    def flush(self):
+        self.out.flush()
+
+    def _write(self, data):
+        with stats.stage('output'):
+            self.out.write(data)
+        stats.count('bytes written', len(data))